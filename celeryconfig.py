@@ -1,5 +1,10 @@
 import os
 
+from kombu import Queue
+
+from emailservice_config import MAILSERVICE_BATCH_MODE, MAILSERVICE_BATCH_SIZE, MAILSERVICE_TRANSACTIONAL_QUEUE, \
+    MAILSERVICE_BULK_QUEUE
+
 # Setup broker for task communication
 # In production this should be AMQP (and not redis) to avoid loosing tasks due to worker failure.
 # For local testing, redis is the default
@@ -9,13 +14,34 @@ BROKER_URL = os.environ.get("BROKER_URL", "redis://localhost")
 # Use redis as results are looked up by key, are temporary and if lost it is non-critical
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost")
 
+# Tasks carry emails in the compact wire format of micromailer.models.encode_email and results are
+# plain dicts, so JSON is used instead of pickle for both
+CELERY_TASK_SERIALIZER = "json"
+CELERY_RESULT_SERIALIZER = "json"
+CELERY_ACCEPT_CONTENT = ["json"]
+
 # Default queue to send tasks. Should be unique if the RabbitMQ service is shared with other applications
-CELERY_DEFAULT_QUEUE = "mailservice"
+CELERY_DEFAULT_QUEUE = MAILSERVICE_TRANSACTIONAL_QUEUE
 
-# Store results for 3 hours with a maximum of 10M results. On redis this should stay within 8GB of memory
+# The queues of the priority lanes, which are consumed by the workers unless started with -Q. The
+# routing key of each queue is its name, so the workers can tell the lane of a task from it
+CELERY_QUEUES = (
+    Queue(MAILSERVICE_TRANSACTIONAL_QUEUE, routing_key=MAILSERVICE_TRANSACTIONAL_QUEUE),
+    Queue(MAILSERVICE_BULK_QUEUE, routing_key=MAILSERVICE_BULK_QUEUE)
+)
+
+# Store results for 3 hours with a maximum of 10M results. Delivered emails are stored as compact
+# delivery records of about 300 bytes per result on redis including the key (see
+# tests/result_size_benchmark.py), so 10M results stay within 3GB of memory
 CELERY_MAX_CACHED_RESULTS = 10000000
 CELERY_TASK_RESULT_EXPIRES = 10800
 
 # Only acknowledge tasks AFTER they have been executed. Setting this to False could loose a task
-# Note: This may result in duplicate emails being delivered as micromailer is not idempotent
+# Redelivered tasks of emails that were already delivered are skipped by their email id (see
+# MAILSERVICE_IDEMPOTENCY), unless the worker died between the delivery and recording it
 CELERY_ACKS_LATE = True
+
+# The batching consumer only receives as many messages as are prefetched, so prefetch a full batch
+# per worker process when it is enabled
+if MAILSERVICE_BATCH_MODE:
+    CELERYD_PREFETCH_MULTIPLIER = MAILSERVICE_BATCH_SIZE
@@ -3,5 +3,108 @@ import os
 SENDGRID_API_KEY = os.environ['SENDGRID_API_KEY'] if 'SENDGRID_API_KEY' in os.environ else None
 MANDRILL_API_KEY = os.environ['MANDRILL_API_KEY'] if 'MANDRILL_API_KEY' in os.environ else None
 
+# API endpoints of the mail services. Only changed to use a stand-in for the services, like the
+# fake provider of the benchmarks (tests/fake_provider.py)
+SENDGRID_API_URL = os.environ.get('SENDGRID_API_URL', None)
+MANDRILL_API_URL = os.environ.get('MANDRILL_API_URL', None)
+
+# Number of keep-alive connections kept open to each mail service per worker process
+# and the (connect, read) timeouts in seconds for requests to the mail services
+MAILSERVICE_HTTP_POOL_SIZE = int(os.environ.get('MAILSERVICE_HTTP_POOL_SIZE', 10))
+MAILSERVICE_HTTP_TIMEOUT = (float(os.environ.get('MAILSERVICE_HTTP_CONNECT_TIMEOUT', 3.05)),
+                            float(os.environ.get('MAILSERVICE_HTTP_READ_TIMEOUT', 10)))
+
+# Maximum number of concurrent requests to each mail service per worker process. Defaults to
+# the number of keep-alive connections
+MAILSERVICE_MAX_CONCURRENCY = int(os.environ['MAILSERVICE_MAX_CONCURRENCY']) if 'MAILSERVICE_MAX_CONCURRENCY' in os.environ else None
+
+# Batching consumer mode. When enabled, emails are enqueued for a task that collects up to
+# MAILSERVICE_BATCH_SIZE emails or waits at most MAILSERVICE_BATCH_INTERVAL_MS milliseconds
+# and delivers them with as few requests to the mail services as possible
+MAILSERVICE_BATCH_MODE = os.environ.get('MAILSERVICE_BATCH_MODE', '0') == '1'
+MAILSERVICE_BATCH_SIZE = int(os.environ.get('MAILSERVICE_BATCH_SIZE', 100))
+MAILSERVICE_BATCH_INTERVAL_MS = int(os.environ.get('MAILSERVICE_BATCH_INTERVAL_MS', 200))
+
+# Maximum size in bytes of the cache of rendered markdown content per process. With
+# MAILSERVICE_RENDER_IN_WORKER=1 the web tier only validates and enqueues the markdown
+# content and the workers render it before delivery
+MAILSERVICE_RENDER_CACHE_BYTES = int(os.environ.get('MAILSERVICE_RENDER_CACHE_BYTES', 32 * 1024 * 1024))
+MAILSERVICE_RENDER_IN_WORKER = os.environ.get('MAILSERVICE_RENDER_IN_WORKER', '0') == '1'
+
+# Rate limits of the mail services in emails per second with bursts of up to the given
+# number of emails. The limits are shared by all the workers when redis is the result
+# backend. An email waits at most MAILSERVICE_RATE_LIMIT_WAIT seconds for the limit
+# before it is retried. While a service is at its limit the emails are sent with the
+# other services
+SENDGRID_RATE_LIMIT = float(os.environ['SENDGRID_RATE_LIMIT']) if 'SENDGRID_RATE_LIMIT' in os.environ else None
+SENDGRID_RATE_BURST = int(os.environ.get('SENDGRID_RATE_BURST', 100))
+MANDRILL_RATE_LIMIT = float(os.environ['MANDRILL_RATE_LIMIT']) if 'MANDRILL_RATE_LIMIT' in os.environ else None
+MANDRILL_RATE_BURST = int(os.environ.get('MANDRILL_RATE_BURST', 100))
+MAILSERVICE_RATE_LIMIT_WAIT = float(os.environ.get('MAILSERVICE_RATE_LIMIT_WAIT', 1))
+
+# Policy selecting the mail service for each email: highest-score sends everything with the
+# healthiest service, weighted-random, power-of-two-choices and least-outstanding spread the
+# emails over the services by their score and number of requests in flight
+MAILSERVICE_DISPATCH_POLICY = os.environ.get('MAILSERVICE_DISPATCH_POLICY', 'highest-score')
+
+# With failover, an email that fails with one mail service is tried with the other services
+# by the same task before it is retried later. MAILSERVICE_ATTEMPT_TIMEOUT is the number of
+# seconds to wait for a service before failing over, which defaults to the HTTP timeouts
+MAILSERVICE_FAILOVER = os.environ.get('MAILSERVICE_FAILOVER', '1') == '1'
+MAILSERVICE_ATTEMPT_TIMEOUT = float(os.environ['MAILSERVICE_ATTEMPT_TIMEOUT']) if 'MAILSERVICE_ATTEMPT_TIMEOUT' in os.environ else None
+
+# Circuit breaker of each mail service. The breaker opens when MAILSERVICE_CIRCUIT_FAILURES
+# requests fail within MAILSERVICE_CIRCUIT_WINDOW seconds, after which emails fail fast
+# without calling the service. After MAILSERVICE_CIRCUIT_OPEN_TIMEOUT seconds up to
+# MAILSERVICE_CIRCUIT_PROBES requests are let through to find out if the service recovered.
+# The breakers are shared by all the workers when redis is the result backend. Disabled with 0
+# failures
+MAILSERVICE_CIRCUIT_FAILURES = int(os.environ.get('MAILSERVICE_CIRCUIT_FAILURES', 5))
+MAILSERVICE_CIRCUIT_WINDOW = float(os.environ.get('MAILSERVICE_CIRCUIT_WINDOW', 60))
+MAILSERVICE_CIRCUIT_OPEN_TIMEOUT = float(os.environ.get('MAILSERVICE_CIRCUIT_OPEN_TIMEOUT', 30))
+MAILSERVICE_CIRCUIT_PROBES = int(os.environ.get('MAILSERVICE_CIRCUIT_PROBES', 1))
+
+# Retries of failed emails back off exponentially with random jitter from MAILSERVICE_RETRY_BASE_DELAY
+# up to MAILSERVICE_RETRY_MAX_DELAY seconds. An email is given up after MAILSERVICE_RETRY_MAX_ATTEMPTS
+# attempts or MAILSERVICE_DELIVERY_DEADLINE seconds and sent to the MAILSERVICE_DEAD_LETTER_QUEUE queue
+MAILSERVICE_RETRY_BASE_DELAY = float(os.environ.get('MAILSERVICE_RETRY_BASE_DELAY', 10))
+MAILSERVICE_RETRY_MAX_DELAY = float(os.environ.get('MAILSERVICE_RETRY_MAX_DELAY', 600))
+MAILSERVICE_RETRY_MAX_ATTEMPTS = int(os.environ.get('MAILSERVICE_RETRY_MAX_ATTEMPTS', 10))
+MAILSERVICE_DELIVERY_DEADLINE = float(os.environ.get('MAILSERVICE_DELIVERY_DEADLINE', 10800))
+MAILSERVICE_DEAD_LETTER_QUEUE = os.environ.get('MAILSERVICE_DEAD_LETTER_QUEUE', 'mailservice.deadletter')
+
+# Priority lanes. Emails are queued on MAILSERVICE_TRANSACTIONAL_QUEUE unless they are posted with
+# priority=bulk, in which case they are queued on MAILSERVICE_BULK_QUEUE, so bulk sends such as
+# newsletters do not delay transactional emails such as password resets. Workers consume both
+# queues unless started with -Q, which is used to reserve workers for the transactional lane
+MAILSERVICE_TRANSACTIONAL_QUEUE = os.environ.get('MAILSERVICE_TRANSACTIONAL_QUEUE', 'mailservice')
+MAILSERVICE_BULK_QUEUE = os.environ.get('MAILSERVICE_BULK_QUEUE', 'mailservice.bulk')
+
+# Deduplication of emails delivered more than once, for example when a task is redelivered
+# after a worker died as tasks are acknowledged late. The id of every delivered email is kept
+# for MAILSERVICE_IDEMPOTENCY_TTL seconds, shared by all the workers when redis is the result
+# backend. A worker claims an email for MAILSERVICE_IDEMPOTENCY_CLAIM_TTL seconds while
+# delivering it, which should be longer than the time it takes to try all the mail services
+MAILSERVICE_IDEMPOTENCY = os.environ.get('MAILSERVICE_IDEMPOTENCY', '1') == '1'
+MAILSERVICE_IDEMPOTENCY_TTL = int(os.environ.get('MAILSERVICE_IDEMPOTENCY_TTL', 10800))
+MAILSERVICE_IDEMPOTENCY_CLAIM_TTL = float(os.environ.get('MAILSERVICE_IDEMPOTENCY_CLAIM_TTL', 120))
+
+# Port the workers serve their metrics on at /metrics in the Prometheus text format. Every worker
+# process has its own metrics, so with the prefork pool each process serves them on a free port
+# of the ports from MAILSERVICE_METRICS_PORT to MAILSERVICE_METRICS_PORT + concurrency - 1, which
+# are all scraped. Disabled unless set
+MAILSERVICE_METRICS_PORT = int(os.environ['MAILSERVICE_METRICS_PORT']) if 'MAILSERVICE_METRICS_PORT' in os.environ else None
+
+# Port the webservice serves its metrics on at /metrics in the Prometheus text format. Like the
+# workers, each uwsgi worker serves its own metrics on a free port of the ports from
+# MAILSERVICE_WEB_METRICS_PORT to MAILSERVICE_WEB_METRICS_PORT + workers - 1. Disabled unless set
+MAILSERVICE_WEB_METRICS_PORT = int(os.environ['MAILSERVICE_WEB_METRICS_PORT']) if 'MAILSERVICE_WEB_METRICS_PORT' in os.environ else None
+
+# Trace a MAILSERVICE_TRACE_SAMPLE_RATE fraction of the emails from the webservice through the
+# workers to the mail services. The spans are appended as lines of JSON to MAILSERVICE_TRACE_FILE.
+# Disabled unless the file is set
+MAILSERVICE_TRACE_FILE = os.environ.get('MAILSERVICE_TRACE_FILE', None)
+MAILSERVICE_TRACE_SAMPLE_RATE = float(os.environ.get('MAILSERVICE_TRACE_SAMPLE_RATE', 0.01))
+
 MAILSERVICE_SENDER_EMAIL = 'no-reply@martindam.dk'
 MAILSERVICE_SENDER_NAME = 'MD Mail Service'
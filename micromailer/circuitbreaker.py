@@ -0,0 +1,221 @@
+import time
+from threading import Lock
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+# Base class for circuit breakers. The breaker is closed while the service
+# works. It opens when failure_threshold requests fail within window seconds,
+# and while open requests fail fast without calling the service. After
+# open_timeout seconds the breaker is half-open and lets up to max_probes
+# requests through to probe the service. A successful probe closes the
+# breaker and a failed probe opens it again. Probes that do not report back
+# within open_timeout seconds are given up on, so other requests can probe.
+class CircuitBreakerBase(object):
+
+    def __init__(self, failure_threshold=5, window=60, open_timeout=30, max_probes=1):
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.open_timeout = open_timeout
+        self.max_probes = max_probes
+
+    # Returns True if a request may be made to the service
+    def allow(self):
+        raise NotImplementedError
+
+    # Record the outcome of a request that was allowed
+    def record(self, success):
+        raise NotImplementedError
+
+    # True if requests to the service currently fail fast
+    def is_open(self):
+        raise NotImplementedError
+
+    # True if the breaker is half-open, so the requests allowed are probes
+    def is_half_open(self):
+        raise NotImplementedError
+
+    def _get_time(self):
+        return time.time()
+
+
+# Circuit breaker kept in the process memory
+class CircuitBreaker(CircuitBreakerBase):
+
+    def __init__(self, failure_threshold=5, window=60, open_timeout=30, max_probes=1):
+        super(CircuitBreaker, self).__init__(failure_threshold, window, open_timeout, max_probes)
+        self._lock = Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._window_start = 0
+        self._open_until = 0
+        self._probes = 0
+
+    def allow(self):
+        now = self._get_time()
+        with self._lock:
+            if self.state == OPEN:
+                if now < self._open_until:
+                    return False
+                self.state = HALF_OPEN
+                self._probes = 0
+                self._open_until = now + self.open_timeout
+            if self.state == HALF_OPEN:
+                if now >= self._open_until:
+                    self._probes = 0
+                    self._open_until = now + self.open_timeout
+                if self._probes >= self.max_probes:
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, success):
+        now = self._get_time()
+        with self._lock:
+            if success:
+                if self.state == HALF_OPEN:
+                    self.state = CLOSED
+                    self._failures = 0
+            elif self.state == HALF_OPEN:
+                self._open(now)
+            elif self.state == CLOSED:
+                if now - self._window_start > self.window:
+                    self._failures = 0
+                    self._window_start = now
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._open(now)
+
+    def is_open(self):
+        with self._lock:
+            return self.state == OPEN and self._get_time() < self._open_until
+
+    def is_half_open(self):
+        with self._lock:
+            return self.state == HALF_OPEN
+
+    def _open(self, now):
+        self.state = OPEN
+        self._open_until = now + self.open_timeout
+
+
+# Check whether a request may be made and move an open breaker to half-open.
+# Returns the state (or "probe" if the request is a probe) and the time the
+# breaker stays open. Numbers are returned as strings, as redis truncates Lua
+# numbers to integers
+_allow_script = """
+local open_timeout = tonumber(ARGV[1])
+local max_probes = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local values = redis.call('HMGET', KEYS[1], 'state', 'open_until', 'probes')
+local state = values[1] or 'closed'
+local open_until = tonumber(values[2]) or 0
+local probes = tonumber(values[3]) or 0
+if state == 'open' then
+    if now < open_until then
+        return {'open', tostring(open_until)}
+    end
+    state = 'half-open'
+    probes = 0
+    open_until = now + open_timeout
+end
+if state == 'half-open' then
+    if now >= open_until then
+        probes = 0
+        open_until = now + open_timeout
+    end
+    if probes >= max_probes then
+        redis.call('HMSET', KEYS[1], 'state', state, 'open_until', tostring(open_until), 'probes', probes)
+        return {'half-open', tostring(open_until)}
+    end
+    redis.call('HMSET', KEYS[1], 'state', state, 'open_until', tostring(open_until), 'probes', probes + 1)
+    return {'probe', tostring(open_until)}
+end
+return {'closed', '0'}
+"""
+
+# Record the outcome of a request. Returns the state and the time the breaker
+# stays open
+_record_script = """
+local success = ARGV[1] == '1'
+local failure_threshold = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local open_timeout = tonumber(ARGV[4])
+local now = tonumber(ARGV[5])
+local values = redis.call('HMGET', KEYS[1], 'state', 'open_until', 'failures', 'window_start')
+local state = values[1] or 'closed'
+local open_until = values[2] or '0'
+local failures = tonumber(values[3]) or 0
+local window_start = tonumber(values[4]) or 0
+if success then
+    if state == 'half-open' then
+        state = 'closed'
+        redis.call('HMSET', KEYS[1], 'state', state, 'failures', 0)
+    end
+elseif state == 'half-open' then
+    state = 'open'
+    open_until = tostring(now + open_timeout)
+    redis.call('HMSET', KEYS[1], 'state', state, 'open_until', open_until)
+elseif state == 'closed' then
+    if now - window_start > window then
+        failures = 0
+        window_start = now
+    end
+    failures = failures + 1
+    if failures >= failure_threshold then
+        state = 'open'
+        open_until = tostring(now + open_timeout)
+    end
+    redis.call('HMSET', KEYS[1], 'state', state, 'open_until', open_until, 'failures', failures,
+               'window_start', tostring(window_start))
+end
+return {state, open_until}
+"""
+
+
+# Circuit breaker stored in redis, so all the worker processes on all the
+# nodes sharing the redis server see the same state and an outage found by
+# one worker opens the breaker for all of them. To avoid a redis request for
+# every email, a closed state is trusted for sync_interval seconds and an open
+# state until it times out. Successful requests are only reported to redis
+# when the breaker is not closed
+class RedisCircuitBreaker(CircuitBreakerBase):
+
+    def __init__(self, client, key, failure_threshold=5, window=60, open_timeout=30, max_probes=1, sync_interval=1):
+        super(RedisCircuitBreaker, self).__init__(failure_threshold, window, open_timeout, max_probes)
+        self._key = key
+        self._sync_interval = sync_interval
+        self._allow_script = client.register_script(_allow_script)
+        self._record_script = client.register_script(_record_script)
+        self._state = (CLOSED, 0, 0)
+
+    def allow(self):
+        now = self._get_time()
+        state, open_until, valid_until = self._state
+        if state == CLOSED and now < valid_until:
+            return True
+        if state == OPEN and now < open_until:
+            return False
+        state, open_until = self._allow_script(keys=[self._key], args=[self.open_timeout, self.max_probes, repr(now)])
+        self._set_state(HALF_OPEN if state == "probe" else state, open_until, now)
+        return state in (CLOSED, "probe")
+
+    def record(self, success):
+        if success and self._state[0] == CLOSED:
+            return
+        now = self._get_time()
+        state, open_until = self._record_script(keys=[self._key], args=[
+            1 if success else 0, self.failure_threshold, self.window, self.open_timeout, repr(now)])
+        self._set_state(state, open_until, now)
+
+    def is_open(self):
+        state, open_until, valid_until = self._state
+        return state == OPEN and self._get_time() < open_until
+
+    def is_half_open(self):
+        return self._state[0] == HALF_OPEN
+
+    def _set_state(self, state, open_until, now):
+        self._state = (state, float(open_until), now + self._sync_interval)
@@ -0,0 +1,60 @@
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Default (connect, read) timeouts in seconds for requests to the mail services
+DEFAULT_TIMEOUT = (3.05, 10)
+
+
+# HTTP session keeping a pool of keep-alive connections that is shared by all
+# threads using a mail service, so DNS, TCP and TLS handshakes are only paid
+# when a new connection has to be opened.
+# At most pool_size idle connections are kept open per host. When more threads
+# send concurrently, additional connections are opened and closed after use
+# instead of blocking the sender.
+class PooledSession(object):
+
+    def __init__(self, pool_size=10, timeout=DEFAULT_TIMEOUT):
+        self._timeout = timeout
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+
+    # Same as requests.post, but using the pooled connections and the default
+    # timeouts unless others are given
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        return self._session.post(url, **kwargs)
+
+    # Return the number of connections opened and the number of requests that
+    # reused an already open connection
+    def get_connection_stats(self):
+        opened = 0
+        requests_made = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+        return {'new': opened, 'reused': max(0, requests_made - opened)}
+
+    def close(self):
+        self._session.close()
+
+
+# Return the number of seconds to wait given by the Retry-After header of the
+# response, either as seconds or as a date. None if there is no valid header
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
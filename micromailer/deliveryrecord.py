@@ -0,0 +1,76 @@
+import json
+import time
+
+# Version of the format produced by encode_delivery_record
+DELIVERY_RECORD_VERSION = 1
+
+# Delivery statuses of a record: all the recipients were accepted, some of
+# them were rejected or all of them were rejected by the mail service
+SENT = 0
+PARTIAL = 1
+REJECTED = 2
+
+delivery_statuses = ("sent", "partial", "rejected")
+
+# Longest response of a mail service kept in a record
+MAX_MESSAGE_LENGTH = 200
+
+
+# Encode the result of delivering an email, as returned by MailServiceBase.send,
+# in the compact format stored in the result backend. The record is a JSON
+# serializable list with the format version followed by the delivery status,
+# the name of the mail service, the message id given by the mail service, the
+# time of the delivery in whole seconds, the number of delivery attempts, the
+# indexes in email.to of the rejected recipients and the response of the mail
+# service. The response is only kept, truncated, when recipients were rejected
+def encode_delivery_record(email, result, attempts, timestamp=None):
+    return _encode([x[0] for x in email.to], result, attempts, int(timestamp if timestamp is not None else time.time()))
+
+
+# Encode a result stored before delivered emails were stored as records, the result
+# of MailServiceBase.send with the number of attempts in _attempts, as a record. The
+# time of the delivery was not stored. The order of the recipients is taken from the
+# response of the mail service when it lists them, like the response of Mandrill
+def encode_legacy_result(result):
+    recipients = sorted(x for x in result if not x.startswith('_'))
+    response = result.get('_response')
+    if isinstance(response, list) and all(isinstance(x, dict) and x.get('email') in result for x in response):
+        recipients = [x['email'] for x in response]
+    return _encode(recipients, result, result.get('_attempts', 1), None)
+
+
+def _encode(recipients, result, attempts, timestamp):
+    rejected = [index for index, recipient in enumerate(recipients) if result.get(recipient) is False]
+    message = None
+    if len(rejected) == 0:
+        status = SENT
+    else:
+        status = REJECTED if len(rejected) == len(recipients) else PARTIAL
+        message = _truncate(result.get('_response'))
+    return [DELIVERY_RECORD_VERSION, status, result.get('_service'), result.get('_id'), timestamp, attempts, rejected,
+            message]
+
+
+# Decode a record encoded with encode_delivery_record into a dict with the
+# fields of the record. Raises ValueError if the record is not in a known format
+def decode_delivery_record(record):
+    if not isinstance(record, list) or len(record) == 0 or record[0] != DELIVERY_RECORD_VERSION:
+        raise ValueError("Unsupported delivery record format")
+    version, status, service, provider_id, timestamp, attempts, rejected, message = record
+    return {
+        'status': delivery_statuses[status],
+        'service': service,
+        'provider_id': provider_id,
+        'timestamp': timestamp,
+        'attempts': attempts,
+        'rejected': rejected,
+        'message': message
+    }
+
+
+def _truncate(response):
+    if response is None:
+        return None
+    if not isinstance(response, basestring):
+        response = json.dumps(response)
+    return response[:MAX_MESSAGE_LENGTH]
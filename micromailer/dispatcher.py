@@ -1,27 +1,299 @@
-from threading import RLock
+from threading import RLock, Lock
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import logging
+import time
 
-from mailservice import MailServiceBase
+from mailservice import MailServiceBase, MailServiceException, ServerException, NetworkException, TooManyRequests, \
+    UnauthorizedRequest, RateLimited, CircuitOpen
+from policies import HighestScorePolicy
+import metrics
+from tracing import tracer
 
+# Exceptions after which an email is tried with the next service in failover
+# mode. The other exceptions are caused by the email itself
+FAILOVER_EXCEPTIONS = (ServerException, NetworkException, TooManyRequests, UnauthorizedRequest, RateLimited, CircuitOpen)
 
+
+# Some of the chunks of recipients of an email were delivered and others failed.
+# result is the merged result of the delivered chunks, failed the (email, name)
+# of the recipients that were not delivered and error the exception raised for
+# the last chunk that failed
+class PartialDelivery(MailServiceException):
+
+    def __init__(self, result, failed, error):
+        super(PartialDelivery, self).__init__("Delivery to %d recipients failed: %s" % (len(failed), error))
+        self.result = result
+        self.failed = failed
+        self.error = error
+
+
+# Split the recipients of the email in copies of the email to at most size
+# recipients each. Returns a single copy if size is None
+def split_recipients(email, recipients, size=None):
+    if size is None:
+        return [email.with_recipients(recipients)]
+    return [email.with_recipients(recipients[i:i + size]) for i in range(0, len(recipients), size)]
+
+
+# Merge the results of sending chunks of the recipients of an email into the
+# result of sending the email. The service and message id are those of the
+# first chunk and the response is the list of the responses to the chunks
+def merge_results(results):
+    merged = {}
+    for result in results:
+        merged.update(result)
+    merged['_service'] = results[0].get('_service')
+    merged['_id'] = results[0].get('_id')
+    merged['_response'] = [x.get('_response') for x in results]
+    return merged
+
+
+select_latency = metrics.registry.histogram("micromailer_dispatcher_select_seconds", "Time to select a mail service",
+                                            buckets=(1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 1e-3, 1e-2))
+
+
+# The services are selected from an immutable snapshot of their scores, so
+# selecting a service does not take any locks. The snapshot is replaced when
+# the health of a service changes and every score_refresh_interval seconds to
+# follow the scores that change with time. The service is chosen from the
+# snapshot by the dispatch policy (see micromailer.policies), which defaults
+# to the service with the highest score.
+# In failover mode, an email that fails with the selected service is tried
+# with the other services in order of their score before the error is raised.
+# With an attempt_timeout, an attempt that does not complete within that many
+# seconds counts as failed with NetworkException. The attempt is not cancelled
+# though, so the email may still be delivered by it. The attempts with a
+# timeout are run by up to max_concurrency threads.
+# An email to more recipients than the service accepts in a request (see
+# MailServiceBase.max_recipients_per_request) is sent in chunks of recipients
+# (see _send_chunks).
 class MailDispatcher():
 
-    def __init__(self):
+    def __init__(self, score_refresh_interval=1, policy=None, failover=False, attempt_timeout=None, max_concurrency=32):
         self._services = []
+        self._scores = []
         self._lock = RLock()
+        self._score_refresh_interval = score_refresh_interval
+        self._policy = policy or HighestScorePolicy()
+        self._failover = failover
+        self._attempt_timeout = attempt_timeout
+        self._max_concurrency = max_concurrency
+        self._executors = {}
+        self._in_flight = {}
+        self._in_flight_lock = Lock()
+        # Tuple of the time the snapshot expires and a tuple of
+        # (service, score) ordered by descending score
+        self._snapshot = (0, ())
 
     def add_service(self, service):
         with self._lock:
             if not isinstance(service, MailServiceBase):
                 raise Exception("Unable to add service of type %s" % type(service))
             self._services.append(service)
+            self._scores.append(service.get_service_score())
+            service.add_score_listener(self._on_score_changed)
+            self._refresh_scores()
 
     def send(self, email):
-        service_to_use = None
+        services = self._select_services()
+        for index, (service_to_use, score) in enumerate(services):
+            if self._exceeds_limit(email, service_to_use):
+                return self._send_chunks(email, services[index:])
+            logging.debug("Using %s with score=%.2f for delivering email", service_to_use.get_name(), score)
+            try:
+                return self._attempt(service_to_use, service_to_use.send, email)
+            except FAILOVER_EXCEPTIONS as e:
+                if index == len(services) - 1:
+                    raise
+                logging.warning("Delivery with %s failed (%r). Failing over to the next service", service_to_use.get_name(), e)
+
+    # Send the email without blocking the caller. Returns a
+    # concurrent.futures.Future holding the result. The number of emails in
+    # flight is limited per service by its max_concurrency. An email to more
+    # recipients than the selected service accepts in a request is sent by
+    # send, in chunks, on one of up to max_concurrency threads of the dispatcher
+    def send_async(self, email):
+        service_to_use, score = self._select_service()
+        if self._exceeds_limit(email, service_to_use):
+            return self._get_executor("send").submit(tracer.wrap(self.send), email)
+        logging.debug("Using %s with score=%.2f for delivering email", service_to_use.get_name(), score)
+        self._update_in_flight(service_to_use, 1)
+        future = service_to_use.send_async(email)
+        future.add_done_callback(lambda x: self._update_in_flight(service_to_use, -1))
+        return future
+
+    # Send a list of emails with as few requests to the service as possible.
+    # Returns a list with the result for each email in the same order as the
+    # emails. The result of an email that could not be delivered is the
+    # MailServiceException raised for it
+    # In failover mode, the emails that failed are sent again with the next service
+    # Emails to more recipients than a service accepts in a request are sent one
+    # at a time in chunks of recipients from that service on
+    def send_many(self, emails):
+        results = [None] * len(emails)
+        services = self._select_services() if len(emails) > 0 else []
+        pending = range(len(emails))
+        for position, (service_to_use, score) in enumerate(services):
+            chunked = set(x for x in pending if self._exceeds_limit(emails[x], service_to_use))
+            for index in sorted(chunked):
+                try:
+                    results[index] = self._send_chunks(emails[index], services[position:])
+                except MailServiceException as e:
+                    results[index] = e
+            pending = [x for x in pending if x not in chunked]
+            if len(pending) == 0:
+                break
+
+            logging.debug("Using %s with score=%.2f for delivering %d emails", service_to_use.get_name(), score, len(pending))
+            try:
+                batch_results = self._attempt(service_to_use, service_to_use.send_batch, [emails[x] for x in pending])
+            except FAILOVER_EXCEPTIONS as e:
+                batch_results = [e] * len(pending)
+
+            failed = []
+            for index, result in zip(pending, batch_results):
+                results[index] = result
+                if isinstance(result, FAILOVER_EXCEPTIONS):
+                    failed.append(index)
+            if len(failed) == 0:
+                break
+            logging.warning("Delivery of %d emails with %s failed. Failing over to the next service", len(failed), service_to_use.get_name())
+            pending = failed
+        return results
+
+    def _exceeds_limit(self, email, service):
+        return service.max_recipients_per_request is not None and len(email.to) > service.max_recipients_per_request
+
+    # Send the recipients of the email in chunks of as many recipients as the
+    # service accepts in a request. The chunks are sent concurrently by the
+    # service (see MailServiceBase.send_batch) and in failover mode, only the
+    # chunks that failed are tried with the next service. Returns the merged
+    # result of the chunks. Raises the exception of the last failed chunk if
+    # no chunk was delivered and PartialDelivery if some were
+    def _send_chunks(self, email, services):
+        results = []
+        failed = []
+        error = None
+        pending = email.to
+        for index, (service_to_use, score) in enumerate(services):
+            chunks = split_recipients(email, pending, service_to_use.max_recipients_per_request)
+            logging.debug("Using %s with score=%.2f for delivering %d chunks of recipients", service_to_use.get_name(),
+                          score, len(chunks))
+            try:
+                chunk_results = self._attempt(service_to_use, service_to_use.send_batch, chunks)
+            except FAILOVER_EXCEPTIONS as e:
+                chunk_results = [e] * len(chunks)
+
+            pending = []
+            for chunk, result in zip(chunks, chunk_results):
+                if not isinstance(result, MailServiceException):
+                    results.append(result)
+                    continue
+                error = result
+                if isinstance(result, FAILOVER_EXCEPTIONS):
+                    pending.extend(chunk.to)
+                else:
+                    failed.extend(chunk.to)
+            if len(pending) == 0:
+                break
+            if index < len(services) - 1:
+                logging.warning("Delivery to %d recipients with %s failed. Failing over to the next service", len(pending),
+                                service_to_use.get_name())
+
+        failed.extend(pending)
+        if len(failed) == 0:
+            return merge_results(results)
+        if len(results) == 0:
+            raise error
+        raise PartialDelivery(merge_results(results), failed, error)
+
+    # Call function with the email(s) for the service, within the attempt
+    # timeout if there is one
+    def _attempt(self, service, function, argument):
+        self._update_in_flight(service, 1)
+        if self._attempt_timeout is None:
+            try:
+                return function(argument)
+            finally:
+                self._update_in_flight(service, -1)
+
+        future = self._get_executor().submit(tracer.wrap(function), argument)
+        future.add_done_callback(lambda x: self._update_in_flight(service, -1))
+        try:
+            return future.result(self._attempt_timeout)
+        except TimeoutError:
+            raise NetworkException("No response from %s within %s sec" % (service.get_name(), self._attempt_timeout))
+
+    # The attempts with a timeout and the emails sent by send_async have their
+    # own threads, so the attempts of the emails sent by send_async can not wait
+    # for a thread held by those emails
+    def _get_executor(self, name="attempt"):
         with self._lock:
-            assert len(self._services) > 0
-            service_to_use = max(self._services, key=lambda x: x.get_service_score())
+            if name not in self._executors:
+                self._executors[name] = ThreadPoolExecutor(max_workers=self._max_concurrency)
+            return self._executors[name]
+
+    # Number of requests the dispatcher has in flight with the service
+    def get_in_flight(self, service):
+        return self._in_flight.get(service, 0)
+
+    def _update_in_flight(self, service, change):
+        with self._in_flight_lock:
+            self._in_flight[service] = self._in_flight.get(service, 0) + change
+
+    # Select a service with the dispatch policy. Services that reached their
+    # rate limit or have an open circuit breaker are only used if all the
+    # services are unavailable. Returns the service and its score
+    def _select_service(self):
+        start = time.time()
+        expires, ranked = self._snapshot
+        if self._get_time() >= expires:
+            ranked = self._refresh_scores(blocking=False)
+        assert len(ranked) > 0
+        available = tuple(x for x in ranked if x[0].is_available()) or ranked
+        selected = self._policy.select(available, self.get_in_flight)
+        select_latency.observe(time.time() - start)
+        return selected
+
+    # Return the (service, score) of the services ordered by descending score,
+    # as last computed
+    def get_scores(self):
+        return self._snapshot[1]
+
+    # Return the (service, score) to send an email with. In failover mode the
+    # selected service is followed by the others, the available ones first,
+    # each ordered by score
+    def _select_services(self):
+        selected = self._select_service()
+        if not self._failover:
+            return [selected]
+        others = [x for x in self._snapshot[1] if x[0] is not selected[0]]
+        return [selected] + sorted(others, key=lambda x: not x[0].is_available())
+
+    # Compute the scores of all the services and replace the snapshot. Without
+    # blocking, the current snapshot is kept if another thread is refreshing it.
+    # Returns the ranked services
+    def _refresh_scores(self, blocking=True):
+        if not self._lock.acquire(blocking):
+            return self._snapshot[1]
+        try:
+            self._scores = [x.get_service_score() for x in self._services]
+            return self._publish_scores(self._get_time() + self._score_refresh_interval)
+        finally:
+            self._lock.release()
+
+    # Only the score of the service with the changed health is computed again
+    def _on_score_changed(self, service):
+        with self._lock:
+            self._scores[self._services.index(service)] = service.get_service_score()
+            self._publish_scores(self._snapshot[0])
+
+    # Must be called with the lock held. The sort is stable, so services with
+    # the same score keep the order they were added in
+    def _publish_scores(self, expires):
+        ranked = tuple(sorted(zip(self._services, self._scores), key=lambda x: -x[1]))
+        self._snapshot = (expires, ranked)
+        return ranked
 
-        logging.debug("Using %s with score=%.2f for delivering email" %
-                      (service_to_use.get_name(), service_to_use.get_service_score()))
-        return service_to_use.send(email)
+    def _get_time(self):
+        return time.time()
@@ -0,0 +1,139 @@
+import time
+import uuid
+from threading import Lock
+
+from mailservice import MailServiceException
+
+# Value of a key once the email has been delivered
+DELIVERED = "delivered"
+
+
+# The email is being delivered by another worker. retry_after is the number of
+# seconds until the claim of the other worker expires
+class DeliveryInProgress(MailServiceException):
+
+    def __init__(self, message="", retry_after=None):
+        super(DeliveryInProgress, self).__init__(message)
+        self.retry_after = retry_after
+
+
+# Base class for the records of the emails that were delivered, used to skip
+# emails delivered again when a task is redelivered by the broker. Before an
+# email is sent, its idempotency key is claimed with an atomic check-and-set
+# that fails if the email was already delivered or is being delivered by
+# another worker. The claim is completed once the email is delivered and
+# released if the delivery failed, so it can be retried. Claims expire after
+# claim_ttl seconds, so the email is delivered again if a worker dies while
+# sending it, and delivered emails are remembered for ttl seconds. The memory
+# used is thereby bounded by the number of emails delivered within ttl seconds
+class IdempotencyStoreBase(object):
+
+    def __init__(self, ttl=10800, claim_ttl=120):
+        self.ttl = ttl
+        self.claim_ttl = claim_ttl
+
+    # Claim the delivery of the email with the given key. Returns a token to
+    # complete or release the claim with, or None if the email was already
+    # delivered. Raises DeliveryInProgress if another worker holds the claim
+    def claim(self, key):
+        token = uuid.uuid4().hex
+        value, expires_in = self._claim(key, token)
+        if value is None:
+            return token
+        if value == DELIVERED:
+            return None
+        raise DeliveryInProgress("Email %s is being delivered by another worker" % key, expires_in)
+
+    # Record that the email with the given key was delivered
+    def complete(self, key):
+        raise NotImplementedError
+
+    # Give up the claim on the email so it can be delivered again
+    def release(self, key, token):
+        raise NotImplementedError
+
+    # Set the key to the token unless it is set. Returns None if the key was
+    # set, or the existing value and the number of seconds until it expires
+    def _claim(self, key, token):
+        raise NotImplementedError
+
+    def _get_time(self):
+        return time.time()
+
+
+# Idempotency store kept in the process memory. Only deduplicates the emails
+# delivered by the same process. Expired keys are removed at most every
+# claim_ttl seconds
+class IdempotencyStore(IdempotencyStoreBase):
+
+    def __init__(self, ttl=10800, claim_ttl=120):
+        super(IdempotencyStore, self).__init__(ttl, claim_ttl)
+        self._lock = Lock()
+        self._keys = {}
+        self._next_purge = 0
+
+    def complete(self, key):
+        now = self._get_time()
+        with self._lock:
+            self._keys[key] = (DELIVERED, now + self.ttl)
+
+    def release(self, key, token):
+        with self._lock:
+            if self._keys.get(key, (None,))[0] == token:
+                del self._keys[key]
+
+    def _claim(self, key, token):
+        now = self._get_time()
+        with self._lock:
+            if now >= self._next_purge:
+                self._keys = dict((k, v) for k, v in self._keys.iteritems() if v[1] > now)
+                self._next_purge = now + self.claim_ttl
+            value, expires = self._keys.get(key, (None, 0))
+            if value is not None and expires > now:
+                return value, expires - now
+            self._keys[key] = (token, now + self.claim_ttl)
+            return None, 0
+
+
+# Set the key to the token with the claim expiry unless it is set. Returns the
+# existing value and its remaining time to live in milliseconds
+_claim_script = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    return {value, redis.call('PTTL', KEYS[1])}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return false
+"""
+
+# Delete the key if it still holds the claim of the token
+_release_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+"""
+
+
+# Idempotency store kept in redis, so an email redelivered to any worker
+# sharing the redis server is skipped. Every key expires on its own, so the
+# memory used is about 150 bytes per email delivered within ttl seconds
+class RedisIdempotencyStore(IdempotencyStoreBase):
+
+    def __init__(self, client, prefix="micromailer.delivery.", ttl=10800, claim_ttl=120):
+        super(RedisIdempotencyStore, self).__init__(ttl, claim_ttl)
+        self._client = client
+        self._prefix = prefix
+        self._claim_script = client.register_script(_claim_script)
+        self._release_script = client.register_script(_release_script)
+
+    def complete(self, key):
+        self._client.set(self._prefix + key, DELIVERED, ex=int(self.ttl))
+
+    def release(self, key, token):
+        self._release_script(keys=[self._prefix + key], args=[token])
+
+    def _claim(self, key, token):
+        result = self._claim_script(keys=[self._prefix + key], args=[token, int(self.claim_ttl * 1000)])
+        if result is None:
+            return None, 0
+        return result[0], max(0, int(result[1])) / 1000.0
@@ -0,0 +1,61 @@
+import math
+from threading import Lock
+
+
+# Streaming estimate of the latency of a service. Keeps an exponentially
+# weighted moving average and a histogram with logarithmic buckets, growing
+# by growth from min_latency to max_latency seconds, to estimate quantiles.
+# Every sample weighs 1/decay times more than the one before, so the
+# histogram follows the recent latency. Uses constant memory and constant
+# time per sample.
+class LatencyEstimate(object):
+
+    def __init__(self, alpha=0.1, decay=0.99, min_latency=0.001, max_latency=120, growth=1.2):
+        self._alpha = alpha
+        self._decay = decay
+        self._min_latency = min_latency
+        self._growth = growth
+        self._buckets = [0.0] * (int(math.ceil(math.log(max_latency / min_latency, growth))) + 1)
+        self._weight = 1.0
+        self._total = 0.0
+        self._average = None
+        self._lock = Lock()
+
+    def add(self, latency):
+        index = self._get_bucket(latency)
+        with self._lock:
+            if self._average is None:
+                self._average = latency
+            else:
+                self._average = self._average * (1 - self._alpha) + latency * self._alpha
+            self._buckets[index] += self._weight
+            self._total += self._weight
+            self._weight /= self._decay
+            # Scale the weights down before they overflow
+            if self._weight > 1e100:
+                self._buckets = [x / self._weight for x in self._buckets]
+                self._total /= self._weight
+                self._weight = 1.0
+
+    # The moving average of the latency or None if there are no samples
+    def get_average(self):
+        return self._average
+
+    # Estimate the latency below which the fraction q of the samples are.
+    # The estimate is the middle of the bucket holding the quantile, so it is
+    # within the bucket growth of the actual value. None if there are no samples
+    def get_quantile(self, q):
+        with self._lock:
+            if self._total == 0:
+                return None
+            remaining = q * self._total
+            for index, weight in enumerate(self._buckets):
+                remaining -= weight
+                if remaining <= 0:
+                    break
+        return self._min_latency * self._growth ** (index + 0.5)
+
+    def _get_bucket(self, latency):
+        if latency <= self._min_latency:
+            return 0
+        return min(len(self._buckets) - 1, int(math.log(latency / self._min_latency, self._growth)))
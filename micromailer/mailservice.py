@@ -1,8 +1,17 @@
 import logging
 import time
-from threading import RLock
+from threading import RLock, Lock
+from concurrent.futures import ThreadPoolExecutor
 
-from models import Email
+from models import Email, delivery_content_types
+from latency import LatencyEstimate
+import metrics
+from tracing import tracer
+
+request_count = metrics.registry.counter("micromailer_service_requests_total",
+                                         "Requests to the mail services by outcome", ("service", "outcome"))
+request_latency = metrics.registry.histogram("micromailer_service_request_seconds",
+                                             "Latency of the requests to the mail services", ("service",))
 
 
 class MailServiceException(Exception):
@@ -24,9 +33,13 @@ class ServerException(MailServiceException):
     pass
 
 
-# Request limit reached on server
+# Request limit reached on server. retry_after is the number of seconds the
+# service asked to wait before the next request, if it did
 class TooManyRequests(MailServiceException):
-    pass
+
+    def __init__(self, message="", retry_after=None):
+        super(TooManyRequests, self).__init__(message)
+        self.retry_after = retry_after
 
 
 # Network error like DNS, unable to connect etc.
@@ -34,22 +47,232 @@ class NetworkException(MailServiceException):
     pass
 
 
+# The rate limit of the service was reached before the request was made
+class RateLimited(MailServiceException):
+    pass
+
+
+# The circuit breaker of the service is open, so no request was made
+class CircuitOpen(MailServiceException):
+    pass
+
+
+# Exceptions counted as failures of the service by the circuit breaker
+CIRCUIT_FAILURES = (ServerException, NetworkException, TooManyRequests, UnauthorizedRequest)
+
+
+# Group emails that can be delivered in a single request to a service because
+# they only differ by their recipients (same sender, subject and content) or
+# are rendered from the same template. Returns a list of groups, each a list of
+# indexes into emails. A group is split when it would exceed max_recipients
+# recipients in total or contain the same recipient twice.
+def group_compatible_emails(emails, max_recipients=None):
+    groups = []
+    open_groups = {}
+    for index, email in enumerate(emails):
+        if email.template is not None:
+            key = ('template', email.sender, email.sender_name, email.template.template_id)
+        else:
+            key = ('content', email.sender, email.sender_name, email.subject, email.content, email.content_type)
+        recipients = set(x[0] for x in email.to)
+        group = open_groups.get(key)
+        if group is None or not group['recipients'].isdisjoint(recipients) or \
+                (max_recipients is not None and group['count'] + len(email.to) > max_recipients):
+            group = {'indexes': [], 'recipients': set(), 'count': 0}
+            open_groups[key] = group
+            groups.append(group['indexes'])
+        group['indexes'].append(index)
+        group['recipients'].update(recipients)
+        group['count'] += len(email.to)
+    return groups
+
+
 # Base class for mail service implementations.
 class MailServiceBase(object):
 
-    def __init__(self):
-        pass
+    # Maximum number of recipients the service accepts in a single request.
+    # None if there is no limit
+    max_recipients_per_request = None
+
+    # max_concurrency is the maximum number of emails sent at the same time by
+    # send_async and send_batch. Further emails wait for a free sender
+    def __init__(self, max_concurrency=10):
+        self._max_concurrency = max_concurrency
+        self._executor = None
+        self._executor_lock = Lock()
+        self._rate_limiter = None
+        self._rate_limit_wait = 0
+        self._circuit_breaker = None
+        self._score_listeners = []
+
+    # Call listener with the service whenever its score changes by other means
+    # than the passing of time
+    def add_score_listener(self, listener):
+        self._score_listeners.append(listener)
+
+    def _notify_score_changed(self):
+        for listener in self._score_listeners:
+            listener(self)
+
+    # Limit the rate of emails sent with the service by the token bucket
+    # rate_limiter (see micromailer.ratelimit). An email waits at most
+    # max_wait seconds for a token before RateLimited is raised
+    def set_rate_limiter(self, rate_limiter, max_wait=1):
+        self._rate_limiter = rate_limiter
+        self._rate_limit_wait = max_wait
+
+    # Fail fast with CircuitOpen without calling the service while the
+    # circuit_breaker (see micromailer.circuitbreaker) is open
+    def set_circuit_breaker(self, circuit_breaker):
+        self._circuit_breaker = circuit_breaker
+
+    # True if the rate limit of the service is reached, so emails should be
+    # sent with another service if possible
+    def is_saturated(self):
+        return self._rate_limiter is not None and self._rate_limiter.is_saturated()
+
+    # True unless the service reached its rate limit or its circuit breaker
+    # is open
+    def is_available(self):
+        return not self.is_saturated() and not (self._circuit_breaker is not None and self._circuit_breaker.is_open())
 
     # Send the email using the service. Raises an exception in case of error
     def send(self, email):
         assert isinstance(email, Email)
         email.is_valid()
-        return self._do_send(email)
+        self._check_deliverable(email)
+        self._check_circuit()
+        self._acquire_rate_limit(1)
+        return self._request(self._do_send, email)
+
+    # Send the email without blocking the caller. Returns a
+    # concurrent.futures.Future holding the result of send()
+    def send_async(self, email):
+        return self._get_executor().submit(tracer.wrap(self.send), email)
+
+    # Send a list of emails using the service. Returns a list with the result
+    # for each email in the same order as the emails. The result for an email
+    # that could not be delivered is the MailServiceException raised for it.
+    def send_batch(self, emails):
+        results = [None] * len(emails)
+        for index, email in enumerate(emails):
+            assert isinstance(email, Email)
+            email.is_valid()
+            try:
+                self._check_deliverable(email)
+            except BadRequest as e:
+                results[index] = e
+        pending = [x for x in range(len(emails)) if results[x] is None]
+        if len(pending) == 0:
+            return results
+        try:
+            self._check_circuit()
+            pending = self._limit_to_probe(emails, pending, results)
+            self._acquire_rate_limit(len(pending))
+        except (CircuitOpen, RateLimited) as e:
+            batch_results = [e] * len(pending)
+        else:
+            batch_results = self._do_send_batch([emails[x] for x in pending])
+        for index, result in zip(pending, batch_results):
+            results[index] = result
+        return results
+
+    # While the circuit breaker is half-open, only the emails of the first request of the
+    # batch are sent, as the probe, and the others fail with CircuitOpen. Returns the
+    # indexes of the pending emails to send
+    def _limit_to_probe(self, emails, pending, results):
+        if self._circuit_breaker is None or not self._circuit_breaker.is_half_open():
+            return pending
+        probe = [pending[x] for x in self._group_emails([emails[x] for x in pending])[0]]
+        error = CircuitOpen("Circuit breaker of %s is half-open" % self.get_name())
+        for index in set(pending) - set(probe):
+            results[index] = error
+        return probe
+
+    # Raise BadRequest for an email with content that has to be rendered before
+    # it is delivered, like text/markdown content
+    def _check_deliverable(self, email):
+        if email.content_type not in delivery_content_types:
+            raise BadRequest("Content-type %s has to be rendered before delivery" % email.content_type)
+
+    def _check_circuit(self):
+        if self._circuit_breaker is not None and not self._circuit_breaker.allow():
+            raise CircuitOpen("Circuit breaker of %s is open" % self.get_name())
+
+    # Make a request to the service by calling function with the item. The
+    # outcome is recorded by the circuit breaker, and the outcome and latency
+    # by _record_request and as a span of the active trace
+    def _request(self, function, item):
+        start = self._get_clock()
+        outcome = "success"
+        try:
+            result = function(item)
+        except Exception as e:
+            outcome = type(e).__name__
+            if self._circuit_breaker is not None and isinstance(e, CIRCUIT_FAILURES):
+                self._circuit_breaker.record(False)
+            raise
+        finally:
+            latency = self._get_clock() - start
+            self._record_request(latency, outcome)
+            tracer.record("service.request", start, latency, service=self.get_name(), outcome=outcome)
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.record(True)
+        return result
+
+    # Called after every request to the service with its latency in seconds
+    # and its outcome: success or the name of the exception raised
+    def _record_request(self, latency, outcome):
+        name = self.get_name()
+        request_count.inc((name, outcome))
+        request_latency.observe(latency, (name,))
+
+    # Take a token from the rate limiter for each of the emails. Raises
+    # RateLimited if they are not available in time
+    def _acquire_rate_limit(self, count):
+        if self._rate_limiter is not None and count > 0:
+            if not self._rate_limiter.acquire(count, self._rate_limit_wait):
+                raise RateLimited("Rate limit of %s reached" % self.get_name())
 
     # Actually send the email and raise an exception on error
     def _do_send(self, email):
         raise NotImplementedError
 
+    # Actually send a list of emails. Services that support bulk requests
+    # should override this to deliver compatible emails in as few requests as
+    # possible. The default is to send the emails one at a time
+    def _do_send_batch(self, emails):
+        return self._map_concurrently(self._do_send, emails)
+
+    # Return the groups of indexes into emails that _do_send_batch sends in a
+    # single request each
+    def _group_emails(self, emails):
+        return [[x] for x in range(len(emails))]
+
+    # Call function for each of the items using up to max_concurrency threads
+    # and return the results in the same order as the items. A
+    # MailServiceException raised for an item is returned as its result
+    def _map_concurrently(self, function, items):
+        if len(items) <= 1:
+            return [self._call(function, item) for item in items]
+        call = tracer.wrap(self._call)
+        futures = [self._get_executor().submit(call, function, item) for item in items]
+        return [future.result() for future in futures]
+
+    def _call(self, function, item):
+        try:
+            return self._request(function, item)
+        except MailServiceException as e:
+            return e
+
+    # The threads are only started on first use so services can be created
+    # before Celery forks the worker processes
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency)
+            return self._executor
+
     # Return the 'quality' of the service calculated in terms of various
     # factors like cost, response time, average queue time, availability and
     # so on.
@@ -57,18 +280,38 @@ class MailServiceBase(object):
     def get_service_score(self):
         return 50
 
+    # Return a dict with the values the service score is calculated from
+    def get_score_inputs(self):
+        return {'score': self.get_service_score()}
+
     def get_name(self):
         return "Unknown"
 
+    # Clock used to measure the latency of requests
+    def _get_clock(self):
+        return time.time()
+
 
 # Simple service base that calculates the service score based on a moving
 # average of the service health where the health is defined as 1 if email
 # was sent successfully and 0 if not. The time since last error is used as
-# a linear weight between base score and service health score
+# a linear weight between base score and service health score.
+# The score is further lowered for a service that responds slower than the
+# latency target, so a service that is up but slow gets less traffic
 class BackoffOnFailureMailServiceBase(MailServiceBase):
 
-    def __init__(self, base_score=50):
-        super(BackoffOnFailureMailServiceBase, self).__init__()
+    # Seconds the moving average of the latency of a request can be before the
+    # score is lowered. The 95th percentile can be twice the target
+    latency_target = 1.0
+
+    # Weight of the previous health when a request succeeds or fails, and the
+    # seconds after the last failure until the score is back to the base
+    # score. See tests/score_sweep_simulate.py for tuning them
+    health_decay = 0.9
+    error_window = 300.0
+
+    def __init__(self, base_score=50, max_concurrency=10):
+        super(BackoffOnFailureMailServiceBase, self).__init__(max_concurrency)
         self._base_score = base_score
         self._lock = RLock()
         self.reset_score()
@@ -78,12 +321,13 @@ class BackoffOnFailureMailServiceBase(MailServiceBase):
         with self._lock:
             self._service_health = 1
             self._last_error = 0
+            self._latency = LatencyEstimate()
+            self._last_latency = 0
+        self._notify_score_changed()
 
     def send(self, email):
-        assert isinstance(email, Email)
-        email.is_valid()
         try:
-            result = self._do_send(email)
+            result = super(BackoffOnFailureMailServiceBase, self).send(email)
             self._update_service_health(True)
             return result
         except (ServerException, UnauthorizedRequest, TooManyRequests):
@@ -92,19 +336,58 @@ class BackoffOnFailureMailServiceBase(MailServiceBase):
                 "Server exception. Decreasing service score to %s" % self.get_service_score())
             raise
 
+    def send_batch(self, emails):
+        results = super(BackoffOnFailureMailServiceBase, self).send_batch(emails)
+
+        # A request to the service may fail for many emails at once. Count each
+        # failed request once and all the successful ones as one success
+        failures = {}
+        for result in results:
+            if isinstance(result, (ServerException, UnauthorizedRequest, TooManyRequests)):
+                failures[id(result)] = result
+        if any(not isinstance(result, MailServiceException) for result in results):
+            self._update_service_health(True)
+        for failure in failures.values():
+            self._update_service_health(False)
+            self._logger.error(
+                "Server exception. Decreasing service score to %s" % self.get_service_score())
+        return results
+
+    # Listeners are only notified if the health changed. The health is rounded
+    # up to 1 when it gets close, so successes of a healthy service do not
+    # cause any work
     def _update_service_health(self, success):
         with self._lock:
             if success:
-                self._service_health = self._service_health * 0.9 + 0.1
+                if self._service_health == 1:
+                    return
+                self._service_health = self._service_health * self.health_decay + (1 - self.health_decay)
+                if self._service_health > 0.999:
+                    self._service_health = 1
             else:
-                self._service_health = self._service_health * 0.9
+                self._service_health = self._service_health * self.health_decay
                 self._last_error = self._get_time()
+        self._notify_score_changed()
+
+    # The latency of every request to the service is added to the estimate
+    def _record_request(self, latency, outcome):
+        super(BackoffOnFailureMailServiceBase, self)._record_request(latency, outcome)
+        self._add_latency(latency)
+
+    # The latency changes with every request, so listeners are not notified.
+    # The dispatcher picks the change up when it refreshes the scores
+    def _add_latency(self, latency):
+        self._latency.add(latency)
+        self._last_latency = self._get_time()
 
     def get_service_score(self):
+        return self.get_score_inputs()['score']
+
+    def get_score_inputs(self):
         with self._lock:
             time_since_last_error = self._get_time() - self._last_error
 
-            # Linear weight over 5 min.
+            # Linear weight over the error window, 5 min by default.
             # Right after a failure, the service health score is weighted 100%, at
             # 150 sec it is 50%/50% for the base score and health and after 300 sec
             # the base score is used 100%
@@ -113,8 +396,30 @@ class BackoffOnFailureMailServiceBase(MailServiceBase):
             # prefered. When the service recovers, the score will increase as no
             # new errors are observed and the service health will go back up to
             # normal
-            time_weight = min(1, time_since_last_error / 300)
-            return min(100, max(0, self._base_score * (1 * time_weight + self._service_health * (1 - time_weight))))
+            time_weight = min(1, time_since_last_error / self.error_window)
+            health_score = self._base_score * (1 * time_weight + self._service_health * (1 - time_weight))
+
+            # The score is multiplied by the latency target relative to the
+            # average latency or half the 95th percentile, whichever is
+            # slowest. The latency factor goes linearly back to 1 over 5 min
+            # without requests, so a slow service is tried again
+            average = self._latency.get_average()
+            p95 = self._latency.get_quantile(0.95)
+            latency_factor = 1
+            if average is not None:
+                latency_factor = min(1, self.latency_target / max(average, p95 / 2, 1e-6))
+                latency_weight = min(1, (self._get_time() - self._last_latency) / 300)
+                latency_factor = latency_factor + (1 - latency_factor) * latency_weight
+
+            return {
+                'score': min(100, max(0, health_score * latency_factor)),
+                'base_score': self._base_score,
+                'health': self._service_health,
+                'time_since_last_error': time_since_last_error,
+                'latency_average': average,
+                'latency_p95': p95,
+                'latency_factor': latency_factor
+            }
 
     def _get_time(self):
         return time.time()
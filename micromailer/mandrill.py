@@ -2,34 +2,99 @@ import json
 import requests
 import logging
 import mailservice
+from connectionpool import PooledSession, DEFAULT_TIMEOUT, get_retry_after
 
 
 class MandrillMailService(mailservice.BackoffOnFailureMailServiceBase):
 
-    def __init__(self, api_key, service_score=50):
-        super(MandrillMailService, self).__init__(service_score)
+    # Mandrill has no fixed limit, but a synchronous send to many recipients
+    # is slow, so the recipients are split in requests of at most 1000
+    max_recipients_per_request = 1000
+
+    default_url = "https://mandrillapp.com/api/1.0/messages/send.json"
+
+    # At most max_concurrency requests are made at the same time by send_async
+    # and send_batch. It defaults to the number of pooled connections. url is
+    # the API endpoint, which can be changed to use a stand-in for the service
+    def __init__(self, api_key, service_score=50, pool_size=10, timeout=DEFAULT_TIMEOUT, max_concurrency=None, url=None):
+        super(MandrillMailService, self).__init__(service_score, max_concurrency or pool_size)
         self._api_key = api_key
-        self._url = "https://mandrillapp.com/api/1.0/messages/send.json"
+        self._url = url or self.default_url
+        self._session = PooledSession(pool_size, timeout)
 
     def _do_send(self, msg):
-        body = {
+        body = self._build_body(msg, msg.to)
+        return self._process_response(self._post(body))
+
+    def _group_emails(self, msgs):
+        return mailservice.group_compatible_emails(msgs, self.max_recipients_per_request)
+
+    # Emails with the same sender, subject and content are sent as a single
+    # message to all their recipients. Recipients are not preserved so every
+    # recipient only sees their own address
+    def _do_send_batch(self, msgs):
+        groups = self._group_emails(msgs)
+        responses = self._map_concurrently(lambda group: self._post(self._build_batch_body(msgs, group)), groups)
+
+        results = [None] * len(msgs)
+        for group, json_resp in zip(groups, responses):
+            for index in group:
+                if isinstance(json_resp, mailservice.MailServiceException):
+                    results[index] = json_resp
+                else:
+                    addresses = set(x[0] for x in msgs[index].to)
+                    results[index] = self._process_response([x for x in json_resp if x['email'] in addresses])
+        return results
+
+    # Emails rendered from the same template are sent as the template with
+    # the variables of each email as merge vars of its recipients
+    def _build_batch_body(self, msgs, group):
+        msg = msgs[group[0]]
+        body = self._build_body(msg, [x for index in group for x in msgs[index].to])
+        body["message"]["preserve_recipients"] = False
+        if msg.template is None:
+            return body
+
+        body["message"]["subject"], body["message"][self._content_key(msg)] = msg.template.format(
+            lambda name: "*|S_%s|*" % name, lambda name: "*|C_%s|*" % name)
+        body["message"]["merge"] = True
+        body["message"]["merge_language"] = "mailchimp"
+        body["message"]["merge_vars"] = []
+        for index in group:
+            merge_vars = []
+            for name in msg.template.variables:
+                value = msgs[index].template_vars[name]
+                merge_vars.append({"name": "S_%s" % name, "content": unicode(value)})
+                merge_vars.append({"name": "C_%s" % name, "content": msg.template.escape(value)})
+            body["message"]["merge_vars"].extend({"rcpt": x[0], "vars": merge_vars} for x in msgs[index].to)
+        return body
+
+    def _content_key(self, msg):
+        return "html" if msg.content_type == "text/html" else "text"
+
+    def _build_body(self, msg, recipients):
+        return {
             "key": self._api_key,
             "async": False,
             "message": {
-                "html" if msg.content_type == "text/html" else "text": msg.content,
+                self._content_key(msg): msg.content,
                 "subject": msg.subject,
                 "from_email": msg.sender,
-                "to": [{"email": x[0], "type": "to"} if x[1] is None else {"email": x[0], "name": x[1], "type": "to"} for x in msg.to]
+                "to": [{"email": x[0], "type": "to"} if x[1] is None else {"email": x[0], "name": x[1], "type": "to"} for x in recipients]
             }
         }
-        logging.debug("Sending email via sendgrid: %s" % json.dumps(body))
 
-        # Perform HTTP request
+    # Perform the HTTP request and return the decoded response. Raises an
+    # exception on error
+    def _post(self, body):
+        logging.debug("Sending email via mandrill: %s" % json.dumps(body))
         try:
-            response = requests.post(self._url, json=body)
+            response = self._session.post(self._url, json=body)
 
             if response.status_code >= 200 and response.status_code <= 299:
-                return self._process_response(response.json())
+                return response.json()
+            elif response.status_code == 429:
+                raise mailservice.TooManyRequests(response.text, get_retry_after(response))
             elif response.status_code >= 400 and response.status_code <= 499:
                 raise mailservice.BadRequest(response.text)
             elif response.status_code >= 500 and response.status_code <= 599:
@@ -41,11 +106,17 @@ class MandrillMailService(mailservice.BackoffOnFailureMailServiceBase):
         except requests.exceptions.RequestException as e:
             raise mailservice.ServerException(e.message)
 
+    # Mandrill returns the status and message id of each recipient. The id of
+    # the first recipient is used as the id of the message
     def _process_response(self, json_resp):
-        output = {'_response': json_resp, '_service': self.get_name()}
+        output = {'_response': json_resp, '_service': self.get_name(),
+                  '_id': json_resp[0].get('_id') if len(json_resp) > 0 else None}
         for entry in json_resp:
             output[entry['email']] = entry['status'] in ['sent', 'queued', 'scheduled']
         return output
 
+    def get_connection_stats(self):
+        return self._session.get_connection_stats()
+
     def get_name(self):
         return "mandrill"
@@ -0,0 +1,227 @@
+import BaseHTTPServer
+import socket
+from bisect import bisect_left
+import threading
+from threading import Lock
+
+# Content type of the Prometheus text format returned by MetricsRegistry.format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Default histogram buckets in seconds, suited for requests over the network
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, unicode(value).replace("\\", "\\\\").replace("\n", "\\n")
+                                           .replace('"', '\\"')) for name, value in pairs)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Base class of the metrics. The values of a metric are kept per thread, so
+# updating a metric is a dict update without any locks. The values of all the
+# threads are only added up, and formatted, when the metrics are collected.
+# The label values are given as a tuple in the order of the label names
+class Metric(object):
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = Lock()
+
+    # Return the values of the calling thread. The dict of a thread is only
+    # changed by that thread, and read by collect
+    def _get_shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._shards_lock:
+                self._shards.append(values)
+            return values
+
+    # Return the values of all the threads by label values
+    def _merge(self, add):
+        with self._shards_lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            for labels, value in shard.items():
+                merged[labels] = add(merged[labels], value) if labels in merged else value
+        return merged
+
+    # Return the lines of the metric in the Prometheus text format
+    def format(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.metric_type)]
+        lines.extend(self._format_samples())
+        return lines
+
+    def _format_samples(self):
+        raise NotImplementedError
+
+
+# A value that only goes up, like the number of requests made
+class Counter(Metric):
+
+    metric_type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        try:
+            values = self._local.values
+        except AttributeError:
+            values = self._get_shard()
+        values[labels] = values.get(labels, 0) + amount
+
+    # Return the count for the label values
+    def get(self, labels=()):
+        return self._merge(lambda x, y: x + y).get(labels, 0)
+
+    def _format_samples(self):
+        return ["%s%s %s" % (self.name, _format_labels(self.labels, labels), _format_value(value))
+                for labels, value in sorted(self._merge(lambda x, y: x + y).items())]
+
+
+# Counts the observed values, like latencies, in buckets with the given upper
+# bounds. Also keeps the sum of the values
+class Histogram(Metric):
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    # The counts of a thread are a list with the count of each bucket, the
+    # count above the last bucket and the sum of the values
+    def observe(self, value, labels=()):
+        try:
+            counts = self._local.values[labels]
+        except (AttributeError, KeyError):
+            counts = self._get_shard().setdefault(labels, [0] * (len(self.buckets) + 2))
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    # Return the number of values observed for the label values
+    def get_count(self, labels=()):
+        counts = self._merge(self._add).get(labels)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def _add(self, counts, other):
+        return [x + y for x, y in zip(counts, other)]
+
+    def _format_samples(self):
+        lines = []
+        for labels, counts in sorted(self._merge(self._add).items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.labels, labels, [("le", le)]), total))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(self.labels, labels), _format_value(counts[-1])))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(self.labels, labels), total))
+        return lines
+
+
+# A value that is read when the metrics are collected, like the current score
+# of a service. collect returns a list of (label values, value)
+class Gauge(Metric):
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, collect, labels=()):
+        super(Gauge, self).__init__(name, documentation, labels)
+        self._collect = collect
+
+    def _format_samples(self):
+        return ["%s%s %s" % (self.name, _format_labels(self.labels, labels), _format_value(value))
+                for labels, value in sorted(self._collect())]
+
+
+# The metrics of a process. Metrics are created once, usually when a module is
+# imported, and updated with their inc or observe methods
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = Lock()
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, collect, labels=()):
+        return self.register(Gauge(name, documentation, collect, labels))
+
+    # Add a metric. Raises ValueError if a metric with the same name exists
+    def register(self, metric):
+        with self._lock:
+            if any(x.name == metric.name for x in self._metrics):
+                raise ValueError("Metric '%s' is already registered" % metric.name)
+            self._metrics.append(metric)
+        return metric
+
+    # Return all the metrics in the Prometheus text format
+    def format(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.format())
+        return "\n".join(lines) + "\n"
+
+
+# The registry of the metrics of micromailer
+registry = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.format().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the metrics of the registry on http://<host>:<port>/metrics from a
+# daemon thread. Returns the server. Raises socket.error if the port is in use
+def start_http_server(port, host="", registry=registry):
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+# Serve the metrics of the calling process on the first free port of the ports
+# from first_port, for servers running a number of processes that each have
+# their own metrics. The metrics of all the processes are scraped from the
+# ports. Returns the server or None if all the ports are in use
+def start_process_http_server(first_port, ports, host="", registry=registry):
+    for port in range(first_port, first_port + ports):
+        try:
+            return start_http_server(port, host, registry)
+        except socket.error:
+            continue
+    return None
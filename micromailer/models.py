@@ -3,6 +3,21 @@ import re
 # Simple regex to check the email is valid (is not correct in 100% of the cases)
 email_pattern = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
 
+# The same check for a list of addresses joined by newlines, so a list is checked
+# in a single match
+recipients_pattern = re.compile(r"(?:[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+\n)*\Z")
+
+# text/markdown content is rendered to text/html by the worker before delivery
+allowed_content_types = ("text/plain", "text/html", "text/markdown")
+
+# Content types the mail services are given. Emails of the other allowed types
+# are only valid on the wire and are rejected by the mail services
+delivery_content_types = ("text/plain", "text/html")
+
+# Version of the wire format produced by encode_email. Version 1 did not
+# carry templates and is still accepted by decode_email
+EMAIL_WIRE_VERSION = 2
+
 
 class InvalidEmailArgument(Exception):
 
@@ -10,46 +25,150 @@ class InvalidEmailArgument(Exception):
         super(InvalidEmailArgument, self).__init__(message)
 
 
-class Email():
-
-    def __init__(self, to, sender, subject, content, content_type="text/plain", to_name=None, sender_name=None):
+# Check a list of recipient email addresses. Raises InvalidEmailArgument for
+# the first invalid address. The addresses are checked with a single match of
+# the joined list, and only checked one by one to find the invalid address or
+# if they can not be joined, like non-ASCII byte strings mixed with unicode
+def validate_recipients(addresses):
+    if len(addresses) > 1:
+        try:
+            joined = "\n".join(addresses) + "\n"
+            if joined.count("\n") == len(addresses) and recipients_pattern.match(joined):
+                return
+        except (TypeError, UnicodeError):
+            pass
+    for address in addresses:
+        if address is None or not isinstance(address, basestring) or not email_pattern.match(address):
+            raise InvalidEmailArgument("Recipient '%s' is invalid" % address)
+
+
+# An email to deliver. An email can be created from a compiled template (see
+# micromailer.templates) and its variables instead of a subject and content.
+# The subject and content are then set by render_template.
+# An email is validated once when created. Recipients added later are checked
+# as they are added and a rendered template when it is rendered, so is_valid
+# does not check the email again. Fields changed directly are not checked.
+class Email(object):
+    __slots__ = ('to', 'sender', 'sender_name', 'subject', 'content', 'content_type', 'template', 'template_vars',
+                 '_validated')
+
+    def __init__(self, to, sender, subject, content, content_type="text/plain", to_name=None, sender_name=None,
+                 template=None, template_vars=None):
         self.to = [(to, to_name)]
         self.sender = sender
         self.sender_name = sender_name
         self.subject = subject
         self.content = content
-        self.content_type = content_type
-
-        self._allowed_content_types = ["text/plain", "text/html"]
+        self.content_type = content_type if template is None else template.content_type
+        self.template = template
+        self.template_vars = template_vars
+        self._validated = False
 
         # Make sure the arguments are valid, if not raise an exception
         self.is_valid()
 
     def is_valid(self):
+        if self._validated:
+            return True
+
         # Validate to email
         if len(self.to) == 0:
             raise InvalidEmailArgument('No recipient supplied')
-
-        for email in self.to:
-            if email[0] is None or not email_pattern.match(email[0]):
-                raise InvalidEmailArgument("Recipient '%s' is invalid" % email[0])
+        validate_recipients([x[0] for x in self.to])
 
         # Validate sender email
         if self.sender is None or not email_pattern.match(self.sender):
             raise InvalidEmailArgument('Sender email is invalid')
 
+        # Validate template variables. The subject and content of a template
+        # email are only validated once rendered
+        if self.template is not None:
+            self.template.check_variables(self.template_vars)
+
+        if self.template is None or self.content is not None:
+            self._check_content()
+
+        if self.content_type not in allowed_content_types:
+            raise InvalidEmailArgument("Content-type has to be plain/text, text/html or text/markdown")
+
+        self._validated = True
+        return True
+
+    def _check_content(self):
         # Validate subject
-        if self.subject is None or type(self.subject) not in [str, unicode] or len(self.subject) == 0:
+        if not isinstance(self.subject, basestring) or len(self.subject) == 0:
             raise InvalidEmailArgument("Subject has to be a non-empty string")
 
         # Validate content
-        if self.content is None or type(self.content) not in [str, unicode] or len(self.content) == 0:
+        if not isinstance(self.content, basestring) or len(self.content) == 0:
             raise InvalidEmailArgument("Content has to be a non-empty string")
 
-        if self.content_type is None or type(self.content_type) is not str or self.content_type not in self._allowed_content_types:
-            raise InvalidEmailArgument("Content-type has to be plain/text or text/html")
-
-        return True
-
+    # Add a recipient. Raises InvalidEmailArgument if the address is invalid
     def add_recipient(self, email, name=None):
+        if email is None or not isinstance(email, basestring) or not email_pattern.match(email):
+            raise InvalidEmailArgument("Recipient '%s' is invalid" % email)
         self.to.append((email, name))
+
+    # Add a list of (email, name) recipients. Raises InvalidEmailArgument and
+    # adds none of them if an address is invalid
+    def add_recipients(self, recipients):
+        recipients = [(x[0], x[1]) for x in recipients]
+        validate_recipients([x[0] for x in recipients])
+        self.to.extend(recipients)
+
+    # Return a copy of the email to some of its recipients, a list of
+    # (email, name) taken from its to list, without validating it again
+    def with_recipients(self, recipients):
+        email = self.__class__.__new__(self.__class__)
+        for name in Email.__slots__:
+            setattr(email, name, getattr(self, name))
+        email.to = list(recipients)
+        return email
+
+    # Set the subject and content by substituting the variables into the
+    # template. Raises InvalidEmailArgument if the rendered email is invalid
+    def render_template(self):
+        self.subject, self.content = self.template.render(self.template_vars)
+        self.content_type = self.template.content_type
+        self._check_content()
+
+
+# Encode the email in the compact wire format used for the task queue. The
+# format is a JSON serializable list with the format version followed by the
+# fields in a fixed order. Template emails only carry the template id and
+# variables instead of the subject and content
+def encode_email(email):
+    if email.template is not None:
+        return [EMAIL_WIRE_VERSION, [list(x) for x in email.to], email.sender, email.sender_name,
+                None, None, email.content_type, email.template.template_id, email.template_vars]
+    return [EMAIL_WIRE_VERSION, [list(x) for x in email.to], email.sender, email.sender_name,
+            email.subject, email.content, email.content_type, None, None]
+
+
+# Decode and validate an email encoded with encode_email. The templates of
+# template emails are looked up in templates (a TemplateRegistry) and rendered.
+# Raises InvalidEmailArgument if the payload is not a valid email
+def decode_email(payload, templates=None):
+    if not isinstance(payload, (list, tuple)) or len(payload) == 0 or payload[0] not in (1, EMAIL_WIRE_VERSION):
+        raise InvalidEmailArgument("Unsupported email wire format")
+    try:
+        if payload[0] == 1:
+            version, to, sender, sender_name, subject, content, content_type = payload
+            template_id = template_vars = None
+        else:
+            version, to, sender, sender_name, subject, content, content_type, template_id, template_vars = payload
+
+        template = None
+        if template_id is not None:
+            if templates is None:
+                raise InvalidEmailArgument("Template emails are not supported")
+            template = templates.get(template_id)
+
+        email = Email(to[0][0], sender, subject, content, content_type, to_name=to[0][1], sender_name=sender_name,
+                      template=template, template_vars=template_vars)
+        email.add_recipients(to[1:])
+    except (ValueError, TypeError, IndexError):
+        raise InvalidEmailArgument("Malformed email wire format")
+    if template is not None:
+        email.render_template()
+    return email
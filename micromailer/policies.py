@@ -0,0 +1,94 @@
+import random
+
+
+# Policies deciding which service the dispatcher sends an email with. A policy
+# selects from the services that have not reached their rate limit, given as a
+# tuple of (service, score) ordered by descending score, and the function
+# in_flight returning the number of requests a service is handling. Returns
+# the selected (service, score)
+class DispatchPolicy(object):
+
+    def select(self, ranked, in_flight):
+        raise NotImplementedError
+
+
+# Send everything with the service with the highest score until its score
+# drops below that of another service
+class HighestScorePolicy(DispatchPolicy):
+
+    def select(self, ranked, in_flight):
+        return ranked[0]
+
+
+# Spread the emails over the services at random in proportion to their scores
+class WeightedRandomPolicy(DispatchPolicy):
+
+    def __init__(self, rand=None):
+        self._random = rand or random.Random()
+
+    def select(self, ranked, in_flight):
+        return _weighted_choice(self._random, ranked)
+
+
+# Pick two different services at random in proportion to their scores and
+# use the one with the fewest requests in flight relative to its score. A
+# failing service is never busy as it fails fast, so its score has to be
+# taken into account to keep it from getting the traffic
+class PowerOfTwoChoicesPolicy(DispatchPolicy):
+
+    def __init__(self, rand=None):
+        self._random = rand or random.Random()
+
+    def select(self, ranked, in_flight):
+        if len(ranked) == 1:
+            return ranked[0]
+        first = _weighted_choice(self._random, ranked)
+        second = _weighted_choice(self._random, [x for x in ranked if x is not first])
+        if _load(second, in_flight) < _load(first, in_flight):
+            return second
+        return first
+
+
+# Use the service with the fewest requests in flight relative to its score,
+# so a service gets more traffic the healthier it is and the faster it
+# completes the requests
+class LeastOutstandingPolicy(DispatchPolicy):
+
+    def select(self, ranked, in_flight):
+        return min(ranked, key=lambda x: _load(x, in_flight))
+
+
+# Requests in flight with the service of the (service, score) entry, including
+# the next, relative to its score
+def _load(entry, in_flight):
+    return (in_flight(entry[0]) + 1) / max(float(entry[1]), 0.01)
+
+
+# Select one of the (service, score) entries at random with a probability
+# proportional to the score. Uniform if all the scores are 0
+def _weighted_choice(rand, entries):
+    total = sum(x[1] for x in entries)
+    if total <= 0:
+        return rand.choice(entries)
+    point = rand.uniform(0, total)
+    for entry in entries:
+        point -= entry[1]
+        if point <= 0:
+            return entry
+    return entries[-1]
+
+
+dispatch_policies = {
+    'highest-score': HighestScorePolicy,
+    'weighted-random': WeightedRandomPolicy,
+    'power-of-two-choices': PowerOfTwoChoicesPolicy,
+    'least-outstanding': LeastOutstandingPolicy
+}
+
+
+# Create the dispatch policy with the given name. Raises ValueError if there
+# is no such policy
+def create_dispatch_policy(name):
+    if name not in dispatch_policies:
+        raise ValueError("Unknown dispatch policy '%s'. Use one of %s" % (name, ", ".join(sorted(dispatch_policies))))
+    return dispatch_policies[name]()
@@ -0,0 +1,120 @@
+import time
+from threading import Lock
+
+
+# Base class for token bucket rate limiters. A bucket holds up to burst tokens
+# and is refilled with rate tokens per second. Each email sent takes a token.
+# A request for more tokens than the burst is granted once the bucket is full
+# and leaves the bucket in debt, so large batches are not starved but still
+# count against the rate.
+class TokenBucketBase(object):
+
+    def __init__(self, rate, burst):
+        assert rate > 0 and burst >= 1
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._saturated_until = 0
+
+    # Take count tokens, waiting at most timeout seconds for them to become
+    # available. Returns True if the tokens were taken
+    def acquire(self, count=1, timeout=0):
+        deadline = self._get_time() + timeout
+        while True:
+            wait = self.try_acquire(count)
+            if wait == 0:
+                return True
+            if self._get_time() + wait > deadline:
+                return False
+            self._sleep(wait)
+
+    # Take count tokens if they are available. Returns 0 if they were taken and
+    # otherwise the number of seconds until they will be available
+    def try_acquire(self, count=1):
+        wait, tokens = self._take(count, self._get_time())
+        if tokens < 1:
+            self._saturated_until = self._get_time() + max(wait, (1 - tokens) / self.rate)
+        return wait
+
+    # True if no token was available at the last attempt to take tokens and
+    # the bucket has not been refilled since. Answered from local state only,
+    # so it is cheap enough to ask for every email
+    def is_saturated(self):
+        return self._get_time() < self._saturated_until
+
+    # Take count tokens at time now if available. Returns the number of
+    # seconds to wait for the tokens (0 if they were taken) and the number of
+    # tokens left in the bucket
+    def _take(self, count, now):
+        raise NotImplementedError
+
+    def _get_time(self):
+        return time.time()
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+
+# Token bucket kept in the process memory
+class TokenBucket(TokenBucketBase):
+
+    def __init__(self, rate, burst):
+        super(TokenBucket, self).__init__(rate, burst)
+        self._tokens = self.burst
+        self._updated = None
+        self._lock = Lock()
+
+    def _take(self, count, now):
+        with self._lock:
+            if self._updated is None:
+                self._updated = now
+            elif now > self._updated:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+            needed = min(count, self.burst)
+            if self._tokens < needed:
+                return (needed - self._tokens) / self.rate, self._tokens
+            self._tokens -= count
+            return 0, self._tokens
+
+
+# Refill and take tokens from the bucket stored in a redis hash atomically.
+# Returns the seconds to wait and the tokens left as strings, as redis
+# truncates Lua numbers to integers
+_take_script = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+if now > updated then
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    updated = now
+end
+local needed = math.min(count, burst)
+local wait = 0
+if tokens < needed then
+    wait = (needed - tokens) / rate
+else
+    tokens = tokens - count
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(updated))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return {tostring(wait), tostring(tokens)}
+"""
+
+
+# Token bucket stored in redis, so all the worker processes on all the nodes
+# sharing the redis server take their tokens from the same bucket. The bucket
+# is refilled by the time of the workers, so their clocks should be in sync
+class RedisTokenBucket(TokenBucketBase):
+
+    def __init__(self, client, key, rate, burst):
+        super(RedisTokenBucket, self).__init__(rate, burst)
+        self._key = key
+        self._script = client.register_script(_take_script)
+
+    def _take(self, count, now):
+        wait, tokens = self._script(keys=[self._key], args=[self.rate, self.burst, count, repr(now)])
+        return float(wait), float(tokens)
@@ -0,0 +1,55 @@
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+
+# Bounded LRU cache of rendered email content. Content is rendered with the
+# given render function and cached by a hash of the content, so repeated
+# bodies (e.g. the same template sent to many recipients) are only rendered
+# once. The least recently used entries are evicted when the size of the
+# rendered content exceeds max_bytes.
+class RenderCache(object):
+
+    def __init__(self, render, max_bytes=32 * 1024 * 1024):
+        self._render = render
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = Lock()
+
+    def render(self, content):
+        key = hashlib.sha1(content.encode('utf-8') if isinstance(content, unicode) else content).digest()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+
+        # Render outside the lock so a slow render does not block cache hits
+        rendered = self._render(content)
+        size = _get_size(rendered)
+        if size > self._max_bytes:
+            return rendered
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (rendered, size)
+                self._size += size
+                while self._size > self._max_bytes:
+                    self._size -= self._entries.popitem(last=False)[1][1]
+        return rendered
+
+    def get_stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'entries': len(self._entries), 'bytes': self._size}
+
+
+# Size in bytes of the content when UTF-8 encoded
+def _get_size(content):
+    if isinstance(content, unicode):
+        return len(content.encode('utf-8'))
+    return len(content)
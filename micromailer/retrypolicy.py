@@ -0,0 +1,49 @@
+import random
+
+from mailservice import BadRequest
+from models import InvalidEmailArgument
+
+
+# Decides if and when a failed delivery is retried. Retries back off
+# exponentially from base_delay up to max_delay seconds with full jitter, so
+# the retries of emails that failed at the same time are spread out instead of
+# hitting a recovering service at once. A service asking to wait with
+# Retry-After is given at least that long. An email is not retried after
+# max_attempts attempts or if the retry would be later than deadline seconds
+# after the first attempt. Errors caused by the email itself are never retried
+class RetryPolicy(object):
+
+    # Exceptions that will fail the same way when retried
+    never_retry = (BadRequest, InvalidEmailArgument)
+
+    def __init__(self, base_delay=10, max_delay=600, max_attempts=10, deadline=10800, jitter=True, rand=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self._jitter = jitter
+        self._random = rand or random.Random()
+
+    # Return the seconds to wait before the next attempt to deliver an email,
+    # or None if it should not be retried. attempts is the number of attempts
+    # made including the one failing with exc, and elapsed is the number of
+    # seconds since the first attempt
+    def get_delay(self, exc, attempts, elapsed=0):
+        if isinstance(exc, self.never_retry) or attempts >= self.max_attempts:
+            return None
+
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        if self._jitter:
+            delay = self._random.uniform(0, delay)
+        retry_after = getattr(exc, 'retry_after', None)
+        if retry_after is not None:
+            delay = max(delay, retry_after + (self._random.uniform(0, self.base_delay) if self._jitter else 0))
+
+        if elapsed + delay > self.deadline:
+            return None
+        return delay
+
+    # True if the email failed with an error that may go away, so it can be
+    # delivered later if the retries were exhausted
+    def is_retryable(self, exc):
+        return not isinstance(exc, self.never_retry)
@@ -2,6 +2,7 @@ import json
 import requests
 import logging
 import mailservice
+from connectionpool import PooledSession, DEFAULT_TIMEOUT, get_retry_after
 
 
 class BearerAuth(requests.auth.AuthBase):
@@ -16,15 +17,70 @@ class BearerAuth(requests.auth.AuthBase):
 
 class SendGridMailService(mailservice.BackoffOnFailureMailServiceBase):
 
-    def __init__(self, api_key, service_score=50):
-        super(SendGridMailService, self).__init__(service_score)
+    # SendGrid accepts at most 1000 personalizations per request
+    max_recipients_per_request = 1000
+
+    default_url = "https://api.sendgrid.com/v3/mail/send"
+
+    # At most max_concurrency requests are made at the same time by send_async
+    # and send_batch. It defaults to the number of pooled connections. url is
+    # the API endpoint, which can be changed to use a stand-in for the service
+    def __init__(self, api_key, service_score=50, pool_size=10, timeout=DEFAULT_TIMEOUT, max_concurrency=None, url=None):
+        super(SendGridMailService, self).__init__(service_score, max_concurrency or pool_size)
         self._auth = BearerAuth(api_key)
-        self._url = "https://api.sendgrid.com/v3/mail/send"
+        self._url = url or self.default_url
+        self._session = PooledSession(pool_size, timeout)
 
     def _do_send(self, msg):
+        response = self._post(self._build_body(msg, msg.to))
+        return self._build_success_response(msg, response)
+
+    def _group_emails(self, msgs):
+        return mailservice.group_compatible_emails(msgs, self.max_recipients_per_request)
+
+    # Emails with the same sender, subject and content are sent in a single
+    # request with a personalization for each recipient
+    def _do_send_batch(self, msgs):
+        groups = self._group_emails(msgs)
+        responses = self._map_concurrently(lambda group: self._post(self._build_batch_body(msgs, group)), groups)
+
+        results = [None] * len(msgs)
+        for group, response in zip(groups, responses):
+            for index in group:
+                if isinstance(response, mailservice.MailServiceException):
+                    results[index] = response
+                else:
+                    results[index] = self._build_success_response(msgs[index], response)
+        return results
+
+    # Emails rendered from the same template are sent as the template with
+    # the variables of each email as substitutions in its personalizations
+    def _build_batch_body(self, msgs, group):
+        msg = msgs[group[0]]
+        if msg.template is None:
+            return self._build_body(msg, [x for index in group for x in msgs[index].to])
 
-        body = {
-            "personalizations": [{"to": [{"email": x[0]}]} if x[1] is None else {"to": [{"email": x[0], "name": x[1]}]} for x in msg.to],
+        body = self._build_body(msg, [])
+        body["subject"], body["content"][0]["value"] = msg.template.format(lambda name: "-subject.%s-" % name,
+                                                                          lambda name: "-%s-" % name)
+        for index in group:
+            substitutions = {}
+            for name in msg.template.variables:
+                value = msgs[index].template_vars[name]
+                substitutions["-subject.%s-" % name] = unicode(value)
+                substitutions["-%s-" % name] = msg.template.escape(value)
+            for x in msgs[index].to:
+                personalization = self._build_personalization(x)
+                personalization["substitutions"] = substitutions
+                body["personalizations"].append(personalization)
+        return body
+
+    def _build_personalization(self, recipient):
+        return {"to": [{"email": recipient[0]}]} if recipient[1] is None else {"to": [{"email": recipient[0], "name": recipient[1]}]}
+
+    def _build_body(self, msg, recipients):
+        return {
+            "personalizations": [self._build_personalization(x) for x in recipients],
             "subject": msg.subject,
             "from": {"email": msg.sender} if msg.sender_name is None else {"email": msg.sender, "name": msg.sender_name},
             "content": [
@@ -34,19 +90,17 @@ class SendGridMailService(mailservice.BackoffOnFailureMailServiceBase):
                 }
             ]
         }
-        logging.debug("Sending email via sendgrid: %s" % json.dumps(body))
 
-        # Perform HTTP request
+    # Perform the HTTP request and raise an exception on error
+    def _post(self, body):
+        logging.debug("Sending email via sendgrid: %s" % json.dumps(body))
         try:
-            response = requests.post(self._url, json=body, auth=self._auth)
+            response = self._session.post(self._url, json=body, auth=self._auth)
 
             if response.status_code >= 200 and response.status_code <= 299:
-                output = self._build_success_response(msg)
-                output['_response'] = response.text
-                output['_service'] = self.get_name()
-                return output
-            elif response.status_code == 419:
-                raise mailservice.TooManyRequests(response.text)
+                return response
+            elif response.status_code in (419, 429):
+                raise mailservice.TooManyRequests(response.text, get_retry_after(response))
             elif response.status_code == 401:
                 raise mailservice.UnauthorizedRequest(response.text)
             elif response.status_code >= 400 and response.status_code <= 499:
@@ -60,11 +114,16 @@ class SendGridMailService(mailservice.BackoffOnFailureMailServiceBase):
         except requests.exceptions.RequestException as e:
             raise mailservice.ServerException(e.message)
 
-    def _build_success_response(self, msg):
-        output = {}
+    # SendGrid accepts all the recipients of a successful request and returns
+    # the id of the message in the X-Message-Id header
+    def _build_success_response(self, msg, response):
+        output = {'_response': response.text, '_service': self.get_name(), '_id': response.headers.get('X-Message-Id')}
         for email in msg.to:
             output[email[0]] = True
         return output
 
+    def get_connection_stats(self):
+        return self._session.get_connection_stats()
+
     def get_name(self):
         return "sendgrid"
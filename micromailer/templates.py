@@ -0,0 +1,157 @@
+import cgi
+import json
+import re
+from threading import Lock
+
+from models import InvalidEmailArgument
+
+# Placeholders in templates are written as {{name}}
+placeholder_pattern = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+template_content_types = ("text/plain", "text/html", "text/markdown")
+
+
+class UnknownTemplate(InvalidEmailArgument):
+    pass
+
+
+# The template already exists with a different definition
+class TemplateConflict(Exception):
+    pass
+
+
+# Split the text in literal parts and placeholder names. Literals are at the
+# even and names at the odd indexes of the returned list
+def _compile(text):
+    return placeholder_pattern.split(text)
+
+
+def _substitute(parts, value):
+    output = list(parts)
+    output[1::2] = [value(name) for name in parts[1::2]]
+    return u"".join(output)
+
+
+# A precompiled template. The subject and content are split around their
+# placeholders once, so rendering an email is a substitution of the variables
+# into the compiled output.
+class Template(object):
+
+    def __init__(self, template_id, subject, content, content_type):
+        self.template_id = template_id
+        self.content_type = content_type
+        self._subject = _compile(subject)
+        self._content = _compile(content)
+        self.variables = frozenset(self._subject[1::2] + self._content[1::2])
+
+    # Raise InvalidEmailArgument unless variables holds a string value for
+    # every placeholder of the template
+    def check_variables(self, variables):
+        if not isinstance(variables, dict):
+            raise InvalidEmailArgument("Template variables have to be an object")
+        for name in self.variables:
+            if name not in variables:
+                raise InvalidEmailArgument("Missing template variable '%s'" % name)
+            if not isinstance(variables[name], (basestring, int, long, float)):
+                raise InvalidEmailArgument("Template variable '%s' has to be a string" % name)
+
+    # Return the subject and content with the variables substituted
+    def render(self, variables):
+        return (_substitute(self._subject, lambda name: unicode(variables[name])),
+                _substitute(self._content, lambda name: self.escape(variables[name])))
+
+    # Return the subject and content with the placeholders replaced by the
+    # tags returned by subject_tag and content_tag for each name. Used to
+    # build the templates for the substitution features of the mail services
+    def format(self, subject_tag, content_tag):
+        return (_substitute(self._subject, subject_tag), _substitute(self._content, content_tag))
+
+    # Return the value of a variable as it should be inserted in the content
+    def escape(self, value):
+        if self.content_type == "text/html":
+            return cgi.escape(unicode(value), quote=True)
+        return unicode(value)
+
+
+# Template store keeping the template definitions in the process memory
+class DictTemplateStore(object):
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = Lock()
+
+    def get(self, template_id):
+        return self._templates.get(template_id)
+
+    # Add the template unless it already exists. Returns True if it was added
+    def add(self, template_id, definition):
+        with self._lock:
+            if template_id in self._templates:
+                return False
+            self._templates[template_id] = definition
+            return True
+
+
+# Template store keeping the template definitions in a redis hash, so all
+# the webservices and workers share the same templates
+class RedisTemplateStore(object):
+
+    def __init__(self, client, key="micromailer.templates"):
+        self._client = client
+        self._key = key
+
+    def get(self, template_id):
+        definition = self._client.hget(self._key, template_id)
+        return json.loads(definition) if definition is not None else None
+
+    def add(self, template_id, definition):
+        return bool(self._client.hsetnx(self._key, template_id, json.dumps(definition)))
+
+
+# Registry of named templates. Templates are immutable once registered, so
+# every process can keep the compiled templates without invalidation.
+# text/markdown templates are rendered to HTML with the render function when
+# compiled
+class TemplateRegistry(object):
+
+    def __init__(self, render=None, store=None):
+        self._render = render
+        self._store = store if store is not None else DictTemplateStore()
+        self._compiled = {}
+        self._lock = Lock()
+
+    # Register a template. Raises InvalidEmailArgument if the definition is
+    # invalid and TemplateConflict if a different template is registered with
+    # the same id. Returns True if the template was added
+    def register(self, template_id, subject, content, content_type="text/markdown"):
+        for name, value in [('Template id', template_id), ('Subject', subject), ('Content', content)]:
+            if not isinstance(value, basestring) or len(value) == 0:
+                raise InvalidEmailArgument("%s has to be a non-empty string" % name)
+        if content_type not in template_content_types or (content_type == "text/markdown" and self._render is None):
+            raise InvalidEmailArgument("Unsupported template content-type '%s'" % content_type)
+
+        definition = {'subject': subject, 'content': content, 'content_type': content_type}
+        if self._store.add(template_id, definition):
+            return True
+        if self._store.get(template_id) != definition:
+            raise TemplateConflict("Template '%s' already exists" % template_id)
+        return False
+
+    # Return the compiled template. Raises UnknownTemplate if there is no
+    # template with the id
+    def get(self, template_id):
+        template = self._compiled.get(template_id)
+        if template is not None:
+            return template
+
+        definition = self._store.get(template_id) if isinstance(template_id, basestring) else None
+        if definition is None:
+            raise UnknownTemplate("Unknown template '%s'" % template_id)
+        content = definition['content']
+        content_type = definition['content_type']
+        if content_type == "text/markdown":
+            content = self._render(content)
+            content_type = "text/html"
+        template = Template(template_id, definition['subject'], content, content_type)
+        with self._lock:
+            return self._compiled.setdefault(template_id, template)
@@ -0,0 +1,146 @@
+import json
+import random
+import threading
+import time
+import uuid
+from threading import Lock
+
+
+# Exporter writing each span as a line of JSON to a file
+class JsonFileExporter(object):
+
+    def __init__(self, path):
+        self._file = open(path, "a")
+        self._lock = Lock()
+
+    def export(self, span):
+        line = json.dumps(span, sort_keys=True) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+
+# Exporter keeping the spans in a list, for tests
+class ListExporter(object):
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+class _Span(object):
+
+    def __init__(self, tracer, trace_id, name, attributes):
+        self._tracer = tracer
+        self._trace_id = trace_id
+        self._name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self._tracer.record(self._name, self._start, time.time() - self._start, self._trace_id, **self.attributes)
+        return False
+
+
+class _Activation(object):
+
+    def __init__(self, local, trace_id):
+        self._local = local
+        self._trace_id = trace_id
+
+    def __enter__(self):
+        self._previous = getattr(self._local, 'trace_id', None)
+        self._local.trace_id = self._trace_id
+        return self._trace_id
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.trace_id = self._previous
+        return False
+
+
+# Records the time spent in the stages of the delivery of an email as spans of
+# a trace. A trace is started for a sample_rate fraction of the emails, and its
+# id is carried from the webservice to the worker in the task headers. Within
+# the worker, the trace is active in the thread delivering the email, and in
+# the threads it hands the delivery to through wrap, so the mail services add
+# their spans to it without passing the trace id around. Each span is a dict
+# with the trace id, the name of the stage, the start time and duration in
+# seconds and any attributes, given to the exporter when the stage ends.
+# Without an active trace, a span is a no-op.
+class Tracer(object):
+
+    def __init__(self, exporter=None, sample_rate=0.01, rand=None):
+        self._exporter = exporter
+        self._sample_rate = sample_rate
+        self._random = rand or random.Random()
+        self._local = threading.local()
+
+    def set_exporter(self, exporter, sample_rate=0.01):
+        self._exporter = exporter
+        self._sample_rate = sample_rate
+
+    # Return the id of a new trace, or None if the trace is not sampled
+    def start_trace(self):
+        if self._exporter is None or self._random.random() >= self._sample_rate:
+            return None
+        return uuid.uuid4().hex
+
+    # Make the trace the active trace of the calling thread within a with block
+    def activate(self, trace_id):
+        return _Activation(self._local, trace_id)
+
+    # Return the id of the active trace of the calling thread or None
+    def current_trace(self):
+        return getattr(self._local, 'trace_id', None)
+
+    # Return a function calling function with the trace of the calling thread
+    # active, for functions run by other threads
+    def wrap(self, function):
+        trace_id = self.current_trace()
+        if trace_id is None:
+            return function
+
+        def traced(*args, **kwargs):
+            with self.activate(trace_id):
+                return function(*args, **kwargs)
+        return traced
+
+    # Time a stage within a with block as a span of the trace, which defaults
+    # to the active trace
+    def span(self, name, trace_id=None, **attributes):
+        trace_id = trace_id or self.current_trace()
+        if trace_id is None:
+            return _no_span
+        return _Span(self, trace_id, name, attributes)
+
+    # Export a span timed by the caller
+    def record(self, name, start, duration, trace_id=None, **attributes):
+        trace_id = trace_id or self.current_trace()
+        if trace_id is None or self._exporter is None:
+            return
+        span = {'trace_id': trace_id, 'name': name, 'start': start, 'duration': duration}
+        span.update(attributes)
+        self._exporter.export(span)
+
+
+# The tracer of micromailer. Traces are only started once an exporter is set
+tracer = Tracer()
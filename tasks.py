@@ -1,31 +1,473 @@
-from celery import Celery
+import logging
+import os
+import time
+
+import markdown
+
+from celery import Celery, states
 from celery.bin import worker
+from celery.contrib.batches import Batches
+from celery.backends.redis import RedisBackend
+from celery.signals import task_postrun, task_prerun, celeryd_after_setup
+from celery.exceptions import Ignore
 
-from micromailer.dispatcher import MailDispatcher
+from micromailer.dispatcher import MailDispatcher, PartialDelivery
 from micromailer.sendgrid import SendGridMailService
 from micromailer.mandrill import MandrillMailService
 from micromailer.mailservice import MailServiceException
+from micromailer.models import decode_email, encode_email, InvalidEmailArgument
+from micromailer.rendercache import RenderCache
+from micromailer.templates import TemplateRegistry, RedisTemplateStore, DictTemplateStore
+from micromailer.ratelimit import TokenBucket, RedisTokenBucket
+from micromailer.policies import create_dispatch_policy
+from micromailer.circuitbreaker import CircuitBreaker, RedisCircuitBreaker
+from micromailer.retrypolicy import RetryPolicy
+from micromailer import metrics
+from micromailer.tracing import tracer, JsonFileExporter
+from micromailer.deliveryrecord import encode_delivery_record
+from micromailer.idempotency import IdempotencyStore, RedisIdempotencyStore, DeliveryInProgress
 
-from emailservice_config import MANDRILL_API_KEY, SENDGRID_API_KEY
+from emailservice_config import MANDRILL_API_KEY, SENDGRID_API_KEY, MAILSERVICE_HTTP_POOL_SIZE, MAILSERVICE_HTTP_TIMEOUT, \
+    MAILSERVICE_MAX_CONCURRENCY, MAILSERVICE_BATCH_SIZE, MAILSERVICE_BATCH_INTERVAL_MS, MAILSERVICE_RENDER_CACHE_BYTES, \
+    SENDGRID_API_URL, MANDRILL_API_URL, \
+    SENDGRID_RATE_LIMIT, SENDGRID_RATE_BURST, MANDRILL_RATE_LIMIT, MANDRILL_RATE_BURST, MAILSERVICE_RATE_LIMIT_WAIT, \
+    MAILSERVICE_DISPATCH_POLICY, MAILSERVICE_FAILOVER, MAILSERVICE_ATTEMPT_TIMEOUT, MAILSERVICE_CIRCUIT_FAILURES, \
+    MAILSERVICE_CIRCUIT_WINDOW, MAILSERVICE_CIRCUIT_OPEN_TIMEOUT, MAILSERVICE_CIRCUIT_PROBES, MAILSERVICE_RETRY_BASE_DELAY, \
+    MAILSERVICE_RETRY_MAX_DELAY, MAILSERVICE_RETRY_MAX_ATTEMPTS, MAILSERVICE_DELIVERY_DEADLINE, MAILSERVICE_DEAD_LETTER_QUEUE, \
+    MAILSERVICE_IDEMPOTENCY, MAILSERVICE_IDEMPOTENCY_TTL, MAILSERVICE_IDEMPOTENCY_CLAIM_TTL, MAILSERVICE_METRICS_PORT, \
+    MAILSERVICE_TRACE_FILE, MAILSERVICE_TRACE_SAMPLE_RATE, MAILSERVICE_TRANSACTIONAL_QUEUE, MAILSERVICE_BULK_QUEUE
 
 celeryApp = Celery(__name__)
 celeryApp.config_from_object('celeryconfig')
 
+# Trace a sample of the emails through the webservice and the workers to a file
+if MAILSERVICE_TRACE_FILE is not None:
+    tracer.set_exporter(JsonFileExporter(MAILSERVICE_TRACE_FILE), MAILSERVICE_TRACE_SAMPLE_RATE)
+
+
+# Create the token bucket limiting the rate of a mail service. The bucket is kept in
+# redis when it is the result backend so the limit applies to all the workers together
+def create_rate_limiter(name, rate, burst):
+    if isinstance(celeryApp.backend, RedisBackend):
+        return RedisTokenBucket(celeryApp.backend.client, "micromailer.ratelimit.%s" % name, rate, burst)
+    return TokenBucket(rate, burst)
+
+
+# Create the circuit breaker of a mail service, shared through redis when it is the
+# result backend so an outage found by one worker opens the breaker for all of them
+def create_circuit_breaker(name):
+    options = dict(failure_threshold=MAILSERVICE_CIRCUIT_FAILURES, window=MAILSERVICE_CIRCUIT_WINDOW,
+                   open_timeout=MAILSERVICE_CIRCUIT_OPEN_TIMEOUT, max_probes=MAILSERVICE_CIRCUIT_PROBES)
+    if isinstance(celeryApp.backend, RedisBackend):
+        return RedisCircuitBreaker(celeryApp.backend.client, "micromailer.circuit.%s" % name, **options)
+    return CircuitBreaker(**options)
+
+
+def add_service(service, rate, burst):
+    if rate is not None:
+        service.set_rate_limiter(create_rate_limiter(service.get_name(), rate, burst), MAILSERVICE_RATE_LIMIT_WAIT)
+    if MAILSERVICE_CIRCUIT_FAILURES > 0:
+        service.set_circuit_breaker(create_circuit_breaker(service.get_name()))
+    dispatcher.add_service(service)
+
+
 # Create mail dispatcher instance
-dispatcher = MailDispatcher()
+dispatcher = MailDispatcher(policy=create_dispatch_policy(MAILSERVICE_DISPATCH_POLICY), failover=MAILSERVICE_FAILOVER,
+                            attempt_timeout=MAILSERVICE_ATTEMPT_TIMEOUT)
 if SENDGRID_API_KEY is not None:
-    dispatcher.add_service(SendGridMailService(SENDGRID_API_KEY))
+    add_service(SendGridMailService(SENDGRID_API_KEY, pool_size=MAILSERVICE_HTTP_POOL_SIZE, timeout=MAILSERVICE_HTTP_TIMEOUT,
+                                    max_concurrency=MAILSERVICE_MAX_CONCURRENCY, url=SENDGRID_API_URL),
+                SENDGRID_RATE_LIMIT, SENDGRID_RATE_BURST)
 if MANDRILL_API_KEY is not None:
-    dispatcher.add_service(MandrillMailService(MANDRILL_API_KEY))
+    add_service(MandrillMailService(MANDRILL_API_KEY, pool_size=MAILSERVICE_HTTP_POOL_SIZE, timeout=MAILSERVICE_HTTP_TIMEOUT,
+                                    max_concurrency=MAILSERVICE_MAX_CONCURRENCY, url=MANDRILL_API_URL),
+                MANDRILL_RATE_LIMIT, MANDRILL_RATE_BURST)
+
+metrics.registry.gauge("micromailer_service_score", "Current score of the mail services",
+                       lambda: [((service.get_name(),), score) for service, score in dispatcher.get_scores()], ("service",))
+retry_count = metrics.registry.counter("micromailer_retries_total", "Emails retried by the exception they failed with",
+                                       ("exception",))
+dead_letter_count = metrics.registry.counter("micromailer_dead_letters_total",
+                                             "Emails given up on by the exception they failed with", ("exception",))
+queue_wait = metrics.registry.histogram("micromailer_queue_wait_seconds",
+                                        "Time emails waited in the queue for their first delivery attempt by priority",
+                                        ("priority",), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900))
+
+# Queue of each priority lane (see MAILSERVICE_TRANSACTIONAL_QUEUE)
+PRIORITY_QUEUES = {'transactional': MAILSERVICE_TRANSACTIONAL_QUEUE, 'bulk': MAILSERVICE_BULK_QUEUE}
+DEFAULT_PRIORITY = 'transactional'
+
+# Decides when failed emails are retried
+retry_policy = RetryPolicy(MAILSERVICE_RETRY_BASE_DELAY, MAILSERVICE_RETRY_MAX_DELAY, MAILSERVICE_RETRY_MAX_ATTEMPTS,
+                           MAILSERVICE_DELIVERY_DEADLINE)
+
+# Cache of markdown content rendered to HTML. Used by the webservice or, if rendering
+# is moved to the workers, before delivery
+markdown_cache = RenderCache(markdown.markdown, MAILSERVICE_RENDER_CACHE_BYTES)
+
+_template_registry = None
+_idempotency_store = None
+
+
+# Return the registry of the named templates. The templates are shared through redis
+# when it is the result backend. Created on first use as the result backend may be
+# configured after this module is imported
+def get_template_registry():
+    global _template_registry
+    if _template_registry is None:
+        if isinstance(celeryApp.backend, RedisBackend):
+            store = RedisTemplateStore(celeryApp.backend.client)
+        else:
+            store = DictTemplateStore()
+        _template_registry = TemplateRegistry(markdown.markdown, store)
+    return _template_registry
+
+
+# Return the record of the delivered emails, or None if emails are not deduplicated. The
+# record is shared through redis when it is the result backend. Created on first use as
+# the result backend may be configured after this module is imported
+def get_idempotency_store():
+    global _idempotency_store
+    if _idempotency_store is None and MAILSERVICE_IDEMPOTENCY:
+        if isinstance(celeryApp.backend, RedisBackend):
+            _idempotency_store = RedisIdempotencyStore(celeryApp.backend.client, ttl=MAILSERVICE_IDEMPOTENCY_TTL,
+                                                       claim_ttl=MAILSERVICE_IDEMPOTENCY_CLAIM_TTL)
+        else:
+            _idempotency_store = IdempotencyStore(MAILSERVICE_IDEMPOTENCY_TTL, MAILSERVICE_IDEMPOTENCY_CLAIM_TTL)
+    return _idempotency_store
+
+
+# Return the priority lane of a task from the delivery info of its message. The routing key
+# of the queue of each lane is the name of the queue. Tasks queued by other routes, like the
+# tasks queued before there were lanes, are transactional
+def get_priority(delivery_info):
+    routing_key = (delivery_info or {}).get('routing_key')
+    for priority, queue in PRIORITY_QUEUES.items():
+        if queue == routing_key:
+            return priority
+    return DEFAULT_PRIORITY
+
+
+# Record the time an email waited in the queue of its priority lane for its first delivery
+# attempt. enqueued_at is the time the webservice enqueued the email, if it is known
+def record_queue_wait(email_id, priority, enqueued_at):
+    if enqueued_at is None:
+        return
+    wait = time.time() - enqueued_at
+    queue_wait.observe(max(wait, 0), (priority,))
+    tracer.record("task.queue_wait", enqueued_at, wait, email_id=email_id, priority=priority)
+
+
+# Claim the delivery of an email by its email id before it is sent, so an email that is
+# redelivered by the broker is not sent twice. Returns the claim, or None if the email
+# must not be sent: either it was delivered already or another worker is delivering it.
+# In the latter case the email is checked again once the claim of the other worker expires,
+# without storing a status that would overwrite the status stored by the other worker.
+# kwargs are the keyword arguments of send_email for the email and priority its lane
+def claim_email(email_id, payload, retries, kwargs, priority=DEFAULT_PRIORITY):
+    store = get_idempotency_store()
+    if store is None:
+        return True
+    try:
+        claim = store.claim(email_id)
+    except DeliveryInProgress as exc:
+        send_email.apply_async([payload], kwargs, task_id=email_id, countdown=exc.retry_after + 1, retries=retries,
+                               queue=PRIORITY_QUEUES[priority])
+        return None
+    if claim is None:
+        logging.info("Skipping email %s as it was already delivered" % email_id)
+    return claim
+
+
+# Record the outcome of the delivery of a claimed email
+def complete_email(email_id, claim, delivered):
+    store = get_idempotency_store()
+    if store is None:
+        return
+    if delivered:
+        store.complete(email_id)
+    else:
+        store.release(email_id, claim)
+
+
+# Decode an email in the task wire format, rendering templates and markdown content
+def decode_task_email(payload):
+    email = decode_email(payload, get_template_registry())
+    if email.content_type == "text/markdown":
+        email.content = markdown_cache.render(email.content)
+        email.content_type = "text/html"
+    return email
+
+
+# Task base class storing the number of delivery attempts together with the
+# exception of a retried or failed email, as the JSON result serializer only
+# keeps the type and message of an exception
+class SendEmailTask(celeryApp.Task):
+    abstract = True
+
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        store_email_exception(task_id, exc, self.request.retries + 1, states.RETRY)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        store_email_exception(task_id, exc, self.request.retries + 1, states.FAILURE)
+
+
+# The email is given in the wire format of micromailer.models.encode_email. first_attempt
+# is the time of the first attempt to deliver the email, which is passed on to the retries
+# so the retry policy can enforce the delivery deadline. Emails that were already delivered
+# under the same email id are ignored, leaving the stored result as it is. The result is
+# stored as a compact delivery record (see micromailer.deliveryrecord).
+# The trace started by the webservice is given in the trace_id header, which is kept by the
+# retries, and the time the email was enqueued in enqueued_at. The retries stay in the queue
+# of the priority lane the email was queued on.
+# When only some chunks of the recipients of an email were delivered, the retries are given
+# the indexes of the other recipients in pending and what was delivered in delivered (see
+# merge_delivered), so only the failed chunks are sent again. An email that is given up on
+# after some of its recipients were delivered is stored as a partial delivery with the other
+# recipients rejected
+@celeryApp.task(name="micromailer.sendEmail", bind=True, base=SendEmailTask, max_retries=None)
+def send_email(self, payload, first_attempt=None, pending=None, delivered=None, enqueued_at=None):
+    headers = self.request.headers or {}
+    trace_id = headers['trace_id'] if 'trace_id' in headers else tracer.start_trace()
+    with tracer.activate(trace_id):
+        if self.request.retries == 0:
+            record_queue_wait(self.request.id, get_priority(self.request.delivery_info), enqueued_at)
+        return deliver_email(self, payload, first_attempt, pending, delivered)
 
 
-@celeryApp.task(name="micromailer.sendEmail", bind=True)
-def send_email(self, email):
+def deliver_email(task, payload, first_attempt, pending=None, delivered=None):
+    attempts = task.request.retries + 1
+    first_attempt = first_attempt or time.time()
+    priority = get_priority(task.request.delivery_info)
+    with tracer.span("task.decode", email_id=task.request.id):
+        email = decode_task_email(payload)
+    claim = claim_email(task.request.id, payload, task.request.retries,
+                        {'first_attempt': first_attempt, 'pending': pending, 'delivered': delivered}, priority)
+    if claim is None:
+        raise Ignore()
     try:
-        return dispatcher.send(email)
+        with tracer.span("dispatcher.send", email_id=task.request.id, attempt=attempts):
+            result = dispatcher.send(email if pending is None else email.with_recipients([email.to[x] for x in pending]))
     except MailServiceException as exc:
-        # Retry on mail service exceptions.
-        raise self.retry(exc=exc, countdown=10)
+        cause = exc
+        if isinstance(exc, PartialDelivery):
+            cause = exc.error
+            pending = get_pending_recipients(email, pending, exc.failed)
+            delivered = merge_delivered(delivered, exc.result)
+        # Retry on mail service exceptions as decided by the retry policy. With failover,
+        # all the services have failed. An email that was delivered to some of its
+        # recipients is given up on as partly delivered. It is only recorded as delivered
+        # if the pending recipients are not dead-lettered, as they are replayed under its id
+        delay = retry_policy.get_delay(cause, attempts, time.time() - first_attempt)
+        if delay is None:
+            dead_lettered = retry_policy.is_retryable(cause)
+            if dead_lettered:
+                dead_letter_email(task.request.id, get_pending_payload(email, payload, pending), exc, priority)
+            complete_email(task.request.id, claim, delivered is not None and not dead_lettered)
+            if delivered is None:
+                raise exc
+            return encode_delivery_record(email, get_partial_result(email, pending, delivered, cause), attempts)
+        complete_email(task.request.id, claim, False)
+        retry_count.inc((type(cause).__name__,))
+        raise task.retry(exc=exc, countdown=delay,
+                         kwargs={'first_attempt': first_attempt, 'pending': pending, 'delivered': delivered})
+    complete_email(task.request.id, claim, True)
+    if delivered is not None:
+        result = dict(result)
+        result.update(delivered)
+    return encode_delivery_record(email, result, attempts)
+
+
+# Return the indexes in email.to of the failed recipients, a list of (email, name), out
+# of the recipients with the pending indexes or all the recipients if None
+def get_pending_recipients(email, pending, failed):
+    failed = set(x[0] for x in failed)
+    return [x for x in (range(len(email.to)) if pending is None else pending) if email.to[x][0] in failed]
+
+
+# Keep the service, message id and rejected recipients of the result of the chunks of the
+# recipients of an email that were delivered. The delivery record of the email is encoded
+# from them and the result of the attempt delivering the last chunks
+def merge_delivered(delivered, result):
+    merged = dict((key, value) for key, value in result.items() if value is False or key in ('_service', '_id'))
+    merged.update(delivered or {})
+    return merged
+
+
+# Return the result of an email that was only delivered to some of its recipients, from
+# what was delivered (see merge_delivered) with the pending recipients rejected with
+# the error they failed with
+def get_partial_result(email, pending, delivered, error):
+    result = dict(delivered)
+    result['_response'] = "%s: %s" % (type(error).__name__, error)
+    for index in pending:
+        result[email.to[index][0]] = False
+    return result
+
+
+# Return the payload of the email to the pending recipients only
+def get_pending_payload(email, payload, pending):
+    if pending is None:
+        return payload
+    return encode_email(email.with_recipients([email.to[x] for x in pending]))
+
+
+# Batching variant of send_email. Buffers up to MAILSERVICE_BATCH_SIZE emails or
+# MAILSERVICE_BATCH_INTERVAL_MS milliseconds and delivers them with a single dispatcher
+# call. The result of each email is stored under its own task id, so the status
+# can be looked up the same way as for send_email. The batches do not get the task
+# headers, so each batch is traced on its own. The emails of a batch may come from
+# both priority lanes, and each email is retried in the queue of its own lane
+@celeryApp.task(name="micromailer.sendEmailBatch", base=Batches, flush_every=MAILSERVICE_BATCH_SIZE,
+                flush_interval=MAILSERVICE_BATCH_INTERVAL_MS / 1000.0)
+def send_email_batch(requests):
+    with tracer.activate(tracer.start_trace()):
+        deliver_email_batch(requests)
+
+
+def deliver_email_batch(requests):
+    first_attempt = time.time()
+    valid_requests = []
+    claims = []
+    emails = []
+    for request in requests:
+        record_queue_wait(request.id, get_priority(request.delivery_info), (request.kwargs or {}).get('enqueued_at'))
+        try:
+            email = decode_task_email(request.args[0])
+        except InvalidEmailArgument as exc:
+            store_email_exception(request.id, exc, 1, states.FAILURE)
+            notify_email_status(request.id, states.FAILURE)
+            continue
+        claim = claim_email(request.id, request.args[0], 0, {'first_attempt': first_attempt},
+                            get_priority(request.delivery_info))
+        if claim is not None:
+            emails.append(email)
+            valid_requests.append(request)
+            claims.append(claim)
+
+    try:
+        with tracer.span("dispatcher.send_many", emails=len(emails)):
+            results = dispatcher.send_many(emails)
+    except Exception as exc:
+        for request, claim in zip(valid_requests, claims):
+            complete_email(request.id, claim, False)
+            store_email_exception(request.id, exc, 1, states.FAILURE)
+            notify_email_status(request.id, states.FAILURE)
+        raise
+
+    for request, claim, email, result in zip(valid_requests, claims, emails, results):
+        if isinstance(result, MailServiceException):
+            cause = result
+            kwargs = {'first_attempt': first_attempt}
+            if isinstance(result, PartialDelivery):
+                cause = result.error
+                kwargs['pending'] = get_pending_recipients(email, None, result.failed)
+                kwargs['delivered'] = merge_delivered(None, result.result)
+            delay = retry_policy.get_delay(cause, 1)
+            if delay is None:
+                dead_lettered = retry_policy.is_retryable(cause)
+                if dead_lettered:
+                    dead_letter_email(request.id, get_pending_payload(email, request.args[0], kwargs.get('pending')), result,
+                                      get_priority(request.delivery_info))
+                complete_email(request.id, claim, 'delivered' in kwargs and not dead_lettered)
+                if 'delivered' in kwargs:
+                    partial = get_partial_result(email, kwargs['pending'], kwargs['delivered'], cause)
+                    celeryApp.backend.mark_as_done(request.id, encode_delivery_record(email, partial, 1))
+                    notify_email_status(request.id, states.SUCCESS)
+                else:
+                    store_email_exception(request.id, result, 1, states.FAILURE)
+                    notify_email_status(request.id, states.FAILURE)
+                continue
+            # Retry failed emails one at a time under the same task id
+            complete_email(request.id, claim, False)
+            retry_count.inc((type(cause).__name__,))
+            store_email_exception(request.id, result, 1, states.RETRY)
+            notify_email_status(request.id, states.RETRY)
+            send_email.apply_async(request.args, kwargs, task_id=request.id, countdown=delay, retries=1,
+                                   queue=PRIORITY_QUEUES[get_priority(request.delivery_info)])
+        else:
+            complete_email(request.id, claim, True)
+            celeryApp.backend.mark_as_done(request.id, encode_delivery_record(email, result, 1))
+            notify_email_status(request.id, states.SUCCESS)
+
+
+# Emails that exhausted their retries are queued for this task on the dead-letter queue,
+# which no worker consumes by default, so they are kept in the broker. Once the problem is
+# fixed, the emails are delivered by running a worker for the queue
+# (celery worker -A tasks -Q <MAILSERVICE_DEAD_LETTER_QUEUE>), which sends each email again
+# under its email id with a new retry budget in the queue of its priority lane
+@celeryApp.task(name="micromailer.deadLetter")
+def dead_letter(email_id, payload, error, priority=DEFAULT_PRIORITY):
+    logging.info("Replaying dead-lettered email %s that failed with: %s" % (email_id, error))
+    send_email.apply_async([payload], task_id=email_id, queue=PRIORITY_QUEUES.get(priority, MAILSERVICE_TRANSACTIONAL_QUEUE))
+
+
+def dead_letter_email(email_id, payload, exc, priority=DEFAULT_PRIORITY):
+    dead_letter_count.inc((type(exc).__name__,))
+    logging.error("Giving up delivery of email %s: %s" % (email_id, exc))
+    dead_letter.apply_async([email_id, payload, "%s: %s" % (type(exc).__name__, exc), priority],
+                            queue=MAILSERVICE_DEAD_LETTER_QUEUE)
+
+
+def store_email_exception(email_id, exc, attempts, state):
+    result = {'exc_type': type(exc).__name__, 'exc_message': str(exc), 'attempts': attempts}
+    celeryApp.backend.store_result(email_id, result, state)
+
+
+def _status_channel(email_id):
+    return "micromailer.status.%s" % email_id
+
+
+# Publish that the status of an email has changed so long-polling status
+# requests can return. Only supported with the redis result backend
+def notify_email_status(email_id, state):
+    if isinstance(celeryApp.backend, RedisBackend):
+        celeryApp.backend.client.publish(_status_channel(email_id), state)
+
+
+# Subscribe to changes of the status of an email. Returns a redis PubSub
+# object or None if the result backend does not support notifications
+def subscribe_email_status(email_id):
+    if not isinstance(celeryApp.backend, RedisBackend):
+        return None
+    subscription = celeryApp.backend.client.pubsub(ignore_subscribe_messages=True)
+    subscription.subscribe(_status_channel(email_id))
+    return subscription
+
+
+_metrics_server_pid = None
+_metrics_ports = 1
+
+
+# The worker processes serve their metrics on as many ports as the worker has processes
+@celeryd_after_setup.connect
+def set_metrics_ports(instance=None, **kwargs):
+    global _metrics_ports
+    _metrics_ports = instance.concurrency
+
+
+# Serve the metrics of the worker process on the first free port of the ports from
+# MAILSERVICE_METRICS_PORT. Started by the first task run by each process, as the tasks of
+# the prefork pool are run by child processes forked after the worker started. A child that
+# replaces a recycled child takes the port the recycled child freed
+@task_prerun.connect
+def start_metrics_server(**kwargs):
+    global _metrics_server_pid
+    if MAILSERVICE_METRICS_PORT is None or _metrics_server_pid == os.getpid():
+        return
+    _metrics_server_pid = os.getpid()
+    server = metrics.start_process_http_server(MAILSERVICE_METRICS_PORT, _metrics_ports)
+    if server is None:
+        logging.error("No free port to serve metrics on from port %d to %d" % (
+            MAILSERVICE_METRICS_PORT, MAILSERVICE_METRICS_PORT + _metrics_ports - 1))
+        return
+    logging.info("Serving metrics on port %d" % server.server_port)
+
+
+@task_postrun.connect
+def on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    if task.name == send_email.name and state != states.IGNORED:
+        notify_email_status(task_id, state)
 
 
 # Make it easier to run for debugging
@@ -3,13 +3,21 @@
 # Two graphs are outputted:
 #  1) Service failure rate with the score algorithm compared with a simple "select a service at random" strategy
 #  2) The behavior of the service score when there is only a single service
+# Before the graphs, a table comparing the dispatch policies is printed (see compare_policies) and the
+# number of requests to a failing service with and without circuit breaker (see compare_circuit_breaker)
+# To compare other constants of the score algorithm, see score_sweep_simulate.py
 
 import context
+import heapq
+import logging
 import random
-import matplotlib.pyplot as plt
 
-from micromailer.mailservice import BackoffOnFailureMailServiceBase, ServerException
-from micromailer.email import Email
+from micromailer.circuitbreaker import CircuitBreaker
+from micromailer.dispatcher import MailDispatcher
+from micromailer.mailservice import BackoffOnFailureMailServiceBase, ServerException, TooManyRequests, \
+    MailServiceException
+from micromailer.models import Email
+from micromailer.policies import dispatch_policies
 
 
 class MockFailingMailService(BackoffOnFailureMailServiceBase):
@@ -56,6 +64,18 @@ def no_failure(index, time):
     pass
 
 
+# The service responds in 0.4 sec
+def normal_latency(time):
+    return 0.4
+
+
+# The service is up but responds in 1.5 sec for 10 min after 200 sec
+def slow_latency_10min(time):
+    if time > 200 and time < 800:
+        return 1.5
+    return 0.4
+
+
 def get_email():
         return Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
 
@@ -110,6 +130,146 @@ def run_test(callback_a, alternative_base_score=40, disable_alg=False):
     return (x, yA, yB, exceptions, attempts)
 
 
+# Service with the latency given by the latency callback for the time that can handle at
+# most capacity requests at a time and rejects the requests above that with
+# TooManyRequests, like a service rate limit. The latency of the requests is measured on
+# a clock that is advanced by the simulated latency
+class SimulatedMailService(MockFailingMailService):
+
+    def __init__(self, send_callback, base_score, latency_callback, capacity):
+        super(SimulatedMailService, self).__init__(send_callback)
+        self._base_score = base_score
+        self._latency_callback = latency_callback
+        self._capacity = capacity
+        self._completions = []
+        self._time = 0
+        self._clock = 0
+        self.total_latency = 0
+
+    def get_in_flight(self):
+        while len(self._completions) > 0 and self._completions[0] <= self._time:
+            heapq.heappop(self._completions)
+        return len(self._completions)
+
+    def _do_send(self, email):
+        if self.get_in_flight() >= self._capacity:
+            raise TooManyRequests()
+        super(SimulatedMailService, self)._do_send(email)
+        latency = self._latency_callback(self._time)
+        heapq.heappush(self._completions, self._time + latency)
+        self._clock += latency
+        self.total_latency += latency
+
+    def _get_clock(self):
+        return self._clock
+
+
+# Dispatcher running on the simulated time and using the simulated requests in flight
+class SimulatedDispatcher(MailDispatcher):
+
+    def __init__(self, policy):
+        MailDispatcher.__init__(self, policy=policy)
+        self._time = 0
+
+    def get_in_flight(self, service):
+        return service.get_in_flight()
+
+    def _get_time(self):
+        return self._time
+
+
+# Simulate rate msg/s for 1000 sec with a dispatch policy. Service A handles up to 6 requests
+# at a time, with a latency of 0.4 sec (15 msg/s) unless changed by latency_a, and fails
+# by callback_a. Service B handles up to 5 requests of 0.5 sec (10 msg/s), so both
+# services are needed for the default load. An email is attempted at most 3 times. Returns the
+# delivered emails per second, the failure rate and the mean latency of the delivered emails
+def run_policy_test(policy_name, callback_a, latency_a=normal_latency, rate=20, duration=1000):
+    service_A = SimulatedMailService(callback_a, 50, latency_a, 6)
+    service_B = SimulatedMailService(no_failure, 40, lambda t: 0.5, 5)
+    policy = dispatch_policies[policy_name]()
+    if hasattr(policy, '_random'):
+        policy._random.seed(1)
+    dispatcher = SimulatedDispatcher(policy)
+    dispatcher.add_service(service_A)
+    dispatcher.add_service(service_B)
+
+    delivered = 0
+    attempts = 0
+    exceptions = 0
+    email = get_email()
+    for step in range(duration * rate):
+        t = step / float(rate)
+        service_A.set_time(t)
+        service_B.set_time(t)
+        dispatcher._time = t
+        for attempt in range(3):
+            try:
+                attempts = attempts + 1
+                dispatcher.send(email)
+                delivered = delivered + 1
+                break
+            except MailServiceException:
+                exceptions = exceptions + 1
+    mean_latency = (service_A.total_latency + service_B.total_latency) / max(delivered, 1)
+    return delivered / float(duration), exceptions / float(attempts) * 100, mean_latency
+
+
+# Print the throughput, failure rate and latency of every dispatch policy for the failure
+# and latency scenarios
+def compare_policies():
+    random.seed(1)
+    logging.getLogger("mailservice").setLevel(logging.CRITICAL)
+    scenarios = [('No failures', no_failure, normal_latency, 20),
+                 ('10 min complete failure', continous_failure_10min, normal_latency, 20),
+                 ('10 min sporadic failure', sporadic_failure_10min, normal_latency, 20),
+                 ('Random 5% failure', uniform_random_5percentage_error, normal_latency, 20),
+                 ('10 min slow service', no_failure, slow_latency_10min, 20),
+                 ('10 min slow, 3 msg/s', no_failure, slow_latency_10min, 3)]
+    print "%-24s %-22s %-16s %-13s %-12s" % ("Scenario", "Policy", "Delivered msg/s", "Failure rate", "Mean latency")
+    for scenario, callback, latency, rate in scenarios:
+        for policy_name in sorted(dispatch_policies):
+            throughput, failure_rate, mean_latency = run_policy_test(policy_name, callback, latency, rate)
+            print "%-24s %-22s %-16.2f %-13s %.2f s" % (scenario, policy_name, throughput, "%.2f%%" % failure_rate, mean_latency)
+
+
+# Circuit breaker running on the simulated time of the service
+class SimulatedCircuitBreaker(CircuitBreaker):
+
+    def __init__(self, service):
+        super(SimulatedCircuitBreaker, self).__init__()
+        self._service = service
+
+    def _get_time(self):
+        return self._service._time
+
+
+# Simulate 10 msg/s for 30 min with a single service and a 10 min outage. Returns the number
+# of requests made to the service during the outage
+def run_circuit_breaker_test(use_circuit_breaker):
+    requests = [0]
+
+    def callback(index, time):
+        if time > 200 and time < 800:
+            requests[0] += 1
+            raise ServerException()
+
+    service = MockFailingMailService(callback)
+    if use_circuit_breaker:
+        service.set_circuit_breaker(SimulatedCircuitBreaker(service))
+    for t in [v / 10.0 for v in range(0, 18000, 1)]:
+        service.set_time(t)
+        try:
+            service.send(get_email())
+        except MailServiceException:
+            pass
+    return requests[0]
+
+
+def compare_circuit_breaker():
+    print "Requests to a single service during a 10 min outage: %d without and %d with circuit breaker" % (
+        run_circuit_breaker_test(False), run_circuit_breaker_test(True))
+
+
 def plot_data(fig_no, title, result):
     x = result[0]
     yA = result[1]
@@ -127,6 +287,10 @@ def plot_data(fig_no, title, result):
 
 
 if __name__ == '__main__':
+    compare_policies()
+    compare_circuit_breaker()
+
+    import matplotlib.pyplot as plt
 
     # Simulate without algorithm to determine failure rate
     result = run_test(continous_failure_10min, disable_alg=True)
@@ -0,0 +1,199 @@
+import context
+import unittest
+
+from micromailer.models import Email
+from micromailer.circuitbreaker import CircuitBreaker, RedisCircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from micromailer.dispatcher import MailDispatcher
+from micromailer.mailservice import BackoffOnFailureMailServiceBase, ServerException, BadRequest, CircuitOpen
+
+
+class FakeClockCircuitBreaker(CircuitBreaker):
+
+    def __init__(self, **kwargs):
+        super(FakeClockCircuitBreaker, self).__init__(**kwargs)
+        self.now = 1000.0
+
+    def _get_time(self):
+        return self.now
+
+
+class MockScript(object):
+
+    def __init__(self, response):
+        self.response = response
+        self.calls = 0
+
+    def __call__(self, keys, args):
+        self.calls += 1
+        return self.response
+
+
+class MockRedisClient(object):
+
+    def __init__(self):
+        self.allow_script = MockScript(["closed", "0"])
+        self.record_script = MockScript(["closed", "0"])
+
+    def register_script(self, source):
+        return self.allow_script if "max_probes" in source else self.record_script
+
+
+class MockMailService(BackoffOnFailureMailServiceBase):
+
+    def __init__(self, service_score, name):
+        super(MockMailService, self).__init__(service_score)
+        self._name = name
+        self.exception = None
+        self.requests = 0
+
+    def _do_send(self, email):
+        self.requests += 1
+        if self.exception is not None:
+            raise self.exception
+        return {"_service": self._name}
+
+    def get_name(self):
+        return self._name
+
+
+class CircuitBreakerTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = FakeClockCircuitBreaker(failure_threshold=3, window=60, open_timeout=30, max_probes=1)
+
+    def fail(self, count):
+        for i in range(count):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(False)
+
+    def test_opens_on_failures(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+    def test_failures_outside_window(self):
+        self.fail(2)
+        self.breaker.now += 61
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_probe_closes(self):
+        self.fail(3)
+        self.breaker.now += 30
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # Only one probe at a time
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_probe_opens(self):
+        self.fail(3)
+        self.breaker.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_lost_probe(self):
+        self.fail(3)
+        self.breaker.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.now += 30
+        self.assertTrue(self.breaker.allow())
+
+
+class RedisCircuitBreakerTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MockRedisClient()
+        self.breaker = RedisCircuitBreaker(self.client, "breaker", sync_interval=60)
+
+    def test_closed_state_is_cached(self):
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.client.allow_script.calls, 1)
+
+    def test_success_is_not_recorded_when_closed(self):
+        self.breaker.allow()
+        self.breaker.record(True)
+        self.assertEqual(self.client.record_script.calls, 0)
+
+    def test_open_state_is_cached(self):
+        self.client.record_script.response = ["open", repr(self.breaker._get_time() + 30)]
+        self.breaker.allow()
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.client.allow_script.calls, 1)
+
+    def test_probe(self):
+        self.client.allow_script.response = ["probe", repr(self.breaker._get_time() + 30)]
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.is_half_open())
+        self.breaker.record(True)
+        self.assertEqual(self.client.record_script.calls, 1)
+
+
+class ServiceCircuitBreakerTestSuite(unittest.TestCase):
+
+    def get_email(self):
+        return Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+
+    def setUp(self):
+        self.service = MockMailService(50, "prefered")
+        self.service.exception = ServerException()
+        self.service.set_circuit_breaker(CircuitBreaker(failure_threshold=2))
+
+    def test_fail_fast_when_open(self):
+        for i in range(2):
+            self.assertRaises(ServerException, self.service.send, self.get_email())
+        self.assertRaises(CircuitOpen, self.service.send, self.get_email())
+        self.assertEqual(self.service.requests, 2)
+        self.assertFalse(self.service.is_available())
+
+    def test_bad_requests_do_not_open(self):
+        self.service.exception = BadRequest()
+        for i in range(3):
+            self.assertRaises(BadRequest, self.service.send, self.get_email())
+        self.assertTrue(self.service.is_available())
+
+    def test_batch_fails_fast_when_open(self):
+        self.service.send_batch([self.get_email(), self.get_email()])
+        results = self.service.send_batch([self.get_email(), self.get_email()])
+        self.assertIsInstance(results[0], CircuitOpen)
+        self.assertEqual(self.service.requests, 2)
+
+    # A half-open breaker lets a single request of a batch through as the probe
+    def test_batch_sends_single_probe_when_half_open(self):
+        breaker = FakeClockCircuitBreaker(failure_threshold=2)
+        self.service.set_circuit_breaker(breaker)
+        self.service.send_batch([self.get_email(), self.get_email()])
+        breaker.now += 30
+        self.service.exception = None
+
+        results = self.service.send_batch([self.get_email(), self.get_email(), self.get_email()])
+        self.assertEqual(results[0], {"_service": "prefered"})
+        self.assertIsInstance(results[1], CircuitOpen)
+        self.assertIs(results[1], results[2])
+        self.assertEqual(self.service.requests, 3)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_dispatcher_skips_open_service(self):
+        secondary = MockMailService(40, "secondary")
+        dispatcher = MailDispatcher()
+        dispatcher.add_service(self.service)
+        dispatcher.add_service(secondary)
+        for i in range(2):
+            self.assertRaises(ServerException, self.service.send, self.get_email())
+        self.service.reset_score()
+        self.assertEqual(dispatcher.send(self.get_email())["_service"], "secondary")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import context
+import unittest
+import threading
+import time
+import BaseHTTPServer
+from email.utils import formatdate
+
+import requests
+
+from micromailer.connectionpool import PooledSession, get_retry_after
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledSessionTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self._server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._url = "http://127.0.0.1:%d/" % self._server.server_address[1]
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def test_connection_is_reused(self):
+        session = PooledSession(pool_size=1)
+        for i in range(3):
+            response = session.post(self._url, json={"index": i})
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(session.get_connection_stats(), {'new': 1, 'reused': 2})
+        session.close()
+
+    def test_no_requests(self):
+        session = PooledSession()
+        self.assertEqual(session.get_connection_stats(), {'new': 0, 'reused': 0})
+
+
+class RetryAfterTestSuite(unittest.TestCase):
+
+    def get_response(self, retry_after=None):
+        response = requests.Response()
+        if retry_after is not None:
+            response.headers['Retry-After'] = retry_after
+        return response
+
+    def test_seconds(self):
+        self.assertEqual(get_retry_after(self.get_response("120")), 120)
+
+    def test_date(self):
+        retry_after = get_retry_after(self.get_response(formatdate(time.time() + 60, usegmt=True)))
+        self.assertAlmostEqual(retry_after, 60, delta=2)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(get_retry_after(self.get_response()))
+        self.assertIsNone(get_retry_after(self.get_response("soon")))
+
+
+if __name__ == '__main__':
+    unittest.main()
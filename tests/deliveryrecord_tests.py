@@ -0,0 +1,63 @@
+import context
+import unittest
+import json
+
+from micromailer.models import Email
+from micromailer.deliveryrecord import encode_delivery_record, encode_legacy_result, decode_delivery_record, \
+    MAX_MESSAGE_LENGTH
+
+
+class DeliveryRecordTestSuite(unittest.TestCase):
+
+    def get_email(self):
+        email = Email("a@email.com", "sender@email.com", "Subject", "Content")
+        email.add_recipient("b@email.com")
+        return email
+
+    def test_sent(self):
+        result = {"a@email.com": True, "b@email.com": True, "_service": "sendgrid", "_id": "abc123", "_response": ""}
+        record = decode_delivery_record(encode_delivery_record(self.get_email(), result, 2, 1476000000.5))
+        self.assertEqual(record, {'status': "sent", 'service': "sendgrid", 'provider_id': "abc123", 'timestamp': 1476000000,
+                                  'attempts': 2, 'rejected': [], 'message': None})
+
+    def test_partial(self):
+        response = [{"email": "a@email.com", "status": "sent"}, {"email": "b@email.com", "status": "rejected"}]
+        result = {"a@email.com": True, "b@email.com": False, "_service": "mandrill", "_response": response}
+        record = decode_delivery_record(encode_delivery_record(self.get_email(), result, 1))
+        self.assertEqual(record['status'], "partial")
+        self.assertEqual(record['rejected'], [1])
+        self.assertEqual(json.loads(record['message']), response)
+
+    def test_rejected(self):
+        result = {"a@email.com": False, "b@email.com": False, "_service": "mandrill", "_response": "x" * 1000}
+        record = decode_delivery_record(encode_delivery_record(self.get_email(), result, 1))
+        self.assertEqual(record['status'], "rejected")
+        self.assertEqual(record['rejected'], [0, 1])
+        self.assertEqual(len(record['message']), MAX_MESSAGE_LENGTH)
+
+    def test_json_round_trip(self):
+        result = {"a@email.com": True, "b@email.com": True, "_service": "sendgrid"}
+        record = encode_delivery_record(self.get_email(), result, 1)
+        self.assertEqual(decode_delivery_record(json.loads(json.dumps(record))), decode_delivery_record(record))
+
+    def test_legacy_result(self):
+        result = {"a@email.com": True, "_service": "sendgrid", "_id": "abc123", "_response": "", "_attempts": 2}
+        self.assertEqual(decode_delivery_record(encode_legacy_result(result)),
+                         {'status': "sent", 'service': "sendgrid", 'provider_id': "abc123", 'timestamp': None,
+                          'attempts': 2, 'rejected': [], 'message': None})
+
+        # The rejected recipients are indexed in the order of the response
+        response = [{"email": "b@email.com", "status": "sent"}, {"email": "a@email.com", "status": "rejected"}]
+        result = {"a@email.com": False, "b@email.com": True, "_service": "mandrill", "_response": response}
+        record = decode_delivery_record(encode_legacy_result(result))
+        self.assertEqual(record['status'], "partial")
+        self.assertEqual(record['rejected'], [1])
+        self.assertEqual(record['attempts'], 1)
+
+    def test_unsupported_format(self):
+        self.assertRaises(ValueError, decode_delivery_record, {"_service": "sendgrid"})
+        self.assertRaises(ValueError, decode_delivery_record, [99])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# Microbenchmark of the service selection in the mail dispatcher. Measures the time per
+# selection with 1, 8 and 64 threads selecting services at the same time, for the
+# snapshot based selection and for the previous selection that took the dispatcher lock
+# and computed the score of every service for every email.
+#
+# Run with: python dispatcher_benchmark.py [selections per thread]
+
+import context
+import sys
+import time
+import threading
+
+from micromailer.dispatcher import MailDispatcher
+from micromailer.mailservice import BackoffOnFailureMailServiceBase
+
+
+class MockMailService(BackoffOnFailureMailServiceBase):
+
+    def __init__(self, service_score):
+        super(MockMailService, self).__init__(service_score)
+
+    def _do_send(self, email):
+        pass
+
+
+# The selection before the score snapshot
+class LockingMailDispatcher(MailDispatcher):
+
+    def _select_service(self):
+        with self._lock:
+            service = max(self._services, key=lambda x: x.get_service_score())
+            return service, service.get_service_score()
+
+
+def run(dispatcher, threads, selections):
+    def select():
+        for i in xrange(selections):
+            dispatcher._select_service()
+
+    workers = [threading.Thread(target=select) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.time() - start) / (threads * selections)
+
+
+if __name__ == '__main__':
+    selections = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print "%-8s %-14s %-14s" % ("threads", "snapshot", "locking")
+    for threads in [1, 8, 64]:
+        results = []
+        for dispatcher in [MailDispatcher(), LockingMailDispatcher()]:
+            dispatcher.add_service(MockMailService(50))
+            dispatcher.add_service(MockMailService(40))
+            results.append(run(dispatcher, threads, selections))
+        print "%-8d %-14s %-14s" % (threads, "%.2f us" % (results[0] * 1e6), "%.2f us" % (results[1] * 1e6))
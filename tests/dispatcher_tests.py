@@ -0,0 +1,285 @@
+import context
+import unittest
+import time
+
+from micromailer.models import Email
+from micromailer.dispatcher import MailDispatcher, PartialDelivery
+from micromailer.mailservice import BackoffOnFailureMailServiceBase, RateLimited, ServerException, BadRequest, \
+    NetworkException
+from micromailer.ratelimit import TokenBucket
+
+
+class MockMailService(BackoffOnFailureMailServiceBase):
+
+    def __init__(self, service_score, name):
+        super(MockMailService, self).__init__(service_score)
+        self._name = name
+        self.sent = []
+
+    def _do_send(self, email):
+        self.sent.append(email)
+        return {"_service": self.get_name()}
+
+    def get_name(self):
+        return self._name
+
+
+class FailingMailService(MockMailService):
+
+    def __init__(self, service_score, name, exception):
+        super(FailingMailService, self).__init__(service_score, name)
+        self.exception = exception
+
+    def _do_send(self, email):
+        self.sent.append(email)
+        if self.exception is not None:
+            raise self.exception
+        return {"_service": self.get_name()}
+
+
+class SlowMailService(MockMailService):
+
+    def _do_send(self, email):
+        time.sleep(0.5)
+        return {"_service": self.get_name()}
+
+
+class MailDispatcherTestSuite(unittest.TestCase):
+
+    def get_email(self):
+        return Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+
+    def setUp(self):
+        self.prefered = MockMailService(50, "prefered")
+        self.secondary = MockMailService(40, "secondary")
+        self.dispatcher = MailDispatcher()
+        self.dispatcher.add_service(self.secondary)
+        self.dispatcher.add_service(self.prefered)
+
+    def test_send_uses_highest_score(self):
+        result = self.dispatcher.send(self.get_email())
+        self.assertEqual(result["_service"], "prefered")
+
+    def test_send_async(self):
+        result = self.dispatcher.send_async(self.get_email()).result()
+        self.assertEqual(result["_service"], "prefered")
+
+    def test_send_many(self):
+        results = self.dispatcher.send_many([self.get_email(), self.get_email()])
+        self.assertEqual([x["_service"] for x in results], ["prefered", "prefered"])
+        self.assertEqual(len(self.prefered.sent), 2)
+
+    def test_send_many_empty(self):
+        self.assertEqual(self.dispatcher.send_many([]), [])
+
+    def test_health_change_updates_selection(self):
+        self.prefered._update_service_health(False)
+        self.prefered._update_service_health(False)
+        self.prefered._update_service_health(False)
+        self.assertEqual(self.dispatcher.send(self.get_email())["_service"], "secondary")
+
+        self.prefered.reset_score()
+        self.assertEqual(self.dispatcher.send(self.get_email())["_service"], "prefered")
+
+    def test_scores_are_refreshed_periodically(self):
+        self.dispatcher._get_time = lambda: 0
+        self.dispatcher._refresh_scores()
+        self.prefered.get_service_score = lambda: 10
+        self.assertEqual(self.dispatcher.send(self.get_email())["_service"], "prefered")
+
+        self.dispatcher._get_time = lambda: 1
+        self.assertEqual(self.dispatcher.send(self.get_email())["_service"], "secondary")
+
+    def test_saturated_service_is_skipped(self):
+        self.prefered.set_rate_limiter(TokenBucket(0.001, 1), 0)
+        self.assertEqual(self.dispatcher.send(self.get_email())["_service"], "prefered")
+        self.assertTrue(self.prefered.is_saturated())
+        self.assertEqual(self.dispatcher.send(self.get_email())["_service"], "secondary")
+
+    def test_all_services_saturated(self):
+        self.prefered.set_rate_limiter(TokenBucket(0.001, 1), 0)
+        self.secondary.set_rate_limiter(TokenBucket(0.001, 1), 0)
+        self.dispatcher.send(self.get_email())
+        self.dispatcher.send(self.get_email())
+        self.assertRaises(RateLimited, self.dispatcher.send, self.get_email())
+        # Being rate limited by us does not count against the service health
+        self.assertEqual(self.prefered.get_service_score(), 50)
+
+
+class FailoverTestSuite(unittest.TestCase):
+
+    def get_email(self):
+        return Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+
+    def setUp(self):
+        self.prefered = FailingMailService(50, "prefered", ServerException("down"))
+        self.secondary = FailingMailService(40, "secondary", None)
+        self.dispatcher = MailDispatcher(failover=True)
+        self.dispatcher.add_service(self.prefered)
+        self.dispatcher.add_service(self.secondary)
+
+    def test_failover(self):
+        self.assertEqual(self.dispatcher.send(self.get_email())["_service"], "secondary")
+        self.assertEqual(len(self.prefered.sent), 1)
+
+    def test_no_failover_on_bad_request(self):
+        self.prefered.exception = BadRequest("invalid")
+        self.assertRaises(BadRequest, self.dispatcher.send, self.get_email())
+        self.assertEqual(len(self.secondary.sent), 0)
+
+    def test_all_services_fail(self):
+        self.secondary.exception = ServerException("also down")
+        with self.assertRaises(ServerException) as context:
+            self.dispatcher.send(self.get_email())
+        self.assertEqual(context.exception.message, "also down")
+
+    def test_failover_disabled(self):
+        dispatcher = MailDispatcher()
+        dispatcher.add_service(self.prefered)
+        dispatcher.add_service(self.secondary)
+        self.assertRaises(ServerException, dispatcher.send, self.get_email())
+        self.assertEqual(len(self.secondary.sent), 0)
+
+    def test_send_many_fails_over_failed_emails(self):
+        failure = ServerException("down")
+        self.prefered.exception = None
+        self.prefered._do_send_batch = lambda emails: [{"_service": "prefered"}, failure, BadRequest("invalid")]
+        results = self.dispatcher.send_many([self.get_email(), self.get_email(), self.get_email()])
+
+        self.assertEqual(results[0]["_service"], "prefered")
+        self.assertEqual(results[1]["_service"], "secondary")
+        self.assertIsInstance(results[2], BadRequest)
+        self.assertEqual(len(self.secondary.sent), 1)
+
+    def test_attempt_timeout(self):
+        slow = SlowMailService(60, "slow")
+        dispatcher = MailDispatcher(failover=True, attempt_timeout=0.1)
+        dispatcher.add_service(slow)
+        dispatcher.add_service(self.secondary)
+        start = time.time()
+        self.assertEqual(dispatcher.send(self.get_email())["_service"], "secondary")
+        self.assertLess(time.time() - start, 0.4)
+
+    def test_attempt_timeout_without_failover(self):
+        dispatcher = MailDispatcher(attempt_timeout=0.1)
+        dispatcher.add_service(SlowMailService(60, "slow"))
+        self.assertRaises(NetworkException, dispatcher.send, self.get_email())
+
+
+# Service accepting two recipients per request that fails the requests with any
+# of the failing recipients
+class ChunkingMailService(MockMailService):
+
+    max_recipients_per_request = 2
+
+    def __init__(self, service_score, name, delay=0):
+        super(ChunkingMailService, self).__init__(service_score, name)
+        self.failing = {}
+        self._delay = delay
+
+    def _do_send(self, email):
+        time.sleep(self._delay)
+        self.sent.append([x[0] for x in email.to])
+        for recipient in email.to:
+            if recipient[0] in self.failing:
+                raise self.failing[recipient[0]]
+        result = {"_service": self.get_name(), "_id": "id-%s" % email.to[0][0], "_response": "ok"}
+        for recipient in email.to:
+            result[recipient[0]] = True
+        return result
+
+
+class ChunkingTestSuite(unittest.TestCase):
+
+    def get_email(self, recipients=5):
+        email = Email("r0@email.com", "anothervalid@email.com", "Subject", "Content")
+        for i in range(1, recipients):
+            email.add_recipient("r%d@email.com" % i)
+        return email
+
+    def setUp(self):
+        self.prefered = ChunkingMailService(50, "prefered")
+        self.secondary = ChunkingMailService(40, "secondary")
+        self.dispatcher = MailDispatcher(failover=True)
+        self.dispatcher.add_service(self.prefered)
+        self.dispatcher.add_service(self.secondary)
+
+    def test_small_email_is_not_split(self):
+        self.dispatcher.send(self.get_email(2))
+        self.assertEqual(self.prefered.sent, [["r0@email.com", "r1@email.com"]])
+
+    def test_chunks_are_merged(self):
+        result = self.dispatcher.send(self.get_email())
+        self.assertEqual(sorted(self.prefered.sent), [["r0@email.com", "r1@email.com"], ["r2@email.com", "r3@email.com"],
+                                                      ["r4@email.com"]])
+        self.assertEqual(result["_service"], "prefered")
+        self.assertEqual(result["_id"], "id-r0@email.com")
+        self.assertEqual(result["_response"], ["ok", "ok", "ok"])
+        self.assertTrue(all(result["r%d@email.com" % i] for i in range(5)))
+
+    def test_chunks_are_sent_concurrently(self):
+        dispatcher = MailDispatcher()
+        dispatcher.add_service(ChunkingMailService(50, "slow", delay=0.2))
+        start = time.time()
+        dispatcher.send(self.get_email(8))
+        self.assertLess(time.time() - start, 0.6)
+
+    def test_only_failed_chunks_fail_over(self):
+        self.prefered.failing["r2@email.com"] = ServerException("down")
+        result = self.dispatcher.send(self.get_email())
+        self.assertEqual(self.secondary.sent, [["r2@email.com", "r3@email.com"]])
+        self.assertEqual(result["_service"], "prefered")
+        self.assertTrue(result["r3@email.com"])
+
+    def test_partial_delivery(self):
+        self.prefered.failing["r2@email.com"] = ServerException("down")
+        self.secondary.failing["r2@email.com"] = ServerException("also down")
+        with self.assertRaises(PartialDelivery) as context:
+            self.dispatcher.send(self.get_email())
+        self.assertEqual(context.exception.failed, [("r2@email.com", None), ("r3@email.com", None)])
+        self.assertEqual(context.exception.error.message, "also down")
+        self.assertTrue(context.exception.result["r4@email.com"])
+        self.assertNotIn("r2@email.com", context.exception.result)
+
+    def test_bad_request_chunk_does_not_fail_over(self):
+        self.prefered.failing["r2@email.com"] = BadRequest("invalid")
+        with self.assertRaises(PartialDelivery) as context:
+            self.dispatcher.send(self.get_email())
+        self.assertIsInstance(context.exception.error, BadRequest)
+        self.assertEqual(self.secondary.sent, [])
+
+    def test_all_chunks_fail(self):
+        self.prefered.failing["r0@email.com"] = self.secondary.failing["r0@email.com"] = ServerException("down")
+        self.assertRaises(ServerException, self.dispatcher.send, self.get_email(2))
+        self.prefered.failing["r2@email.com"] = self.secondary.failing["r2@email.com"] = ServerException("down")
+        self.assertRaises(ServerException, self.dispatcher.send, self.get_email(4))
+
+    def test_send_many_splits_large_emails(self):
+        results = self.dispatcher.send_many([self.get_email(1), self.get_email()])
+        self.assertTrue(results[1]["r4@email.com"])
+        self.assertEqual(len(self.prefered.sent), 4)
+
+    def test_send_async_splits_large_emails(self):
+        dispatcher = MailDispatcher(attempt_timeout=1)
+        dispatcher.add_service(self.prefered)
+        result = dispatcher.send_async(self.get_email()).result(1)
+        self.assertEqual(len(self.prefered.sent), 3)
+        self.assertTrue(all(result["r%d@email.com" % i] for i in range(5)))
+
+    # An email that fits the first service is split for a service it fails over to
+    def test_limit_of_failover_service(self):
+        self.prefered.max_recipients_per_request = None
+        self.prefered.failing["r0@email.com"] = ServerException("down")
+        result = self.dispatcher.send(self.get_email(3))
+        self.assertEqual(self.prefered.sent, [["r0@email.com", "r1@email.com", "r2@email.com"]])
+        self.assertEqual(sorted(self.secondary.sent), [["r0@email.com", "r1@email.com"], ["r2@email.com"]])
+        self.assertEqual(result["_service"], "secondary")
+
+        self.secondary.sent = []
+        results = self.dispatcher.send_many([self.get_email(1), self.get_email(3)])
+        self.assertEqual(results[1]["_service"], "secondary")
+        self.assertEqual(sorted(self.secondary.sent), [["r0@email.com"], ["r0@email.com", "r1@email.com"], ["r2@email.com"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 import context
 import unittest
+import json
+import mock
 
 from micromailer import models
 
@@ -32,6 +34,86 @@ class EmailTestSuite(unittest.TestCase):
         e.add_recipient("anotheremail@valid.com", "With name")
         self.assertIn("anotheremail@valid.com", [x[0] for x in e.to], "Second receiver not added correctly")
 
+    def test_add_invalid_recipient(self):
+        e = models.Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+        with self.assertRaises(models.InvalidEmailArgument):
+            e.add_recipient("invalid")
+        self.assertEqual(len(e.to), 1)
+
+    def test_add_recipients(self):
+        e = models.Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+        e.add_recipients([("a@valid.com", None), ["b@valid.com", "B"]])
+        self.assertEqual(e.to, [("valid@email.com", None), ("a@valid.com", None), ("b@valid.com", "B")])
+        with self.assertRaises(models.InvalidEmailArgument):
+            e.add_recipients([("c@valid.com", None), ("invalid", None)])
+        self.assertEqual(len(e.to), 3)
+
+    def test_validate_recipients(self):
+        models.validate_recipients(["a@valid.com", u"b@valid.com"])
+        models.validate_recipients([])
+        for addresses in [["a@valid.com", "invalid"], ["a@valid.com", None], ["a@valid.com\nb@valid.com"],
+                          ["a@valid.com", 1], ["a@valid.com", ""]]:
+            with self.assertRaises(models.InvalidEmailArgument):
+                models.validate_recipients(addresses)
+        with self.assertRaisesRegexp(models.InvalidEmailArgument, "'invalid'"):
+            models.validate_recipients(["a@valid.com", "invalid", "b@valid.com"])
+
+    # Non-ASCII byte strings can not be joined with unicode addresses
+    def test_validate_mixed_str_and_unicode_recipients(self):
+        with self.assertRaises(models.InvalidEmailArgument):
+            models.validate_recipients([u"a@valid.com", "caf\xc3\xa9@valid.com"])
+        e = models.Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+        with self.assertRaises(models.InvalidEmailArgument):
+            e.add_recipients([(u"b@valid.com", None), ("\xc3@valid.com", None)])
+        self.assertEqual(len(e.to), 1)
+
+    def test_validated_once(self):
+        e = models.Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+        with mock.patch.object(models, 'validate_recipients') as validate:
+            self.assertTrue(e.is_valid())
+            self.assertFalse(validate.called)
+
+    def test_no_instance_dict(self):
+        e = models.Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+        with self.assertRaises(AttributeError):
+            e.unknown_field = True
+
+    def test_wire_format_roundtrip(self):
+        e = models.Email("valid@email.com", "anothervalid@email.com", "Subject", "Content",
+                         content_type="text/html", sender_name="Sender")
+        e.add_recipient("anotheremail@valid.com", "With name")
+
+        # The payload is sent as JSON which turns tuples into lists and strings into unicode
+        payload = json.loads(json.dumps(models.encode_email(e)))
+        decoded = models.decode_email(payload)
+
+        self.assertEqual(payload[0], models.EMAIL_WIRE_VERSION)
+        self.assertEqual(decoded.to, [("valid@email.com", None), ("anotheremail@valid.com", "With name")])
+        self.assertEqual(decoded.sender, e.sender)
+        self.assertEqual(decoded.sender_name, e.sender_name)
+        self.assertEqual(decoded.subject, e.subject)
+        self.assertEqual(decoded.content, e.content)
+        self.assertEqual(decoded.content_type, e.content_type)
+
+    def test_wire_format_unknown_version(self):
+        e = models.Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+        payload = models.encode_email(e)
+        payload[0] = models.EMAIL_WIRE_VERSION + 1
+        with self.assertRaises(models.InvalidEmailArgument):
+            models.decode_email(payload)
+
+    def test_wire_format_malformed(self):
+        with self.assertRaises(models.InvalidEmailArgument):
+            models.decode_email([models.EMAIL_WIRE_VERSION, [], "anothervalid@email.com"])
+        with self.assertRaises(models.InvalidEmailArgument):
+            models.decode_email([models.EMAIL_WIRE_VERSION, [["invalid", None]], "anothervalid@email.com",
+                                 None, "Subject", "Content", "text/plain", None, None])
+
+    def test_wire_format_version_1(self):
+        e = models.decode_email([1, [["valid@email.com", None]], "anothervalid@email.com",
+                                 None, "Subject", "Content", "text/plain"])
+        self.assertEqual(e.content, "Content")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,226 @@
+# Local stand-in for the mail services used by the benchmarks. Speaks the SendGrid v3
+# (POST /v3/mail/send) and Mandrill (POST /api/1.0/messages/send.json) protocols well
+# enough for micromailer, without delivering anything. The latency of the responses,
+# the rate of server errors, periodic bursts of errors and a rate limit can be configured
+# to see how micromailer behaves when the services are slow or fail.
+#
+# GET /_stats returns the number of requests by status code, the number of emails
+# accepted, and the time each email was received by its subject, so a benchmark can
+# measure the end-to-end latency. DELETE /_stats resets them.
+#
+# Run with: python fake_provider.py [--port 8025] [--latency 50] [--latency-dist lognormal]
+#               [--error-rate 0.01] [--burst-every 60 --burst-length 5 --burst-status 429]
+#               [--rate-limit 500]
+# and point micromailer at it with SENDGRID_API_URL=http://localhost:8025/v3/mail/send
+# and MANDRILL_API_URL=http://localhost:8025/api/1.0/messages/send.json
+
+import context
+import argparse
+import BaseHTTPServer
+import SocketServer
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+from micromailer.ratelimit import TokenBucket
+
+SENDGRID_PATH = "/v3/mail/send"
+MANDRILL_PATH = "/api/1.0/messages/send.json"
+
+
+# Behaviour of the fake provider. latency is the mean latency of a response in
+# seconds, drawn from the latency_dist distribution: constant, exponential or
+# lognormal (with a sigma of latency_sigma). error_rate is the fraction of
+# requests failing with a 500. Every burst_every seconds, all requests fail
+# with burst_status for burst_length seconds. With a rate_limit, emails above
+# that many per second are rejected with 429 and a Retry-After header
+class ProviderBehaviour(object):
+
+    def __init__(self, latency=0.05, latency_dist="constant", latency_sigma=0.5, error_rate=0, burst_every=None,
+                 burst_length=0, burst_status=429, rate_limit=None, rand=None):
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.burst_status = burst_status
+        self._rate_limiter = TokenBucket(rate_limit, max(1, int(rate_limit))) if rate_limit else None
+        self._random = rand or random.Random()
+        self._start = time.time()
+
+    def get_latency(self):
+        if self.latency_dist == "exponential":
+            return self._random.expovariate(1.0 / self.latency) if self.latency > 0 else 0
+        if self.latency_dist == "lognormal":
+            # The mean of a lognormal distribution is exp(mu + sigma^2 / 2)
+            mu = math.log(self.latency) - self.latency_sigma ** 2 / 2 if self.latency > 0 else 0
+            return self._random.lognormvariate(mu, self.latency_sigma) if self.latency > 0 else 0
+        return self.latency
+
+    # Return the status code to fail a request for count emails with, or None
+    # if the request succeeds
+    def get_failure(self, count):
+        if self.burst_every and (time.time() - self._start) % self.burst_every < self.burst_length:
+            return self.burst_status
+        if self._random.random() < self.error_rate:
+            return 500
+        if self._rate_limiter is not None and self._rate_limiter.try_acquire(count) > 0:
+            return 429
+        return None
+
+
+class FakeProviderStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statuses = {}
+            self.emails = 0
+            self.received = {}
+
+    def record(self, status, subjects):
+        now = time.time()
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status < 300:
+                self.emails += len(subjects)
+                for subject in subjects:
+                    self.received.setdefault(subject, now)
+
+    def to_json(self):
+        with self._lock:
+            return json.dumps({"statuses": self.statuses, "emails": self.emails, "received": self.received})
+
+
+class FakeProviderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/_stats":
+            return self._respond(404, "")
+        self._respond(200, self.server.stats.to_json(), "application/json")
+
+    def do_DELETE(self):
+        if self.path != "/_stats":
+            return self._respond(404, "")
+        self.server.stats.reset()
+        self._respond(200, "{}", "application/json")
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            return self._respond(400, '{"errors": [{"message": "Invalid JSON"}]}', "application/json")
+        if self.path == SENDGRID_PATH:
+            self._sendgrid(body)
+        elif self.path == MANDRILL_PATH:
+            self._mandrill(body)
+        else:
+            self._respond(404, "")
+
+    def _sendgrid(self, body):
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self._respond(401, '{"errors": [{"message": "Missing API key"}]}', "application/json")
+        personalizations = body.get("personalizations", [])
+        if len(personalizations) == 0 or len(personalizations) > 1000:
+            return self._respond(400, '{"errors": [{"message": "Invalid personalizations"}]}', "application/json")
+        subjects = [body.get("subject") for x in personalizations]
+        if self._fail(len(subjects), subjects):
+            return
+        self.server.stats.record(202, subjects)
+        self._respond(202, "", headers={"X-Message-Id": uuid.uuid4().hex[:22]})
+
+    def _mandrill(self, body):
+        if not body.get("key"):
+            return self._respond(500, '{"status": "error", "name": "Invalid_Key"}', "application/json")
+        recipients = body.get("message", {}).get("to", [])
+        subjects = [body["message"].get("subject") for x in recipients]
+        if self._fail(len(subjects), subjects):
+            return
+        self.server.stats.record(200, subjects)
+        self._respond(200, json.dumps([{"email": x["email"], "status": "sent", "_id": uuid.uuid4().hex,
+                                        "reject_reason": None} for x in recipients]), "application/json")
+
+    # Wait for the latency of the response and respond with an error if the
+    # request fails. Returns True if it failed
+    def _fail(self, count, subjects):
+        time.sleep(self.server.behaviour.get_latency())
+        status = self.server.behaviour.get_failure(count)
+        if status is None:
+            return False
+        self.server.stats.record(status, subjects)
+        self._respond(status, '{"errors": [{"message": "Fake failure"}]}', "application/json",
+                      {"Retry-After": "1"} if status == 429 else None)
+        return True
+
+    def _respond(self, status, body, content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProviderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, behaviour):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeProviderHandler)
+        self.behaviour = behaviour
+        self.stats = FakeProviderStats()
+
+    def get_url(self, path):
+        return "http://%s:%d%s" % (self.server_address[0], self.server_address[1], path)
+
+
+# Start a fake provider serving from a daemon thread. Returns the server
+def start_fake_provider(behaviour=None, host="127.0.0.1", port=0):
+    server = FakeProviderServer((host, port), behaviour or ProviderBehaviour())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+def add_behaviour_arguments(parser):
+    parser.add_argument("--latency", type=float, default=50, help="Mean latency of the responses in ms")
+    parser.add_argument("--latency-dist", choices=["constant", "exponential", "lognormal"], default="constant")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Sigma of the lognormal latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests failing with 500")
+    parser.add_argument("--burst-every", type=float, default=None, help="Seconds between bursts of errors")
+    parser.add_argument("--burst-length", type=float, default=0, help="Seconds a burst of errors lasts")
+    parser.add_argument("--burst-status", type=int, default=429, help="Status code of the errors of a burst")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Emails per second accepted")
+
+
+def create_behaviour(args):
+    return ProviderBehaviour(args.latency / 1000.0, args.latency_dist, args.latency_sigma, args.error_rate,
+                             args.burst_every, args.burst_length, args.burst_status, args.rate_limit)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake SendGrid and Mandrill API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025)
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeProviderServer((args.host, args.port), create_behaviour(args))
+    print "Serving SendGrid on %s" % server.get_url(SENDGRID_PATH)
+    print "Serving Mandrill on %s" % server.get_url(MANDRILL_PATH)
+    server.serve_forever()
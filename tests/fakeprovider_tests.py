@@ -0,0 +1,81 @@
+import context
+import unittest
+import json
+import urllib2
+
+from fake_provider import ProviderBehaviour, start_fake_provider, SENDGRID_PATH, MANDRILL_PATH
+from micromailer.models import Email
+from micromailer.sendgrid import SendGridMailService
+from micromailer.mandrill import MandrillMailService
+from micromailer import mailservice
+
+
+class FakeProviderTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.behaviour = ProviderBehaviour(latency=0)
+        self.server = start_fake_provider(self.behaviour)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_email(self, subject="Subject"):
+        email = Email("valid@email.com", "anothervalid@email.com", subject, "Content")
+        email.add_recipient("other@email.com")
+        return email
+
+    def get_stats(self):
+        return json.loads(urllib2.urlopen(self.server.get_url("/_stats")).read())
+
+    def test_sendgrid(self):
+        service = SendGridMailService("api", url=self.server.get_url(SENDGRID_PATH))
+        result = service.send(self.get_email("sendgrid"))
+        self.assertEqual(result['_service'], "sendgrid")
+        self.assertTrue(result['_id'])
+
+        stats = self.get_stats()
+        self.assertEqual(stats["statuses"], {"202": 1})
+        self.assertEqual(stats["emails"], 2)
+        self.assertIn("sendgrid", stats["received"])
+
+    def test_mandrill(self):
+        service = MandrillMailService("api", url=self.server.get_url(MANDRILL_PATH))
+        result = service.send(self.get_email("mandrill"))
+        self.assertEqual(result['_service'], "mandrill")
+        self.assertTrue(result['valid@email.com'])
+        self.assertTrue(result['other@email.com'])
+        self.assertEqual(self.get_stats()["statuses"], {"200": 1})
+
+    def test_errors(self):
+        self.behaviour.error_rate = 1
+        service = SendGridMailService("api", url=self.server.get_url(SENDGRID_PATH))
+        self.assertRaises(mailservice.ServerException, service.send, self.get_email())
+        self.assertEqual(self.get_stats(), {"statuses": {"500": 1}, "emails": 0, "received": {}})
+
+    def test_burst(self):
+        self.behaviour.burst_every = 60
+        self.behaviour.burst_length = 60
+        self.behaviour.burst_status = 419
+        service = SendGridMailService("api", url=self.server.get_url(SENDGRID_PATH))
+        self.assertRaises(mailservice.TooManyRequests, service.send, self.get_email())
+
+    def test_rate_limit(self):
+        self.server.behaviour = ProviderBehaviour(latency=0, rate_limit=2)
+        service = MandrillMailService("api", url=self.server.get_url(MANDRILL_PATH))
+        service.send(self.get_email())
+        with self.assertRaises(mailservice.TooManyRequests) as context:
+            service.send(self.get_email())
+        self.assertEqual(context.exception.retry_after, 1)
+
+    def test_reset_stats(self):
+        service = SendGridMailService("api", url=self.server.get_url(SENDGRID_PATH))
+        service.send(self.get_email())
+        request = urllib2.Request(self.server.get_url("/_stats"))
+        request.get_method = lambda: "DELETE"
+        urllib2.urlopen(request).read()
+        self.assertEqual(self.get_stats(), {"statuses": {}, "emails": 0, "received": {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import context
+import unittest
+
+from micromailer.idempotency import IdempotencyStore, RedisIdempotencyStore, DeliveryInProgress, DELIVERED
+
+
+class FakeClockIdempotencyStore(IdempotencyStore):
+
+    def __init__(self, ttl, claim_ttl):
+        super(FakeClockIdempotencyStore, self).__init__(ttl, claim_ttl)
+        self.now = 1000.0
+
+    def _get_time(self):
+        return self.now
+
+
+class MockScript(object):
+
+    def __init__(self, response=None):
+        self.response = response
+        self.calls = []
+
+    def __call__(self, keys, args):
+        self.calls.append((keys, args))
+        return self.response
+
+
+class MockRedisClient(object):
+
+    def __init__(self):
+        self.claim_script = MockScript()
+        self.release_script = MockScript()
+        self.values = {}
+
+    def register_script(self, source):
+        return self.claim_script if "PTTL" in source else self.release_script
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value, ex)
+
+
+class IdempotencyStoreTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeClockIdempotencyStore(ttl=100, claim_ttl=10)
+
+    def test_claim(self):
+        self.assertIsNotNone(self.store.claim("email"))
+        self.assertIsNotNone(self.store.claim("other"))
+
+    def test_delivered(self):
+        self.store.claim("email")
+        self.store.complete("email")
+        self.assertIsNone(self.store.claim("email"))
+
+    def test_in_progress(self):
+        self.store.claim("email")
+        self.store.now += 4
+        with self.assertRaises(DeliveryInProgress) as context:
+            self.store.claim("email")
+        self.assertEqual(context.exception.retry_after, 6)
+
+    def test_release(self):
+        claim = self.store.claim("email")
+        self.store.release("email", claim)
+        self.assertIsNotNone(self.store.claim("email"))
+
+    def test_release_of_expired_claim(self):
+        claim = self.store.claim("email")
+        self.store.now += 10
+        self.store.claim("email")
+        # The claim of the other worker is kept
+        self.store.release("email", claim)
+        self.assertRaises(DeliveryInProgress, self.store.claim, "email")
+
+    def test_expiry(self):
+        self.store.claim("email")
+        self.store.complete("email")
+        self.store.now += 100
+        self.assertIsNotNone(self.store.claim("email"))
+
+    def test_expired_keys_are_removed(self):
+        for i in range(100):
+            self.store.claim("email%d" % i)
+        self.store.now += 10
+        self.store.claim("email")
+        self.assertEqual(len(self.store._keys), 1)
+
+
+class RedisIdempotencyStoreTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MockRedisClient()
+        self.store = RedisIdempotencyStore(self.client, prefix="delivery.", ttl=100, claim_ttl=10)
+
+    def test_claim(self):
+        claim = self.store.claim("email")
+        self.assertEqual(self.client.claim_script.calls, [(["delivery.email"], [claim, 10000])])
+
+    def test_delivered(self):
+        self.client.claim_script.response = [DELIVERED, "90000"]
+        self.assertIsNone(self.store.claim("email"))
+
+    def test_in_progress(self):
+        self.client.claim_script.response = ["a-claim", "2500"]
+        with self.assertRaises(DeliveryInProgress) as context:
+            self.store.claim("email")
+        self.assertEqual(context.exception.retry_after, 2.5)
+
+    def test_complete_and_release(self):
+        self.store.complete("email")
+        self.assertEqual(self.client.values["delivery.email"], (DELIVERED, 100))
+        self.store.release("email", "a-claim")
+        self.assertEqual(self.client.release_script.calls, [(["delivery.email"], ["a-claim"])])
+
+
+if __name__ == '__main__':
+    unittest.main()
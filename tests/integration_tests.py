@@ -7,13 +7,19 @@ import unittest
 import time
 import json
 import threading
+import mock
+import urllib2
 
 from celery.bin import worker
 from celery.signals import worker_ready
 
 import tasks
 import webservice
-from micromailer import mailservice
+from micromailer import mailservice, metrics
+from micromailer.models import Email, encode_email
+from micromailer.dispatcher import MailDispatcher
+from micromailer.retrypolicy import RetryPolicy
+from micromailer.tracing import tracer, ListExporter
 
 
 class FakeMailService(mailservice.BackoffOnFailureMailServiceBase):
@@ -22,10 +28,22 @@ class FakeMailService(mailservice.BackoffOnFailureMailServiceBase):
         super(FakeMailService, self).__init__(service_score)
         self._name = name
         self._should_fail = False
+        self._exception = None
+        self.failing_recipients = set()
+        self.failing_exception = mailservice.ServerException("Fake failure")
+        self.sent = 0
+        self.recipients = []
 
     def _do_send(self, email):
+        self.last_email = email
+        self.sent += 1
+        self.recipients.append([x[0] for x in email.to])
+        if self._exception is not None:
+            raise self._exception
         if self._should_fail:
             raise mailservice.ServerException("Fake failure")
+        if any(x[0] in self.failing_recipients for x in email.to):
+            raise self.failing_exception
         return {"status": "success", "_service": self.get_name()}
 
     def get_name(self):
@@ -33,12 +51,15 @@ class FakeMailService(mailservice.BackoffOnFailureMailServiceBase):
 
 
 # Use fake mail services for integration tests
-tasks.dispatcher._services = []
+tasks.dispatcher = MailDispatcher(failover=True)
 prefered_service = FakeMailService(50, "prefered")  # Prefered service
 secondary_service = FakeMailService(49, "secondary")
 tasks.dispatcher.add_service(secondary_service)
 tasks.dispatcher.add_service(prefered_service)
 
+# Retry after 3 sec without jitter
+tasks.retry_policy = RetryPolicy(base_delay=3, jitter=False)
+
 
 class IntegrationTests(unittest.TestCase):
 
@@ -69,8 +90,27 @@ class IntegrationTests(unittest.TestCase):
         # Reset the services to avoid interference between tests
         prefered_service.reset_score()
         prefered_service._should_fail = False
+        prefered_service._exception = None
+        prefered_service.failing_recipients = set()
+        prefered_service.failing_exception = mailservice.ServerException("Fake failure")
+        prefered_service.max_recipients_per_request = None
         secondary_service.reset_score()
         secondary_service._should_fail = False
+        secondary_service._exception = None
+        secondary_service.failing_recipients = set()
+        secondary_service.failing_exception = mailservice.ServerException("Fake failure")
+        secondary_service.max_recipients_per_request = None
+        tasks.retry_policy.max_attempts = 10
+
+    # Poll the status until the email is no longer queued or retrying
+    def _get_final_status(self, web_app, email_id, timeout=5):
+        timeout_at = time.time() + timeout
+        while True:
+            result = web_app.get("/email/%s" % email_id)
+            result_json = json.loads(result.get_data())
+            if result_json["status"] not in ["queued", "retrying"] or time.time() > timeout_at:
+                return result, result_json
+            time.sleep(0.1)
 
     def _wait_for_worker(self):
         timeout_at = time.time() + 30
@@ -88,11 +128,275 @@ class IntegrationTests(unittest.TestCase):
         assert resp.status_code == 200
 
         # Get the result
-        result = web_app.get("/email/%s" % json.loads(resp.get_data())["emailId"])
-        result_json = json.loads(result.get_data())
+        result, result_json = self._get_final_status(web_app, json.loads(resp.get_data())["emailId"])
         assert result.status_code == 200
         assert result_json["status"] == "success"
-        assert result_json["result"]["_service"] == "prefered"
+        assert result_json["attempts"] == 1
+        assert result_json["result"]["service"] == "prefered"
+        assert result_json["result"]["delivery"] == "sent"
+        assert result_json["result"]["rejected"] == []
+
+    # Test that an email redelivered under the same email id is only sent once
+    def test_duplicate_email(self):
+        web_app = webservice.app.test_client()
+
+        payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Integration testing",
+                   "idempotency_key": "integration-duplicate-%s" % time.time()}
+        email_id = json.loads(web_app.post("/email", data=payload).get_data())["emailId"]
+        result, result_json = self._get_final_status(web_app, email_id)
+        assert result_json["status"] == "success"
+        sent = prefered_service.sent
+
+        # Adding the email again returns the same email id and the email is not sent again
+        assert json.loads(web_app.post("/email", data=payload).get_data())["emailId"] == email_id
+        time.sleep(1)
+        assert prefered_service.sent == sent
+        result, result_json = self._get_final_status(web_app, email_id)
+        assert result_json["status"] == "success"
+        assert result_json["attempts"] == 1
+
+    # Test that only the chunks of recipients that failed are sent again
+    def test_retry_failed_chunks(self):
+        web_app = webservice.app.test_client()
+        prefered_service.max_recipients_per_request = 2
+        secondary_service.max_recipients_per_request = 2
+        prefered_service.failing_recipients = secondary_service.failing_recipients = set(["c@example.com"])
+
+        email = Email("a@example.com", "no-reply@example.com", "Test", "Chunked")
+        for recipient in ["b@example.com", "c@example.com", "d@example.com", "e@example.com"]:
+            email.add_recipient(recipient)
+        email_id = tasks.send_email.apply_async([encode_email(email)]).id
+        timeout_at = time.time() + 5
+        while json.loads(web_app.get("/email/%s" % email_id).get_data())["status"] != "retrying":
+            assert time.time() < timeout_at
+            time.sleep(0.1)
+        assert ["c@example.com", "d@example.com"] in secondary_service.recipients
+
+        prefered_service.recipients = []
+        prefered_service.failing_recipients = secondary_service.failing_recipients = set()
+        result, result_json = self._get_final_status(web_app, email_id, timeout=10)
+        assert result_json["status"] == "success"
+        assert result_json["attempts"] == 2
+        assert result_json["result"]["delivery"] == "sent"
+        assert prefered_service.recipients == [["c@example.com", "d@example.com"]]
+
+    # Test that an email of which a chunk of recipients is rejected is reported as partly
+    # delivered, and that only the pending recipients are dead-lettered when it is given up on
+    def test_partly_delivered_email(self):
+        web_app = webservice.app.test_client()
+        prefered_service.max_recipients_per_request = 2
+        secondary_service.max_recipients_per_request = 2
+        prefered_service.failing_recipients = set(["c@example.com"])
+        prefered_service.failing_exception = mailservice.BadRequest("Fake bad request")
+
+        email = Email("a@example.com", "no-reply@example.com", "Test", "Chunked")
+        for recipient in ["b@example.com", "c@example.com", "d@example.com", "e@example.com"]:
+            email.add_recipient(recipient)
+        email_id = tasks.send_email.apply_async([encode_email(email)]).id
+        result, result_json = self._get_final_status(web_app, email_id)
+        assert result_json["status"] == "success"
+        assert result_json["attempts"] == 1
+        assert result_json["result"]["delivery"] == "partial"
+        assert result_json["result"]["rejected"] == [2, 3]
+        assert result_json["result"]["message"] == "BadRequest: Fake bad request"
+
+        tasks.retry_policy.max_attempts = 1
+        prefered_service.failing_exception = mailservice.ServerException("Fake failure")
+        secondary_service.failing_recipients = set(["c@example.com"])
+        with mock.patch.object(tasks.dead_letter, 'apply_async') as dead_letter:
+            email_id = tasks.send_email.apply_async([encode_email(email)]).id
+            result, result_json = self._get_final_status(web_app, email_id)
+        assert result_json["result"]["delivery"] == "partial"
+        assert result_json["result"]["rejected"] == [2, 3]
+        args, kwargs = dead_letter.call_args
+        assert args[0][0] == email_id
+        assert [x[0] for x in args[0][1][1]] == ["c@example.com", "d@example.com"]
+
+        # The same with the batching consumer
+        secondary_service.failing_recipients = set()
+        prefered_service.failing_exception = mailservice.BadRequest("Fake bad request")
+        email_id = tasks.send_email_batch.apply_async([encode_email(email)]).id
+        result, result_json = self._get_final_status(web_app, email_id)
+        assert result_json["result"]["delivery"] == "partial"
+        assert result_json["result"]["rejected"] == [2, 3]
+
+    def test_batch_email(self):
+        web_app = webservice.app.test_client()
+        webservice.email_task = tasks.send_email_batch
+        try:
+            email_ids = []
+            for priority in ["transactional", "bulk", "transactional"]:
+                payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Batch testing",
+                           "priority": priority}
+                resp = web_app.post("/email", data=payload)
+                assert resp.status_code == 200
+                email_ids.append(json.loads(resp.get_data())["emailId"])
+        finally:
+            webservice.email_task = tasks.send_email
+
+        # Every email of the batch has its own result
+        for email_id in email_ids:
+            result, result_json = self._get_final_status(web_app, email_id)
+            assert result_json["status"] == "success"
+            assert result_json["result"]["service"] == "prefered"
+
+    def test_render_in_worker(self):
+        web_app = webservice.app.test_client()
+
+        payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Rendered *by* the worker"}
+        with mock.patch('webservice.MAILSERVICE_RENDER_IN_WORKER', True):
+            resp = web_app.post("/email", data=payload)
+        assert resp.status_code == 200
+
+        result, result_json = self._get_final_status(web_app, json.loads(resp.get_data())["emailId"])
+        assert result_json["status"] == "success"
+        assert prefered_service.last_email.content_type == "text/html"
+        assert prefered_service.last_email.content == "<p>Rendered <em>by</em> the worker</p>"
+
+    def test_template_email(self):
+        web_app = webservice.app.test_client()
+
+        template = {"subject": "Welcome {{name}}", "content": "Hello *{{name}}*"}
+        resp = web_app.put("/template/integration-welcome", data=json.dumps(template), content_type="application/json")
+        assert resp.status_code in [200, 201]
+        assert json.loads(resp.get_data())["variables"] == ["name"]
+
+        resp = web_app.put("/template/integration-welcome", data=json.dumps({"subject": "Other", "content": "Other"}),
+                           content_type="application/json")
+        assert resp.status_code == 409
+
+        payload = {"to": "martinslothdam@gmail.com", "template_id": "integration-welcome", "variables": {"name": "<Martin>"}}
+        resp = web_app.post("/email", data=json.dumps(payload), content_type="application/json")
+        assert resp.status_code == 200
+
+        result, result_json = self._get_final_status(web_app, json.loads(resp.get_data())["emailId"])
+        assert result_json["status"] == "success"
+        assert prefered_service.last_email.subject == "Welcome <Martin>"
+        assert prefered_service.last_email.content == "<p>Hello <em>&lt;Martin&gt;</em></p>"
+
+        # Missing variables and unknown templates are rejected before the email is queued
+        payload = {"to": "martinslothdam@gmail.com", "template_id": "integration-welcome", "variables": {}}
+        assert web_app.post("/email", data=json.dumps(payload), content_type="application/json").status_code == 400
+        payload = {"to": "martinslothdam@gmail.com", "template_id": "unknown"}
+        assert web_app.post("/email", data=json.dumps(payload), content_type="application/json").status_code == 400
+
+    def test_batch_endpoint(self):
+        web_app = webservice.app.test_client()
+
+        payload = [{"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Batch endpoint"},
+                   {"to": "invalid", "subject": "Test", "content": "Batch endpoint"},
+                   {"to": "martinslothdam@gmail.com", "content": "Batch endpoint"},
+                   {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Batch endpoint", "to_name": "Martin"}]
+        resp = web_app.post("/email/batch", data=json.dumps(payload), content_type="application/json")
+        assert resp.status_code == 200
+
+        emails = json.loads(resp.get_data())["emails"]
+        assert [x["status"] for x in emails] == ["queued", "failed", "failed", "queued"]
+        assert emails[2]["error"] == "Missing field 'subject'"
+        for email in [emails[0], emails[3]]:
+            result, result_json = self._get_final_status(web_app, email["emailId"])
+            assert result_json["status"] == "success"
+
+    # Test that emails are delivered from the queue of their priority lane and the time
+    # they waited is measured per lane
+    def test_priority_lanes(self):
+        web_app = webservice.app.test_client()
+        waits = dict((x, tasks.queue_wait.get_count((x,))) for x in ["transactional", "bulk"])
+
+        for priority in ["bulk", "transactional"]:
+            payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Lane", "priority": priority}
+            resp = web_app.post("/email", data=payload)
+            assert resp.status_code == 200
+            result, result_json = self._get_final_status(web_app, json.loads(resp.get_data())["emailId"])
+            assert result_json["status"] == "success"
+            assert tasks.queue_wait.get_count((priority,)) == waits[priority] + 1
+        assert 'micromailer_queue_wait_seconds_count{priority="bulk"}' in metrics.registry.format()
+
+        payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Lane", "priority": "urgent"}
+        resp = web_app.post("/email", data=payload)
+        assert resp.status_code == 400
+        assert json.loads(resp.get_data())["error"] == "Priority has to be transactional or bulk"
+
+        payload = [{"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Lane", "priority": "bulk"},
+                   {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Lane", "priority": ["bulk"]}]
+        resp = web_app.post("/email/batch", data=json.dumps(payload), content_type="application/json")
+        assert [x["status"] for x in json.loads(resp.get_data())["emails"]] == ["queued", "failed"]
+
+    def test_batch_endpoint_ndjson(self):
+        web_app = webservice.app.test_client()
+
+        payload = "\n".join(json.dumps({"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Line %d" % i})
+                            for i in range(3))
+        resp = web_app.post("/email/batch", data=payload, content_type="application/x-ndjson")
+        assert resp.status_code == 200
+        assert [x["status"] for x in json.loads(resp.get_data())["emails"]] == 3 * ["queued"]
+
+        resp = web_app.post("/email/batch", data=json.dumps({"to": "martinslothdam@gmail.com"}),
+                            content_type="application/json")
+        assert resp.status_code == 400
+
+    def test_batch_endpoint_invalid_json(self):
+        web_app = webservice.app.test_client()
+
+        for data, content_type in [("{not json", "application/json"), ("{not json", "application/x-ndjson")]:
+            resp = web_app.post("/email/batch", data=data, content_type=content_type)
+            assert resp.status_code == 400
+            assert json.loads(resp.get_data())["error"] == "Body has to be a JSON array or NDJSON stream of emails"
+
+    # Test that a status request waits for a status notification
+    def test_status_long_poll(self):
+        web_app = webservice.app.test_client()
+
+        payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Integration testing"}
+        resp = web_app.post("/email", data=payload)
+        email_id = json.loads(resp.get_data())["emailId"]
+
+        # The in-memory result backend has no notifications, so fake one arriving after the delivery
+        subscription = mock.Mock()
+        subscription.get_message.side_effect = lambda timeout: time.sleep(0.5) or {"type": "message"}
+        with mock.patch('webservice.subscribe_email_status', return_value=subscription):
+            result = web_app.get("/email/%s?wait=5" % email_id)
+
+        result_json = json.loads(result.get_data())
+        assert result_json["status"] == "success"
+        assert subscription.close.called
+
+    # Test that the trace id is carried from the webservice to the mail service
+    def test_trace_email(self):
+        web_app = webservice.app.test_client()
+        exporter = ListExporter()
+        tracer.set_exporter(exporter, 1)
+        try:
+            payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Traced *email*"}
+            resp_json = json.loads(web_app.post("/email", data=payload).get_data())
+            result, result_json = self._get_final_status(web_app, resp_json["emailId"])
+        finally:
+            tracer.set_exporter(None)
+
+        assert result_json["status"] == "success"
+        spans = [x for x in exporter.spans if x["trace_id"] == resp_json["traceId"]]
+        assert set(x["name"] for x in spans) == set(["webservice.build_email", "webservice.enqueue", "task.queue_wait",
+                                                      "task.decode", "dispatcher.send", "service.request"])
+        assert [x["service"] for x in spans if x["name"] == "service.request"] == ["prefered"]
+        assert all(x["duration"] >= 0 for x in spans)
+
+    def test_metrics(self):
+        free = metrics.start_http_server(0, "127.0.0.1")
+        port = free.server_port
+        free.shutdown()
+        free.server_close()
+
+        web_app = webservice.app.test_client()
+        with mock.patch.object(webservice, 'MAILSERVICE_WEB_METRICS_PORT', port), \
+                mock.patch.object(webservice, '_metrics_server_pid', None):
+            web_app.post("/email", data={"to": "invalid", "subject": "Test", "content": "Integration testing"})
+
+        resp = urllib2.urlopen("http://127.0.0.1:%d/metrics" % port)
+        assert resp.info()["Content-Type"].startswith("text/plain; version=0.0.4")
+        data = resp.read()
+        assert 'micromailer_emails_added_total{status="failed"}' in data
+        assert 'micromailer_service_score{service="prefered"}' in data
+        assert web_app.get("/metrics").status_code == 404
 
     def test_nonexisting_email(self):
         web_app = webservice.app.test_client()
@@ -100,11 +404,28 @@ class IntegrationTests(unittest.TestCase):
         resp = web_app.get("/email/359df1ed-c91e-471f-9fa2-7aaf38a26a01")
         resp_json = json.loads(resp.get_data())
         assert resp.status_code == 200
-        assert resp_json["status"] == "notfound"
+        assert resp_json["status"] == "queued"
+        assert resp_json["attempts"] == 0
 
     # Test that a task is retried if the first attempt fails
+    def test_failover_service(self):
+        prefered_service._should_fail = True
+
+        web_app = webservice.app.test_client()
+
+        payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Integration testing"}
+        resp = web_app.post("/email", data=payload)
+        assert resp.status_code == 200
+
+        # The email is delivered with the secondary service by the first attempt
+        result, result_json = self._get_final_status(web_app, json.loads(resp.get_data())["emailId"])
+        assert result_json["status"] == "success"
+        assert result_json["attempts"] == 1
+        assert result_json["result"]["service"] == "secondary"
+
     def test_retry_service(self):
         prefered_service._should_fail = True
+        secondary_service._should_fail = True
 
         web_app = webservice.app.test_client()
 
@@ -112,17 +433,57 @@ class IntegrationTests(unittest.TestCase):
         resp = web_app.post("/email", data=payload)
 
         assert resp.status_code == 200
+        email_id = json.loads(resp.get_data())["emailId"]
 
-        # Sleep for 11 seconds as the retry takes 10 sec
-        time.sleep(11)
+        # The first attempt failed and the email waits to be retried
+        time.sleep(1)
+        result = web_app.get("/email/%s" % email_id)
+        result_json = json.loads(result.get_data())
+        assert result_json["status"] == "retrying"
+        assert result_json["attempts"] == 1
+        assert result_json["exception"] == "Fake failure"
+
+        # The retry is made after 3 sec
+        secondary_service._should_fail = False
 
         # Get the result
-        result = web_app.get("/email/%s" % json.loads(resp.get_data())["emailId"])
-        result_json = json.loads(result.get_data())
+        result, result_json = self._get_final_status(web_app, email_id, timeout=10)
         print result.get_data()
         assert result.status_code == 200
         assert result_json["status"] == "success"
-        assert result_json["result"]["_service"] == "secondary"
+        assert result_json["attempts"] == 2
+        assert result_json["result"]["service"] == "secondary"
+
+
+    def test_bad_request_is_not_retried(self):
+        prefered_service._exception = mailservice.BadRequest("Fake bad request")
+
+        web_app = webservice.app.test_client()
+        payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Integration testing"}
+        resp = web_app.post("/email", data=payload)
+
+        result, result_json = self._get_final_status(web_app, json.loads(resp.get_data())["emailId"])
+        assert result_json["status"] == "failed"
+        assert result_json["attempts"] == 1
+        assert result_json["exception"] == "Fake bad request"
+
+    def test_exhausted_retries_are_dead_lettered(self):
+        prefered_service._should_fail = True
+        secondary_service._should_fail = True
+        tasks.retry_policy.max_attempts = 1
+
+        web_app = webservice.app.test_client()
+        payload = {"to": "martinslothdam@gmail.com", "subject": "Test", "content": "Integration testing"}
+        with mock.patch.object(tasks.dead_letter, 'apply_async') as dead_letter:
+            resp = web_app.post("/email", data=payload)
+            email_id = json.loads(resp.get_data())["emailId"]
+            result, result_json = self._get_final_status(web_app, email_id)
+
+        assert result_json["status"] == "failed"
+        assert result_json["attempts"] == 1
+        args, kwargs = dead_letter.call_args
+        assert args[0][0] == email_id
+        assert kwargs["queue"] == tasks.MAILSERVICE_DEAD_LETTER_QUEUE
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+import context
+import unittest
+import random
+
+from micromailer.latency import LatencyEstimate
+
+
+class LatencyEstimateTestSuite(unittest.TestCase):
+
+    def test_no_samples(self):
+        estimate = LatencyEstimate()
+        self.assertIsNone(estimate.get_average())
+        self.assertIsNone(estimate.get_quantile(0.95))
+
+    def test_average(self):
+        estimate = LatencyEstimate(alpha=0.5)
+        estimate.add(1.0)
+        self.assertEqual(estimate.get_average(), 1.0)
+        estimate.add(2.0)
+        self.assertEqual(estimate.get_average(), 1.5)
+
+    def test_quantile(self):
+        rand = random.Random(1)
+        estimate = LatencyEstimate(decay=1)
+        for i in range(10000):
+            estimate.add(rand.uniform(0, 1))
+        self.assertAlmostEqual(estimate.get_quantile(0.95), 0.95, delta=0.95 * 0.2)
+        self.assertAlmostEqual(estimate.get_quantile(0.5), 0.5, delta=0.5 * 0.2)
+
+    def test_quantile_follows_recent_samples(self):
+        estimate = LatencyEstimate()
+        for i in range(1000):
+            estimate.add(0.1)
+        for i in range(1000):
+            estimate.add(2.0)
+        self.assertAlmostEqual(estimate.get_quantile(0.5), 2.0, delta=2.0 * 0.2)
+
+    def test_out_of_range(self):
+        estimate = LatencyEstimate(min_latency=0.001, max_latency=10)
+        estimate.add(0)
+        self.assertLess(estimate.get_quantile(0.5), 0.002)
+        estimate.add(1000)
+        self.assertLess(estimate.get_quantile(1), 12)
+
+    def test_weights_are_rescaled(self):
+        estimate = LatencyEstimate(decay=0.5)
+        for i in range(1000):
+            estimate.add(0.5)
+        self.assertAlmostEqual(estimate.get_quantile(0.95), 0.5, delta=0.5 * 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,13 @@
 import context
 import unittest
 import time
+import threading
 
 from micromailer.models import Email
-from micromailer.mailservice import BackoffOnFailureMailServiceBase, ServerException
+from micromailer.templates import Template
+from micromailer.mailservice import BackoffOnFailureMailServiceBase, ServerException, BadRequest, RateLimited, \
+    group_compatible_emails
+from micromailer.ratelimit import TokenBucket
 
 
 class MockMailService(BackoffOnFailureMailServiceBase):
@@ -30,6 +34,40 @@ class MockFailingMailService(BackoffOnFailureMailServiceBase):
             raise self._fail_pattern[index]
 
 
+class BlockingMailService(BackoffOnFailureMailServiceBase):
+
+    def __init__(self, max_concurrency):
+        super(BlockingMailService, self).__init__(50, max_concurrency)
+        self._lock = threading.Lock()
+        self._release = threading.Event()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _do_send(self, email):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self._release.wait(5)
+        with self._lock:
+            self.in_flight -= 1
+        return {"to": email.to[0][0]}
+
+
+# Service whose requests take latency seconds on a fake clock
+class SlowMailService(BackoffOnFailureMailServiceBase):
+
+    def __init__(self, latency):
+        super(SlowMailService, self).__init__(50)
+        self.latency = latency
+        self.clock = 0
+
+    def _do_send(self, email):
+        self.clock += self.latency
+
+    def _get_clock(self):
+        return self.clock
+
+
 class BackoffOnFailureMailServiceBaseTestSuite(unittest.TestCase):
 
     def get_email(self):
@@ -40,6 +78,35 @@ class BackoffOnFailureMailServiceBaseTestSuite(unittest.TestCase):
         service.send(self.get_email())
         self.assertEquals(service.get_service_score(), 50)
 
+    def test_score_on_slow_service(self):
+        service = SlowMailService(4.0)
+        for i in range(10):
+            service.send(self.get_email())
+
+        inputs = service.get_score_inputs()
+        self.assertEqual(inputs['latency_average'], 4.0)
+        self.assertAlmostEqual(inputs['latency_p95'], 4.0, delta=4.0 * 0.2)
+        self.assertAlmostEqual(inputs['latency_factor'], 0.25, 2)
+        self.assertAlmostEqual(service.get_service_score(), 12.5, 0)
+
+    def test_score_on_fast_service(self):
+        service = SlowMailService(0.5)
+        for i in range(10):
+            service.send(self.get_email())
+        self.assertEqual(service.get_score_inputs()['latency_factor'], 1)
+        self.assertEqual(service.get_service_score(), 50)
+
+    def test_slow_service_score_recovers(self):
+        service = SlowMailService(4.0)
+        service.send(self.get_email())
+        service._last_latency = time.time() - 310
+        self.assertEquals(service.get_service_score(), 50)
+
+    def test_batch_requests_are_timed(self):
+        service = SlowMailService(4.0)
+        service.send_batch([self.get_email(), self.get_email()])
+        self.assertIsNotNone(service.get_score_inputs()['latency_average'])
+
     def test_base_score_on_single_failure(self):
         service = MockFailingMailService(fail_pattern=[ServerException()])
         with self.assertRaises(ServerException):
@@ -79,6 +146,96 @@ class BackoffOnFailureMailServiceBaseTestSuite(unittest.TestCase):
         self.assertEquals(service.get_service_score(), 50)
         self.assertLess(service._service_health, 1)
 
+    def test_send_batch_falls_back_to_single_sends(self):
+        service = MockFailingMailService(fail_pattern=[None, BadRequest(), None])
+        results = service.send_batch([self.get_email(), self.get_email(), self.get_email()])
+
+        # The emails are sent concurrently, so any of them may be the one that fails
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len([x for x in results if isinstance(x, BadRequest)]), 1)
+        self.assertEqual(results.count(None), 2)
+        self.assertEquals(service.get_service_score(), 50)
+
+    def test_send_batch_counts_shared_failure_once(self):
+        service = MockMailService()
+        failure = ServerException()
+        service._do_send_batch = lambda emails: [failure] * len(emails)
+        service.send_batch([self.get_email(), self.get_email()])
+
+        self.assertAlmostEqual(service._service_health, 0.9)
+
+    def test_send_batch_rate_limited(self):
+        service = MockFailingMailService(fail_pattern=[None, None])
+        service.set_rate_limiter(TokenBucket(0.001, 2), 0)
+        self.assertEqual(service.send_batch([self.get_email(), self.get_email()]), [None, None])
+        self.assertTrue(service.is_saturated())
+
+        results = service.send_batch([self.get_email(), self.get_email()])
+        self.assertIsInstance(results[0], RateLimited)
+        self.assertIs(results[0], results[1])
+        self.assertEquals(service.get_service_score(), 50)
+
+    def test_markdown_is_not_delivered(self):
+        service = MockFailingMailService(fail_pattern=[None])
+        markdown_email = Email("valid@email.com", "anothervalid@email.com", "Subject", "*Content*", "text/markdown")
+        with self.assertRaises(BadRequest):
+            service.send(markdown_email)
+
+        results = service.send_batch([markdown_email, self.get_email()])
+        self.assertIsInstance(results[0], BadRequest)
+        self.assertIsNone(results[1])
+        self.assertEqual(service._index, 1)
+
+    def test_send_async(self):
+        service = MockFailingMailService(fail_pattern=[None, ServerException()])
+        self.assertIsNone(service.send_async(self.get_email()).result())
+        with self.assertRaises(ServerException):
+            service.send_async(self.get_email()).result()
+
+    def test_send_async_concurrency_limit(self):
+        service = BlockingMailService(max_concurrency=3)
+        futures = [service.send_async(self.get_email()) for i in range(10)]
+        time.sleep(0.1)
+        self.assertEqual(service.in_flight, 3)
+
+        service._release.set()
+        self.assertEqual([x.result()["to"] for x in futures], 10 * ["valid@email.com"])
+        self.assertEqual(service.max_in_flight, 3)
+
+
+class GroupCompatibleEmailsTestSuite(unittest.TestCase):
+
+    def test_groups_by_content(self):
+        emails = [
+            Email("a@email.com", "sender@email.com", "Subject", "Content"),
+            Email("b@email.com", "sender@email.com", "Subject", "Other content"),
+            Email("c@email.com", "sender@email.com", "Subject", "Content"),
+            Email("d@email.com", "sender@email.com", "Other subject", "Content")]
+
+        self.assertEqual(group_compatible_emails(emails), [[0, 2], [1], [3]])
+
+    def test_groups_split_on_max_recipients(self):
+        emails = [Email("a%d@email.com" % i, "sender@email.com", "Subject", "Content") for i in range(5)]
+        emails[1].add_recipient("b@email.com")
+
+        self.assertEqual(group_compatible_emails(emails, max_recipients=3), [[0, 1], [2, 3, 4]])
+
+    def test_groups_split_on_duplicate_recipient(self):
+        emails = [Email("a@email.com", "sender@email.com", "Subject", "Content") for i in range(2)]
+
+        self.assertEqual(group_compatible_emails(emails), [[0], [1]])
+
+    def test_groups_by_template(self):
+        template = Template("welcome", "Hi {{name}}", "<p>Welcome {{name}}</p>", "text/html")
+        emails = [Email("a@email.com", "sender@email.com", None, None, template=template, template_vars={"name": "A"}),
+                  Email("b@email.com", "sender@email.com", "Subject", "Content"),
+                  Email("c@email.com", "sender@email.com", None, None, template=template, template_vars={"name": "C"})]
+        for email in emails:
+            if email.template is not None:
+                email.render_template()
+
+        self.assertEqual(group_compatible_emails(emails), [[0, 2], [1]])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,6 +7,7 @@ import requests
 
 from micromailer.models import Email
 from micromailer.mandrill import MandrillMailService
+from micromailer.templates import Template
 from micromailer import mailservice
 
 
@@ -26,15 +27,16 @@ class MandrillMailServerTestSuite(unittest.TestCase):
     def get_email(self, name=None):
         return Email("valid@email.com", "anothervalid@email.com", "Subject", "Content", to_name=name)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_send_single_email(self, mock):
-        response = MockResponse(json.dumps([{"status": "sent", "email": "valid@email.com"}]))
+        response = MockResponse(json.dumps([{"status": "sent", "email": "valid@email.com", "_id": "abc123"}]))
         response.status_code = 200
         mock.return_value = response
 
         service = MandrillMailService("api")
         email = self.get_email()
         result = service.send(email)
+        assert result['_id'] == "abc123"
 
         assert mock.called
         request_body = mock.call_args_list[0][1]['json']
@@ -46,7 +48,7 @@ class MandrillMailServerTestSuite(unittest.TestCase):
         assert 'valid@email.com' in result
         assert result['valid@email.com']
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_send_single_email_withname(self, mock):
         response = MockResponse(json.dumps([{"status": "sent", "email": "valid@email.com"}]))
         response.status_code = 200
@@ -60,7 +62,49 @@ class MandrillMailServerTestSuite(unittest.TestCase):
         assert request_body["key"] == "api"
         assert request_body["message"]["to"][0]["name"] == "John"
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
+    def test_send_batch_single_request(self, mock):
+        response = MockResponse(json.dumps([{"status": "sent", "email": "a@email.com"},
+                                            {"status": "rejected", "email": "b@email.com"}]))
+        response.status_code = 200
+        mock.return_value = response
+
+        emails = [Email("a@email.com", "sender@email.com", "Subject", "Content"),
+                  Email("b@email.com", "sender@email.com", "Subject", "Content")]
+        results = MandrillMailService("api").send_batch(emails)
+
+        assert mock.call_count == 1
+        request_body = mock.call_args_list[0][1]['json']
+        assert [x['email'] for x in request_body["message"]["to"]] == ["a@email.com", "b@email.com"]
+        assert not request_body["message"]["preserve_recipients"]
+
+        assert results[0]['a@email.com'] and 'b@email.com' not in results[0]
+        assert not results[1]['b@email.com']
+
+    @mock.patch('requests.Session.post')
+    def test_send_batch_template(self, mock):
+        response = MockResponse(json.dumps([{"status": "sent", "email": "a@email.com"},
+                                            {"status": "sent", "email": "b@email.com"}]))
+        response.status_code = 200
+        mock.return_value = response
+
+        template = Template("welcome", "Hi {{name}}", "Welcome {{name}}", "text/plain")
+        emails = [Email("a@email.com", "sender@email.com", None, None, template=template, template_vars={"name": "A"}),
+                  Email("b@email.com", "sender@email.com", None, None, template=template, template_vars={"name": "B"})]
+        for email in emails:
+            email.render_template()
+        results = MandrillMailService("api").send_batch(emails)
+
+        assert mock.call_count == 1
+        message = mock.call_args_list[0][1]['json']["message"]
+        assert message["subject"] == "Hi *|S_name|*"
+        assert message["text"] == "Welcome *|C_name|*"
+        assert message["merge"] and message["merge_language"] == "mailchimp"
+        assert message["merge_vars"][1]["rcpt"] == "b@email.com"
+        assert {"name": "C_name", "content": "B"} in message["merge_vars"][1]["vars"]
+        assert results[0]['a@email.com'] and results[1]['b@email.com']
+
+    @mock.patch('requests.Session.post')
     def test_server_failure(self, mock):
         response = requests.Response()
         response.status_code = 500
@@ -70,7 +114,7 @@ class MandrillMailServerTestSuite(unittest.TestCase):
         with self.assertRaises(mailservice.ServerException):
             service.send(self.get_email())
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_network_failure(self, mock):
         mock.side_effect = requests.exceptions.ConnectionError()
 
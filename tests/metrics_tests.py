@@ -0,0 +1,123 @@
+import context
+import unittest
+import threading
+import urllib2
+
+from micromailer.models import Email
+from micromailer.mailservice import MailServiceBase, ServerException, request_count, request_latency
+from micromailer.metrics import MetricsRegistry, start_http_server, start_process_http_server
+
+
+class MockMailService(MailServiceBase):
+
+    def __init__(self):
+        super(MockMailService, self).__init__()
+        self.exception = None
+
+    def _do_send(self, email):
+        if self.exception is not None:
+            raise self.exception
+
+    def get_name(self):
+        return "metrics-mock"
+
+
+class MetricsTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter("sends_total", "Sends", ("service", "outcome"))
+        counter.inc(("sendgrid", "success"))
+        counter.inc(("sendgrid", "success"), 2)
+        counter.inc(("mandrill", "ServerException"))
+        self.assertEqual(counter.get(("sendgrid", "success")), 3)
+        self.assertEqual(self.registry.format(), "\n".join([
+            "# HELP sends_total Sends",
+            "# TYPE sends_total counter",
+            'sends_total{service="mandrill",outcome="ServerException"} 1',
+            'sends_total{service="sendgrid",outcome="success"} 3']) + "\n")
+
+    def test_counter_threads(self):
+        counter = self.registry.counter("sends_total", "Sends")
+
+        def increment():
+            for i in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=increment) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.get(), 8000)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("latency_seconds", "Latency", ("service",), buckets=(0.1, 1))
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value, ("sendgrid",))
+        self.assertEqual(histogram.get_count(("sendgrid",)), 4)
+        self.assertEqual(histogram.format()[2:], [
+            'latency_seconds_bucket{service="sendgrid",le="0.1"} 2',
+            'latency_seconds_bucket{service="sendgrid",le="1"} 3',
+            'latency_seconds_bucket{service="sendgrid",le="+Inf"} 4',
+            'latency_seconds_sum{service="sendgrid"} 2.65',
+            'latency_seconds_count{service="sendgrid"} 4'])
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("score", "Score", lambda: [(("sendgrid",), 50), (("mandrill",), 40.5)], ("service",))
+        self.assertEqual(gauge.format()[2:], ['score{service="mandrill"} 40.5', 'score{service="sendgrid"} 50'])
+
+    def test_label_escaping(self):
+        counter = self.registry.counter("sends_total", "Sends", ("service",))
+        counter.inc(('a "b"\n',))
+        self.assertEqual(counter.format()[2], 'sends_total{service="a \\"b\\"\\n"} 1')
+
+    def test_duplicate_name(self):
+        self.registry.counter("sends_total", "Sends")
+        self.assertRaises(ValueError, self.registry.counter, "sends_total", "Sends")
+
+    def test_http_server(self):
+        self.registry.counter("sends_total", "Sends").inc()
+        server = start_http_server(0, "127.0.0.1", self.registry)
+        try:
+            response = urllib2.urlopen("http://127.0.0.1:%d/metrics" % server.server_port)
+            self.assertIn("sends_total 1", response.read())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, "http://127.0.0.1:%d/other" % server.server_port)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_process_http_server(self):
+        first = start_http_server(0, "127.0.0.1", self.registry)
+        port = first.server_port
+        first.shutdown()
+        first.server_close()
+        server = start_process_http_server(port, 1, "127.0.0.1", self.registry)
+        try:
+            self.assertEqual(server.server_port, port)
+            # Every port is taken by another process
+            self.assertIsNone(start_process_http_server(port, 1, "127.0.0.1", self.registry))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_service_requests(self):
+        service = MockMailService()
+        email = Email("valid@email.com", "anothervalid@email.com", "Subject", "Content")
+        successes = request_count.get(("metrics-mock", "success"))
+        failures = request_count.get(("metrics-mock", "ServerException"))
+        requests = request_latency.get_count(("metrics-mock",))
+
+        service.send(email)
+        service.exception = ServerException()
+        self.assertRaises(ServerException, service.send, email)
+
+        self.assertEqual(request_count.get(("metrics-mock", "success")), successes + 1)
+        self.assertEqual(request_count.get(("metrics-mock", "ServerException")), failures + 1)
+        self.assertEqual(request_latency.get_count(("metrics-mock",)), requests + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
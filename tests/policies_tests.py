@@ -0,0 +1,98 @@
+import context
+import unittest
+import random
+import time
+import threading
+
+from micromailer.models import Email
+from micromailer.dispatcher import MailDispatcher
+from micromailer.mailservice import MailServiceBase
+from micromailer.policies import HighestScorePolicy, WeightedRandomPolicy, PowerOfTwoChoicesPolicy, \
+    LeastOutstandingPolicy, create_dispatch_policy
+
+
+class BlockingMailService(MailServiceBase):
+
+    def __init__(self):
+        super(BlockingMailService, self).__init__()
+        self.release = threading.Event()
+
+    def _do_send(self, email):
+        self.release.wait(5)
+
+
+class DispatchPolicyTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.ranked = (("a", 50), ("b", 30), ("c", 20))
+        self.in_flight = {"a": 0, "b": 0, "c": 0}
+
+    def count_selections(self, policy, selections=10000):
+        counts = {"a": 0, "b": 0, "c": 0}
+        for i in range(selections):
+            counts[policy.select(self.ranked, self.in_flight.get)[0]] += 1
+        return counts
+
+    def test_highest_score(self):
+        self.assertEqual(HighestScorePolicy().select(self.ranked, self.in_flight.get), ("a", 50))
+
+    def test_weighted_random(self):
+        counts = self.count_selections(WeightedRandomPolicy(random.Random(1)))
+        self.assertAlmostEqual(counts["a"] / 10000.0, 0.5, delta=0.03)
+        self.assertAlmostEqual(counts["b"] / 10000.0, 0.3, delta=0.03)
+        self.assertAlmostEqual(counts["c"] / 10000.0, 0.2, delta=0.03)
+
+    def test_weighted_random_zero_scores(self):
+        self.ranked = (("a", 0), ("b", 0), ("c", 0))
+        counts = self.count_selections(WeightedRandomPolicy(random.Random(1)), 1000)
+        self.assertTrue(all(x > 0 for x in counts.values()))
+
+    def test_power_of_two_choices(self):
+        self.in_flight["a"] = 5
+        counts = self.count_selections(PowerOfTwoChoicesPolicy(random.Random(1)))
+        # "a" is only used when it is not picked with any of the others
+        self.assertEqual(counts["a"], 0)
+        self.assertGreater(counts["b"], counts["c"])
+
+    def test_power_of_two_choices_relative_to_score(self):
+        self.ranked = (("a", 50), ("b", 5))
+        self.in_flight["a"] = 3
+        counts = self.count_selections(PowerOfTwoChoicesPolicy(random.Random(1)), 100)
+        self.assertEqual(counts["a"], 100)
+
+    def test_power_of_two_choices_single_service(self):
+        self.assertEqual(PowerOfTwoChoicesPolicy().select((("a", 50),), self.in_flight.get), ("a", 50))
+
+    def test_least_outstanding(self):
+        policy = LeastOutstandingPolicy()
+        self.assertEqual(policy.select(self.ranked, self.in_flight.get)[0], "a")
+        self.in_flight["a"] = 1
+        self.assertEqual(policy.select(self.ranked, self.in_flight.get)[0], "b")
+        self.in_flight["b"] = 1
+        self.assertEqual(policy.select(self.ranked, self.in_flight.get)[0], "a")
+
+    def test_create_dispatch_policy(self):
+        self.assertIsInstance(create_dispatch_policy("least-outstanding"), LeastOutstandingPolicy)
+        self.assertRaises(ValueError, create_dispatch_policy, "unknown")
+
+    def test_dispatcher_counts_in_flight(self):
+        service = BlockingMailService()
+        dispatcher = MailDispatcher(policy=LeastOutstandingPolicy())
+        dispatcher.add_service(service)
+
+        futures = [dispatcher.send_async(Email("valid@email.com", "anothervalid@email.com", "Subject", "Content"))
+                   for i in range(3)]
+        self.assertEqual(dispatcher.get_in_flight(service), 3)
+        service.release.set()
+        for future in futures:
+            future.result()
+        # The futures complete right before the done callbacks are called
+        for i in range(100):
+            if dispatcher.get_in_flight(service) == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(dispatcher.get_in_flight(service), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import context
+import unittest
+
+from micromailer.ratelimit import TokenBucket, RedisTokenBucket
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def get_time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeClockTokenBucket(TokenBucket):
+
+    def __init__(self, rate, burst, clock):
+        super(FakeClockTokenBucket, self).__init__(rate, burst)
+        self._get_time = clock.get_time
+        self._sleep = clock.sleep
+
+
+class MockScript(object):
+
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def __call__(self, keys, args):
+        self.calls.append((keys, args))
+        return self.response
+
+
+class MockRedisClient(object):
+
+    def __init__(self, script):
+        self.script = script
+
+    def register_script(self, source):
+        return self.script
+
+
+class TokenBucketTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = FakeClockTokenBucket(10, 5, self.clock)
+
+    def test_burst(self):
+        for i in range(5):
+            self.assertEqual(self.bucket.try_acquire(), 0)
+        self.assertAlmostEqual(self.bucket.try_acquire(), 0.1)
+
+    def test_refill(self):
+        self.assertEqual(self.bucket.try_acquire(5), 0)
+        self.clock.now += 0.25
+        self.assertEqual(self.bucket.try_acquire(2), 0)
+        self.assertAlmostEqual(self.bucket.try_acquire(1), 0.05)
+
+    def test_refill_is_capped_by_burst(self):
+        self.clock.now += 60
+        self.assertEqual(self.bucket.try_acquire(5), 0)
+        self.assertAlmostEqual(self.bucket.try_acquire(), 0.1)
+
+    def test_acquire_more_than_burst(self):
+        self.assertEqual(self.bucket.try_acquire(20), 0)
+        # The bucket is in debt until the 20 tokens are paid back
+        self.assertAlmostEqual(self.bucket.try_acquire(), 1.6)
+
+    def test_acquire_waits(self):
+        self.bucket.try_acquire(5)
+        self.assertTrue(self.bucket.acquire(2, timeout=1))
+        self.assertAlmostEqual(self.clock.now, 1000.2)
+
+    def test_acquire_timeout(self):
+        self.bucket.try_acquire(5)
+        self.assertFalse(self.bucket.acquire(5, timeout=0.2))
+        self.assertEqual(self.clock.now, 1000.0)
+
+    def test_is_saturated(self):
+        self.assertFalse(self.bucket.is_saturated())
+        self.bucket.try_acquire(4)
+        self.assertFalse(self.bucket.is_saturated())
+        self.bucket.try_acquire(1)
+        self.assertTrue(self.bucket.is_saturated())
+        self.clock.now += 0.1
+        self.assertFalse(self.bucket.is_saturated())
+
+
+class RedisTokenBucketTestSuite(unittest.TestCase):
+
+    def test_take(self):
+        script = MockScript(["0", "4.5"])
+        bucket = RedisTokenBucket(MockRedisClient(script), "bucket", 10, 5)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertFalse(bucket.is_saturated())
+        keys, args = script.calls[0]
+        self.assertEqual(keys, ["bucket"])
+        self.assertEqual(args[:3], [10, 5, 1])
+
+    def test_saturated(self):
+        script = MockScript(["0.25", "-1.5"])
+        bucket = RedisTokenBucket(MockRedisClient(script), "bucket", 10, 5)
+        self.assertEqual(bucket.try_acquire(4), 0.25)
+        self.assertTrue(bucket.is_saturated())
+
+
+if __name__ == '__main__':
+    unittest.main()
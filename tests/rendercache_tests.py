@@ -0,0 +1,53 @@
+import context
+import unittest
+
+from micromailer.rendercache import RenderCache
+
+
+class RenderCacheTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.rendered = []
+
+    def render(self, content):
+        self.rendered.append(content)
+        return "<p>%s</p>" % content
+
+    def test_hit_and_miss(self):
+        cache = RenderCache(self.render)
+        self.assertEqual(cache.render("Content"), "<p>Content</p>")
+        self.assertEqual(cache.render("Content"), "<p>Content</p>")
+        self.assertEqual(cache.render(u"Other content"), "<p>Other content</p>")
+
+        self.assertEqual(self.rendered, ["Content", "Other content"])
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['bytes'], len("<p>Content</p>") + len("<p>Other content</p>"))
+
+    def test_evicts_least_recently_used(self):
+        # Each rendered entry is 10 bytes, so only two fit
+        cache = RenderCache(self.render, max_bytes=20)
+        cache.render("one")
+        cache.render("two")
+        cache.render("one")
+        cache.render("six")
+
+        self.assertEqual(cache.get_stats()['entries'], 2)
+        self.assertEqual(cache.get_stats()['bytes'], 20)
+        cache.render("one")
+        cache.render("two")
+        self.assertEqual(self.rendered, ["one", "two", "six", "two"])
+
+    def test_does_not_cache_oversized_content(self):
+        cache = RenderCache(self.render, max_bytes=5)
+        cache.render("Content")
+        cache.render("Content")
+
+        self.assertEqual(len(self.rendered), 2)
+        self.assertEqual(cache.get_stats()['entries'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
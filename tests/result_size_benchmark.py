@@ -0,0 +1,72 @@
+# Measures the size of the results stored in the result backend for a delivered email,
+# for the compact delivery records and for the previous results, which were the dicts
+# returned by the mail services. The sizes are of the JSON encoded task meta as stored
+# by the redis result backend. The redis memory adds the key and about 90 bytes of
+# overhead per stored result.
+#
+# Run with: python result_size_benchmark.py
+
+import context
+import json
+import uuid
+
+from micromailer.models import Email
+from micromailer.sendgrid import SendGridMailService
+from micromailer.mandrill import MandrillMailService
+from micromailer.deliveryrecord import encode_delivery_record
+
+# Estimated redis memory per key on top of the key and value: the hash table and
+# expiry entries, object headers and allocator rounding
+REDIS_KEY_OVERHEAD = 90
+
+# Results stored in CELERY_MAX_CACHED_RESULTS
+STORED_RESULTS = 10000000
+
+
+class MockResponse(object):
+
+    def __init__(self, text, headers=None):
+        self.text = text
+        self.headers = headers or {}
+
+
+def get_email(recipients):
+    email = Email("recipient0@example.com", "no-reply@martindam.dk", "Subject", "Content")
+    for i in range(1, recipients):
+        email.add_recipient("recipient%d@example.com" % i)
+    return email
+
+
+def sendgrid_result(email):
+    response = MockResponse("", {"X-Message-Id": "HbtrXj1NRuW3yDMyRrUWWA"})
+    return SendGridMailService("api")._build_success_response(email, response)
+
+
+def mandrill_result(email):
+    return MandrillMailService("api")._process_response(
+        [{"email": x[0], "status": "sent", "_id": uuid.uuid4().hex, "reject_reason": None} for x in email.to])
+
+
+def stored_size(result):
+    meta = {'status': "SUCCESS", 'result': result, 'traceback': None, 'children': []}
+    key = "celery-task-meta-%s" % uuid.uuid4()
+    return len(json.dumps(meta)) + len(key) + REDIS_KEY_OVERHEAD
+
+
+if __name__ == '__main__':
+    print "%-26s %-12s %-12s %-10s" % ("result", "previous", "record", "reduction")
+    for name, build_result, recipients in [("sendgrid, 1 recipient", sendgrid_result, 1),
+                                           ("mandrill, 1 recipient", mandrill_result, 1),
+                                           ("mandrill, 10 recipients", mandrill_result, 10),
+                                           ("sendgrid, 100 recipients", sendgrid_result, 100)]:
+        email = get_email(recipients)
+        previous = build_result(email)
+        previous['_attempts'] = 1
+        record = encode_delivery_record(email, build_result(email), 1)
+        sizes = [stored_size(previous), stored_size(record)]
+        print "%-26s %-12s %-12s %-10s" % (name, "%d B" % sizes[0], "%d B" % sizes[1],
+                                           "%.0f%%" % (100 - 100.0 * sizes[1] / sizes[0]))
+        if recipients == 1:
+            print "%-26s %-12s %-12s" % ("  %dM results" % (STORED_RESULTS / 1000000),
+                                         "%.2f GB" % (sizes[0] * STORED_RESULTS / 1e9),
+                                         "%.2f GB" % (sizes[1] * STORED_RESULTS / 1e9))
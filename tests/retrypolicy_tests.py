@@ -0,0 +1,48 @@
+import context
+import unittest
+import random
+
+from micromailer.mailservice import ServerException, BadRequest, TooManyRequests, NetworkException
+from micromailer.models import InvalidEmailArgument
+from micromailer.retrypolicy import RetryPolicy
+
+
+class RetryPolicyTestSuite(unittest.TestCase):
+
+    def test_exponential_backoff(self):
+        policy = RetryPolicy(base_delay=10, max_delay=60, jitter=False)
+        self.assertEqual([policy.get_delay(ServerException(), x) for x in range(1, 6)], [10, 20, 40, 60, 60])
+
+    def test_full_jitter(self):
+        policy = RetryPolicy(base_delay=10, rand=random.Random(1))
+        delays = [policy.get_delay(NetworkException(), 3) for i in range(1000)]
+        self.assertTrue(all(0 <= x <= 40 for x in delays))
+        self.assertAlmostEqual(sum(delays) / len(delays), 20, delta=2)
+
+    def test_never_retry(self):
+        policy = RetryPolicy()
+        self.assertIsNone(policy.get_delay(BadRequest(), 1))
+        self.assertIsNone(policy.get_delay(InvalidEmailArgument("Invalid"), 1))
+        self.assertFalse(policy.is_retryable(BadRequest()))
+        self.assertTrue(policy.is_retryable(ServerException()))
+
+    def test_retry_after(self):
+        policy = RetryPolicy(base_delay=10, rand=random.Random(1))
+        for i in range(100):
+            delay = policy.get_delay(TooManyRequests("", retry_after=120), 1)
+            self.assertTrue(120 <= delay <= 130)
+        self.assertLessEqual(policy.get_delay(TooManyRequests(), 1), 10)
+
+    def test_max_attempts(self):
+        policy = RetryPolicy(max_attempts=3, jitter=False)
+        self.assertIsNotNone(policy.get_delay(ServerException(), 2))
+        self.assertIsNone(policy.get_delay(ServerException(), 3))
+
+    def test_deadline(self):
+        policy = RetryPolicy(base_delay=10, deadline=100, jitter=False)
+        self.assertEqual(policy.get_delay(ServerException(), 1, 90), 10)
+        self.assertIsNone(policy.get_delay(ServerException(), 1, 95))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,20 @@ testmodules = [
     'mailservice_tests',
     'mandrill_tests',
     'sendgrid_tests',
+    'dispatcher_tests',
+    'policies_tests',
+    'connectionpool_tests',
+    'rendercache_tests',
+    'latency_tests',
+    'templates_tests',
+    'ratelimit_tests',
+    'circuitbreaker_tests',
+    'retrypolicy_tests',
+    'idempotency_tests',
+    'deliveryrecord_tests',
+    'metrics_tests',
+    'tracing_tests',
+    'fakeprovider_tests',
     'integration_tests']
 
 suite = unittest.TestSuite()
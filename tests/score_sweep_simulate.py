@@ -0,0 +1,155 @@
+# Simulation of the score algorithm of BackoffOnFailureMailServiceBase for sweeps of its
+# constants. Like run_test in backoff_alg_simulate.py, a preferred service A and an
+# alternative service B are sent emails at a fixed rate for 30 min, each email is sent with
+# the service with the highest score and retried once with the other service on failure,
+# and service A fails by a failure scenario.
+#
+# Instead of stepping through mail service objects, the health, time of the last error and
+# score of every simulation are kept in NumPy arrays, so each time step updates all the
+# simulations at once: every combination of scenario, health decay, error window, base
+# score of service B and random seed. The simulations of each message rate are split in
+# chunks run in parallel by a process pool. The latency factor of the score is not
+# simulated, the services are assumed to be fast.
+#
+# Prints a table with the failure rate (failed attempts / attempts) and the share of the
+# attempts made to service A for each configuration, averaged over the seeds, with the
+# standard deviation of the failure rate. Requires NumPy.
+#
+# Run with: python score_sweep_simulate.py [--decay 0.8 0.9 0.95] [--window 150 300 600]
+#               [--base-score 30 40 45] [--rate 10] [--seeds 20] [--processes 4]
+
+import context
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from micromailer.mailservice import BackoffOnFailureMailServiceBase
+
+# Base score of the preferred service A
+BASE_SCORE_A = 50
+
+
+# Failure scenarios of service A. Each returns the probability that a request at
+# each of the times (a NumPy array of seconds) fails. Same scenarios as in
+# backoff_alg_simulate.py
+def continous_failure_10min(times):
+    return np.where((times > 200) & (times < 800), 1.0, 0.0)
+
+
+def sporadic_failure_10min(times):
+    return np.where((times > 200) & (times < 800), 0.5, 0.0)
+
+
+def uniform_random_5percentage_error(times):
+    return np.full(len(times), 0.05)
+
+
+def no_failure(times):
+    return np.zeros(len(times))
+
+
+scenarios = [('10 min complete failure', continous_failure_10min),
+             ('10 min sporadic failure', sporadic_failure_10min),
+             ('Random 5% failure', uniform_random_5percentage_error),
+             ('No failures', no_failure)]
+
+
+# Simulate the configurations, a list of (scenario index, decay, window, base score
+# of B, seed index), at rate msg/s for duration seconds with random numbers drawn
+# from seed. Returns the number of attempts, failed attempts and attempts made to
+# service A of each configuration as arrays
+def simulate(configurations, rate, duration, seed=0):
+    count = len(configurations)
+    scenario, decay, window, base_b = [np.array(x) for x in zip(*configurations)[:4]]
+    base_a = np.full(count, float(BASE_SCORE_A))
+
+    times = np.arange(int(duration * rate)) / float(rate)
+    failure_probability = np.array([function(times) for name, function in scenarios])
+    random = np.random.RandomState(seed)
+
+    health_a = np.ones(count)
+    health_b = np.ones(count)
+    last_error_a = np.full(count, -np.inf)
+    last_error_b = np.full(count, -np.inf)
+    attempts = np.zeros(count, dtype=np.int64)
+    failures = np.zeros(count, dtype=np.int64)
+    attempts_a = np.zeros(count, dtype=np.int64)
+
+    for step, t in enumerate(times):
+        weight_a = np.minimum(1, (t - last_error_a) / window)
+        weight_b = np.minimum(1, (t - last_error_b) / window)
+        a_first = base_a * (weight_a + health_a * (1 - weight_a)) >= base_b * (weight_b + health_b * (1 - weight_b))
+
+        # Service B does not fail, so an email is only sent with A after B if A failed
+        failed_a = random.random_sample(count) < failure_probability[:, step][scenario]
+        used_a = a_first
+        used_b = ~a_first | failed_a
+        attempts += 1 + (a_first & failed_a)
+        failures += a_first & failed_a
+        attempts_a += used_a
+
+        success_a = used_a & ~failed_a
+        health_a = np.where(used_a, health_a * decay + np.where(success_a, 1 - decay, 0), health_a)
+        health_a[success_a & (health_a > 0.999)] = 1
+        last_error_a = np.where(used_a & failed_a, t, last_error_a)
+        health_b = np.where(used_b, health_b * decay + (1 - decay), health_b)
+        health_b[used_b & (health_b > 0.999)] = 1
+
+    return attempts, failures, attempts_a
+
+
+def run_chunk(arguments):
+    configurations, rate, duration, seed = arguments
+    return configurations, rate, simulate(configurations, rate, duration, seed)
+
+
+# Run the sweep in parallel chunks of at most chunk_size simulations.
+# Returns a dict from (scenario index, rate, decay, window, base score of B) to a
+# list of (failure rate, share of A) for each seed
+def sweep(decays, windows, base_scores, rates, seeds, duration, processes, chunk_size):
+    configurations = list(itertools.product(range(len(scenarios)), decays, windows, base_scores, range(seeds)))
+    chunks = [(configurations[i:i + chunk_size], rate, duration, len(configurations) * j + i)
+              for j, rate in enumerate(rates) for i in range(0, len(configurations), chunk_size)]
+
+    results = {}
+    executor = ProcessPoolExecutor(processes)
+    try:
+        for chunk, rate, (attempts, failures, attempts_a) in executor.map(run_chunk, chunks):
+            for index, (scenario, decay, window, base_b, seed) in enumerate(chunk):
+                results.setdefault((scenario, rate, decay, window, base_b), []).append(
+                    (100.0 * failures[index] / attempts[index], 100.0 * attempts_a[index] / attempts[index]))
+    finally:
+        executor.shutdown()
+    return results
+
+
+def print_results(results):
+    print "%-24s %-6s %-6s %-7s %-7s %-20s %-10s" % ("Scenario", "Rate", "Decay", "Window", "Base B",
+                                                    "Failure rate", "Share A")
+    for key in sorted(results):
+        scenario, rate, decay, window, base_b = key
+        values = np.array(results[key])
+        print "%-24s %-6g %-6g %-7g %-7g %-20s %-10s" % (
+            scenarios[scenario][0], rate, decay, window, base_b,
+            "%.2f%% +- %.2f" % (values[:, 0].mean(), values[:, 0].std()), "%.1f%%" % values[:, 1].mean())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep the constants of the service score algorithm")
+    parser.add_argument("--decay", type=float, nargs="+", default=[0.8, BackoffOnFailureMailServiceBase.health_decay, 0.95],
+                        help="Weights of the previous health")
+    parser.add_argument("--window", type=float, nargs="+", default=[150, BackoffOnFailureMailServiceBase.error_window, 600],
+                        help="Seconds after the last error until the base score is used again")
+    parser.add_argument("--base-score", type=float, nargs="+", default=[30, 40, 45],
+                        help="Base scores of service B (service A has %d)" % BASE_SCORE_A)
+    parser.add_argument("--rate", type=float, nargs="+", default=[10], help="Emails per second")
+    parser.add_argument("--seeds", type=int, default=20, help="Simulations of each configuration")
+    parser.add_argument("--duration", type=float, default=1800, help="Simulated seconds")
+    parser.add_argument("--processes", type=int, default=None, help="Number of processes (default: CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Simulations per process at a time")
+    args = parser.parse_args()
+
+    print_results(sweep(args.decay, args.window, args.base_score, args.rate, args.seeds, args.duration,
+                        args.processes, args.chunk_size))
@@ -6,6 +6,8 @@ import requests
 
 from micromailer.models import Email
 from micromailer.sendgrid import SendGridMailService
+from micromailer.connectionpool import DEFAULT_TIMEOUT
+from micromailer.templates import Template
 from micromailer import mailservice
 
 
@@ -14,15 +16,17 @@ class SendgridMailServiceTestSuite(unittest.TestCase):
     def get_email(self, name=None):
         return Email("valid@email.com", "anothervalid@email.com", "Subject", "Content", to_name=name)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_send_single_email(self, mock):
         response = requests.Response()
         response.status_code = 200
+        response.headers['X-Message-Id'] = "abc123"
         mock.return_value = response
 
         service = SendGridMailService("api")
         email = self.get_email()
         result = service.send(email)
+        assert result['_id'] == "abc123"
 
         assert mock.called
         request_body = mock.call_args_list[0][1]['json']
@@ -33,7 +37,7 @@ class SendgridMailServiceTestSuite(unittest.TestCase):
         assert 'valid@email.com' in result
         assert result['valid@email.com']
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_send_single_email_withname(self, mock):
         response = requests.Response()
         response.status_code = 200
@@ -46,7 +50,62 @@ class SendgridMailServiceTestSuite(unittest.TestCase):
         request_body = mock.call_args_list[0][1]['json']
         assert request_body['personalizations'][0]['to'][0]['name'] == "John"
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
+    def test_send_batch_single_request(self, mock):
+        response = requests.Response()
+        response.status_code = 202
+        mock.return_value = response
+
+        emails = [Email("a@email.com", "sender@email.com", "Subject", "Content"),
+                  Email("b@email.com", "sender@email.com", "Subject", "Content"),
+                  Email("c@email.com", "sender@email.com", "Subject", "Other content")]
+        results = SendGridMailService("api").send_batch(emails)
+
+        assert mock.call_count == 2
+        request_body = mock.call_args_list[0][1]['json']
+        assert [x['to'][0]['email'] for x in request_body['personalizations']] == ["a@email.com", "b@email.com"]
+        assert mock.call_args_list[1][1]['json']['content'][0]['value'] == "Other content"
+
+        assert results[0]['a@email.com'] and 'b@email.com' not in results[0]
+        assert results[1]['b@email.com']
+        assert results[2]['c@email.com']
+
+    @mock.patch('requests.Session.post')
+    def test_send_batch_failure(self, mock):
+        response = requests.Response()
+        response.status_code = 400
+        mock.return_value = response
+
+        emails = [Email("a@email.com", "sender@email.com", "Subject", "Content"),
+                  Email("b@email.com", "sender@email.com", "Subject", "Content")]
+        results = SendGridMailService("api").send_batch(emails)
+
+        assert mock.call_count == 1
+        assert all(isinstance(x, mailservice.BadRequest) for x in results)
+
+    @mock.patch('requests.Session.post')
+    def test_send_batch_template(self, mock):
+        response = requests.Response()
+        response.status_code = 202
+        mock.return_value = response
+
+        template = Template("welcome", "Hi {{name}}", "<p>Welcome {{name}}</p>", "text/html")
+        emails = [Email("a@email.com", "sender@email.com", None, None, template=template, template_vars={"name": "A&B"}),
+                  Email("b@email.com", "sender@email.com", None, None, template=template, template_vars={"name": "C"})]
+        for email in emails:
+            email.render_template()
+        results = SendGridMailService("api").send_batch(emails)
+
+        assert mock.call_count == 1
+        request_body = mock.call_args_list[0][1]['json']
+        assert request_body['subject'] == "Hi -subject.name-"
+        assert request_body['content'][0]['value'] == "<p>Welcome -name-</p>"
+        assert request_body['personalizations'][0]['substitutions'] == {"-subject.name-": "A&B", "-name-": "A&amp;B"}
+        assert request_body['personalizations'][1]['to'][0]['email'] == "b@email.com"
+        assert request_body['personalizations'][1]['substitutions']["-name-"] == "C"
+        assert results[0]['a@email.com'] and results[1]['b@email.com']
+
+    @mock.patch('requests.Session.post')
     def test_bearer_token(self, mock):
         response = requests.Response()
         response.status_code = 200
@@ -58,7 +117,19 @@ class SendgridMailServiceTestSuite(unittest.TestCase):
         req = mock.call_args_list[0][1]['auth'](requests.Request())
         assert req.headers['Authorization'] == 'Bearer api'
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
+    def test_timeouts(self, mock):
+        response = requests.Response()
+        response.status_code = 200
+        mock.return_value = response
+
+        SendGridMailService("api").send(self.get_email())
+        assert mock.call_args_list[0][1]['timeout'] == DEFAULT_TIMEOUT
+
+        SendGridMailService("api", timeout=(1, 2)).send(self.get_email())
+        assert mock.call_args_list[1][1]['timeout'] == (1, 2)
+
+    @mock.patch('requests.Session.post')
     def test_server_failure(self, mock):
         response = requests.Response()
         response.status_code = 500
@@ -68,7 +139,19 @@ class SendgridMailServiceTestSuite(unittest.TestCase):
         with self.assertRaises(mailservice.ServerException):
             service.send(self.get_email())
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
+    def test_too_many_requests(self, mock):
+        response = requests.Response()
+        response.status_code = 429
+        response.headers['Retry-After'] = '30'
+        mock.return_value = response
+
+        service = SendGridMailService("api")
+        with self.assertRaises(mailservice.TooManyRequests) as context:
+            service.send(self.get_email())
+        self.assertEqual(context.exception.retry_after, 30)
+
+    @mock.patch('requests.Session.post')
     def test_network_failure(self, mock):
         mock.side_effect = requests.exceptions.ConnectionError()
 
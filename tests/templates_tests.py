@@ -0,0 +1,116 @@
+import context
+import unittest
+import json
+
+import markdown
+
+from micromailer.models import Email, InvalidEmailArgument, encode_email, decode_email
+from micromailer.templates import Template, TemplateRegistry, TemplateConflict, UnknownTemplate, RedisTemplateStore
+
+
+class MockRedisClient(object):
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hsetnx(self, key, field, value):
+        values = self.hashes.setdefault(key, {})
+        if field in values:
+            return 0
+        values[field] = value
+        return 1
+
+
+class TemplateTestSuite(unittest.TestCase):
+
+    def test_render(self):
+        template = Template("welcome", "Hi {{name}}", "Welcome {{ name }}, your code is {{code}}", "text/plain")
+        self.assertEqual(template.variables, frozenset(["name", "code"]))
+        self.assertEqual(template.render({"name": "John", "code": 42}), ("Hi John", "Welcome John, your code is 42"))
+
+    def test_render_escapes_html(self):
+        template = Template("welcome", "Hi {{name}}", "<p>Welcome {{name}}</p>", "text/html")
+        self.assertEqual(template.render({"name": "<b>&"}), ("Hi <b>&", "<p>Welcome &lt;b&gt;&amp;</p>"))
+
+    def test_format(self):
+        template = Template("welcome", "Hi {{name}}", "<p>Welcome {{name}}</p>", "text/html")
+        self.assertEqual(template.format(lambda x: "-s.%s-" % x, lambda x: "-%s-" % x), ("Hi -s.name-", "<p>Welcome -name-</p>"))
+
+    def test_check_variables(self):
+        template = Template("welcome", "Hi {{name}}", "Welcome", "text/plain")
+        template.check_variables({"name": "John"})
+        with self.assertRaises(InvalidEmailArgument):
+            template.check_variables({})
+        with self.assertRaises(InvalidEmailArgument):
+            template.check_variables({"name": ["John"]})
+        with self.assertRaises(InvalidEmailArgument):
+            template.check_variables(None)
+
+
+class TemplateRegistryTestSuite(unittest.TestCase):
+
+    def test_register_markdown(self):
+        registry = TemplateRegistry(markdown.markdown)
+        self.assertTrue(registry.register("welcome", "Hi {{first_name}}", "Welcome *{{first_name}}*"))
+
+        template = registry.get("welcome")
+        self.assertEqual(template.content_type, "text/html")
+        self.assertEqual(template.render({"first_name": "John"})[1], "<p>Welcome <em>John</em></p>")
+        self.assertIs(registry.get("welcome"), template)
+
+    def test_register_existing(self):
+        registry = TemplateRegistry(markdown.markdown)
+        registry.register("welcome", "Hi", "Welcome")
+        self.assertFalse(registry.register("welcome", "Hi", "Welcome"))
+        with self.assertRaises(TemplateConflict):
+            registry.register("welcome", "Hi", "Other content")
+
+    def test_register_invalid(self):
+        registry = TemplateRegistry()
+        with self.assertRaises(InvalidEmailArgument):
+            registry.register("welcome", "", "Welcome", "text/plain")
+        with self.assertRaises(InvalidEmailArgument):
+            registry.register("welcome", "Hi", "Welcome", "application/json")
+        # Markdown templates need a render function
+        with self.assertRaises(InvalidEmailArgument):
+            registry.register("welcome", "Hi", "Welcome", "text/markdown")
+
+    def test_unknown_template(self):
+        with self.assertRaises(UnknownTemplate):
+            TemplateRegistry().get("welcome")
+
+    def test_shared_store(self):
+        store = RedisTemplateStore(MockRedisClient())
+        TemplateRegistry(store=store).register("welcome", "Hi {{name}}", "Welcome", "text/plain")
+
+        template = TemplateRegistry(store=store).get("welcome")
+        self.assertEqual(template.render({"name": "John"}), ("Hi John", "Welcome"))
+
+    def test_template_email_wire_format(self):
+        registry = TemplateRegistry()
+        registry.register("welcome", "Hi {{name}}", "Welcome {{name}}", "text/plain")
+        email = Email("valid@email.com", "anothervalid@email.com", None, None,
+                      template=registry.get("welcome"), template_vars={"name": "John"})
+
+        payload = json.loads(json.dumps(encode_email(email)))
+        self.assertIsNone(payload[5])
+        decoded = decode_email(payload, registry)
+        self.assertEqual(decoded.subject, "Hi John")
+        self.assertEqual(decoded.content, "Welcome John")
+        self.assertIs(decoded.template, registry.get("welcome"))
+
+        with self.assertRaises(InvalidEmailArgument):
+            decode_email(payload)
+
+    def test_template_email_missing_variable(self):
+        registry = TemplateRegistry()
+        registry.register("welcome", "Hi {{name}}", "Welcome", "text/plain")
+        with self.assertRaises(InvalidEmailArgument):
+            Email("valid@email.com", "anothervalid@email.com", None, None, template=registry.get("welcome"), template_vars={})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+# End-to-end throughput benchmark. Emails are posted to the /email endpoint of the
+# webservice from a number of client threads, queued in the broker, and delivered by a
+# celery worker to the fake provider (fake_provider.py) standing in for SendGrid and
+# Mandrill. Reports the number of emails delivered per second, the latency of the
+# /email requests (enqueue latency), the time from posting an email until the
+# provider received it (end-to-end latency) and the CPU time used per email by the
+# webservice and by the worker.
+#
+# The webservice runs in this process through the Flask test client, so the numbers do
+# not include nginx and uwsgi. The fake provider and the worker are started as separate
+# processes. The broker and result backend are those of celeryconfig (BROKER_URL and
+# CELERY_RESULT_BACKEND, redis on localhost by default), and the worker is configured by
+# the usual MAILSERVICE_* environment variables.
+#
+# Each run is appended as a line of JSON with the commit and the parameters to the output
+# file, so the results of different commits can be compared.
+#
+# Run with: python throughput_benchmark.py [--emails 2000] [--clients 8] [--concurrency 4]
+#               [--output throughput.jsonl] [fake provider options, see fake_provider.py]
+
+import context
+import argparse
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+from fake_provider import SENDGRID_PATH, MANDRILL_PATH, add_behaviour_arguments
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def start_fake_provider(args, port):
+    command = [sys.executable, os.path.join(TESTS_DIR, "fake_provider.py"), "--port", str(port),
+               "--latency", str(args.latency), "--latency-dist", args.latency_dist,
+               "--latency-sigma", str(args.latency_sigma), "--error-rate", str(args.error_rate),
+               "--burst-length", str(args.burst_length), "--burst-status", str(args.burst_status)]
+    if args.burst_every is not None:
+        command += ["--burst-every", str(args.burst_every)]
+    if args.rate_limit is not None:
+        command += ["--rate-limit", str(args.rate_limit)]
+    process = subprocess.Popen(command, stdout=open(os.devnull, "w"))
+    wait_for(lambda: urllib2.urlopen("http://127.0.0.1:%d/_stats" % port).read())
+    return process
+
+
+def start_worker(args):
+    command = [sys.executable, "-m", "celery", "worker", "-A", "tasks", "--loglevel", "WARNING",
+               "--concurrency", str(args.concurrency), "--pool", args.pool]
+    return subprocess.Popen(command, cwd=ROOT_DIR, env=os.environ.copy())
+
+
+# Stop the worker and return the CPU time it used, including its pool processes
+def stop_worker(worker):
+    worker.send_signal(signal.SIGTERM)
+    pid, status, usage = os.wait4(worker.pid, 0)
+    return usage.ru_utime + usage.ru_stime
+
+
+def wait_for(function, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return function()
+        except Exception:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def get_provider_stats(port):
+    return json.loads(urllib2.urlopen("http://127.0.0.1:%d/_stats" % port).read())
+
+
+# Post the emails from the client threads. Returns the time each email was
+# posted by its subject and the latency of each request
+def post_emails(app, emails, clients, run_id):
+    posted = {}
+    latencies = []
+    counter = iter(xrange(emails))
+    lock = threading.Lock()
+
+    def post():
+        client = app.test_client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            subject = "%s-%d" % (run_id, i)
+            start = time.time()
+            response = client.post("/email", data={"to": "recipient%d@example.com" % i, "subject": subject,
+                                                   "content": "Benchmark email %d" % i})
+            latency = time.time() - start
+            if response.status_code != 200:
+                raise Exception("Posting an email failed: %s" % response.data)
+            with lock:
+                posted[subject] = start
+                latencies.append(latency)
+
+    threads = [threading.Thread(target=post) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return posted, latencies
+
+
+def run(args):
+    provider_port = get_free_port()
+    provider = start_fake_provider(args, provider_port)
+    os.environ.setdefault("SENDGRID_API_KEY", "benchmark")
+    os.environ.setdefault("MANDRILL_API_KEY", "benchmark")
+    os.environ["SENDGRID_API_URL"] = "http://127.0.0.1:%d%s" % (provider_port, SENDGRID_PATH)
+    os.environ["MANDRILL_API_URL"] = "http://127.0.0.1:%d%s" % (provider_port, MANDRILL_PATH)
+    worker = start_worker(args)
+    try:
+        # The webservice reads its configuration when imported
+        import webservice
+        wait_for(lambda: webservice.celeryApp.control.ping(timeout=1)[0], timeout=60)
+
+        run_id = "%x" % int(time.time() * 1000)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        posted, enqueue_latencies = post_emails(webservice.app, args.emails, args.clients, run_id)
+        enqueue_time = time.time() - start
+        web_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        deadline = time.time() + args.timeout
+        while True:
+            stats = get_provider_stats(provider_port)
+            received = dict((subject, at) for subject, at in stats["received"].items() if subject in posted)
+            if len(received) == len(posted) or time.time() > deadline:
+                break
+            time.sleep(0.2)
+        elapsed = max(received.values()) - start if received else None
+    finally:
+        worker_cpu = stop_worker(worker)
+        provider.terminate()
+        provider.wait()
+
+    end_to_end = [at - posted[subject] for subject, at in received.items()]
+    web_cpu = (web_usage.ru_utime + web_usage.ru_stime) - (usage.ru_utime + usage.ru_stime)
+    return {
+        "commit": get_commit(),
+        "time": int(start),
+        "params": dict((name, value) for name, value in vars(args).items() if name != "output"),
+        "emails": args.emails,
+        "delivered": len(received),
+        "provider_statuses": stats["statuses"],
+        "emails_per_second": len(received) / elapsed if elapsed else None,
+        "enqueue_per_second": args.emails / enqueue_time,
+        "enqueue_latency_p50": percentile(enqueue_latencies, 0.5),
+        "enqueue_latency_p99": percentile(enqueue_latencies, 0.99),
+        "end_to_end_p50": percentile(end_to_end, 0.5),
+        "end_to_end_p99": percentile(end_to_end, 0.99),
+        "web_cpu_per_email": web_cpu / args.emails,
+        "worker_cpu_per_email": worker_cpu / len(received) if received else None,
+    }
+
+
+def print_result(result):
+    def ms(value):
+        return "-" if value is None else "%.1f ms" % (value * 1000)
+
+    print "Commit %s: %d of %d emails delivered, provider responses %s" % (
+        result["commit"], result["delivered"], result["emails"], result["provider_statuses"])
+    print "%-24s %s" % ("Emails per second", "%.1f" % result["emails_per_second"] if result["emails_per_second"] else "-")
+    print "%-24s %.1f" % ("Enqueued per second", result["enqueue_per_second"])
+    print "%-24s p50 %s, p99 %s" % ("Enqueue latency", ms(result["enqueue_latency_p50"]), ms(result["enqueue_latency_p99"]))
+    print "%-24s p50 %s, p99 %s" % ("End-to-end latency", ms(result["end_to_end_p50"]), ms(result["end_to_end_p99"]))
+    print "%-24s %s" % ("Webservice CPU per email", ms(result["web_cpu_per_email"]))
+    print "%-24s %s" % ("Worker CPU per email", ms(result["worker_cpu_per_email"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark of micromailer")
+    parser.add_argument("--emails", type=int, default=2000, help="Number of emails to send")
+    parser.add_argument("--clients", type=int, default=8, help="Number of threads posting emails")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of worker processes")
+    parser.add_argument("--pool", default="prefork", help="Pool of the worker (prefork, threads or solo)")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the emails to be delivered")
+    parser.add_argument("--output", default=os.path.join(TESTS_DIR, "throughput.jsonl"),
+                        help="File the results are appended to")
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    result = run(args)
+    print_result(result)
+    with open(args.output, "a") as output:
+        output.write(json.dumps(result, sort_keys=True) + "\n")
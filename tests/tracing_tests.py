@@ -0,0 +1,78 @@
+import context
+import unittest
+import json
+import os
+import random
+import tempfile
+import threading
+
+from micromailer.tracing import Tracer, ListExporter, JsonFileExporter
+
+
+class TracerTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = ListExporter()
+        self.tracer = Tracer(self.exporter, sample_rate=1)
+
+    def test_sampling(self):
+        tracer = Tracer(self.exporter, sample_rate=0.25, rand=random.Random(1))
+        sampled = len([x for x in range(10000) if tracer.start_trace() is not None])
+        self.assertAlmostEqual(sampled / 10000.0, 0.25, delta=0.02)
+        self.assertIsNone(Tracer().start_trace())
+
+    def test_span(self):
+        trace_id = self.tracer.start_trace()
+        with self.tracer.span("stage", trace_id, service="sendgrid"):
+            pass
+        self.assertEqual(len(self.exporter.spans), 1)
+        span = self.exporter.spans[0]
+        self.assertEqual((span["trace_id"], span["name"], span["service"]), (trace_id, "stage", "sendgrid"))
+        self.assertGreaterEqual(span["duration"], 0)
+
+    def test_span_without_trace(self):
+        with self.tracer.span("stage") as span:
+            self.assertIsNone(span)
+        self.tracer.record("stage", 0, 1)
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_span_error(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.span("stage", "trace"):
+                raise ValueError()
+        self.assertEqual(self.exporter.spans[0]["error"], "ValueError")
+
+    def test_active_trace(self):
+        with self.tracer.activate("trace"):
+            with self.tracer.activate("other"):
+                self.assertEqual(self.tracer.current_trace(), "other")
+            with self.tracer.span("stage"):
+                pass
+        self.assertIsNone(self.tracer.current_trace())
+        self.assertEqual(self.exporter.spans[0]["trace_id"], "trace")
+
+    def test_wrap(self):
+        with self.tracer.activate("trace"):
+            function = self.tracer.wrap(lambda: self.tracer.record("stage", 0, 1))
+        thread = threading.Thread(target=function)
+        thread.start()
+        thread.join()
+        self.assertEqual(self.exporter.spans[0]["trace_id"], "trace")
+
+    def test_json_file_exporter(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            tracer = Tracer(JsonFileExporter(path), sample_rate=1)
+            tracer.record("stage", 10, 0.5, "trace", email_id="email")
+            tracer.record("other", 11, 0.5, "trace")
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+        self.assertEqual(spans[0], {"trace_id": "trace", "name": "stage", "start": 10, "duration": 0.5, "email_id": "email"})
+        self.assertEqual(spans[1]["name"], "other")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# Microbenchmark of the validation of emails on the worker. Measures the time per email to
+# decode an email from the task wire format and send it with a mail service, which checks
+# that the email is valid, for emails with 1, 10, 100 and 1000 recipients. Compared with
+# the previous validation, which checked every recipient again each time is_valid was
+# called: when decoded and when sent.
+#
+# Run with: python validation_benchmark.py [emails]
+
+import context
+import sys
+import time
+
+from micromailer import models
+from micromailer.models import Email, InvalidEmailArgument, email_pattern, encode_email, decode_email
+from micromailer.mailservice import MailServiceBase
+
+
+class MockMailService(MailServiceBase):
+
+    def _do_send(self, email):
+        pass
+
+
+# The validation before emails were validated once
+class PreviousEmail(Email):
+    __slots__ = ()
+
+    def is_valid(self):
+        if len(self.to) == 0:
+            raise InvalidEmailArgument('No recipient supplied')
+        for email in self.to:
+            if email[0] is None or not email_pattern.match(email[0]):
+                raise InvalidEmailArgument("Recipient '%s' is invalid" % email[0])
+        if self.sender is None or not email_pattern.match(self.sender):
+            raise InvalidEmailArgument('Sender email is invalid')
+        if self.subject is None or type(self.subject) not in [str, unicode] or len(self.subject) == 0:
+            raise InvalidEmailArgument("Subject has to be a non-empty string")
+        if self.content is None or type(self.content) not in [str, unicode] or len(self.content) == 0:
+            raise InvalidEmailArgument("Content has to be a non-empty string")
+        if self.content_type is None or type(self.content_type) not in [str, unicode] or \
+                self.content_type not in models.allowed_content_types:
+            raise InvalidEmailArgument("Content-type has to be plain/text, text/html or text/markdown")
+        return True
+
+    def add_recipient(self, email, name=None):
+        self.to.append((email, name))
+
+
+def previous_decode_email(payload):
+    version, to, sender, sender_name, subject, content, content_type, template_id, template_vars = payload
+    email = PreviousEmail(to[0][0], sender, subject, content, content_type, to_name=to[0][1], sender_name=sender_name)
+    for recipient in to[1:]:
+        email.add_recipient(recipient[0], recipient[1])
+    email.is_valid()
+    return email
+
+
+def get_payload(recipients):
+    email = Email("recipient0@example.com", "no-reply@martindam.dk", "Subject", "Content")
+    for i in range(1, recipients):
+        email.add_recipient("recipient%d@example.com" % i)
+    return encode_email(email)
+
+
+def run(decode, payload, emails):
+    service = MockMailService()
+    start = time.time()
+    for i in xrange(emails):
+        service.send(decode(payload))
+    return (time.time() - start) / emails
+
+
+if __name__ == '__main__':
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print "%-12s %-14s %-14s %-8s" % ("recipients", "previous", "validated once", "speedup")
+    for recipients in [1, 10, 100, 1000]:
+        payload = get_payload(recipients)
+        count = max(10, emails / recipients)
+        previous = run(previous_decode_email, payload, count)
+        current = run(decode_email, payload, count)
+        print "%-12d %-14s %-14s %-8s" % (recipients, "%.2f us" % (previous * 1e6), "%.2f us" % (current * 1e6),
+                                          "%.1fx" % (previous / current))
@@ -1,17 +1,76 @@
 from flask import Flask, request, Response
-from celery.result import AsyncResult
-from celery.exceptions import TimeoutError
+from celery import states
 import json
 import logging
-import markdown
+import os
+import time
+import uuid
 
-from tasks import send_email
-from micromailer.models import Email, InvalidEmailArgument
+from tasks import celeryApp, send_email, send_email_batch, subscribe_email_status, markdown_cache, get_template_registry, \
+    PRIORITY_QUEUES, DEFAULT_PRIORITY
+from micromailer.models import Email, InvalidEmailArgument, encode_email
+from micromailer.templates import TemplateConflict
+from micromailer.deliveryrecord import decode_delivery_record, encode_legacy_result
+from micromailer import metrics
+from micromailer.tracing import tracer
 
-from emailservice_config import MAILSERVICE_SENDER_EMAIL, MAILSERVICE_SENDER_NAME
+from emailservice_config import MAILSERVICE_SENDER_EMAIL, MAILSERVICE_SENDER_NAME, MAILSERVICE_BATCH_MODE, \
+    MAILSERVICE_RENDER_IN_WORKER, MAILSERVICE_WEB_METRICS_PORT
 
 app = Flask(__name__)
 
+# Task used to deliver the emails
+email_task = send_email_batch if MAILSERVICE_BATCH_MODE else send_email
+
+# Email status reported for each task state
+EMAIL_STATUSES = {
+    states.PENDING: 'queued',
+    states.RETRY: 'retrying',
+    states.SUCCESS: 'success',
+    states.FAILURE: 'failed'
+}
+
+# Longest time in seconds a status request may wait for the status to change
+MAX_STATUS_WAIT = 30
+
+# Maximum number of emails accepted in a single batch request
+MAX_BATCH_EMAILS = 10000
+
+added_count = metrics.registry.counter("micromailer_emails_added_total", "Emails added by status", ("status",))
+
+# Namespace of the email ids derived from idempotency keys
+IDEMPOTENCY_NAMESPACE = uuid.UUID('6b0c4f3e-2d55-4f8e-9a47-5c1d0e7b9a21')
+
+_metrics_server_pid = None
+
+
+# Serve the metrics of the webservice process on a free port of the ports from
+# MAILSERVICE_WEB_METRICS_PORT, one port for each uwsgi worker. Started by the first request
+# handled by each process, as uwsgi forks the workers after loading the app
+@app.before_request
+def start_metrics_server():
+    global _metrics_server_pid
+    if MAILSERVICE_WEB_METRICS_PORT is None or _metrics_server_pid == os.getpid():
+        return
+    _metrics_server_pid = os.getpid()
+    ports = get_process_count()
+    server = metrics.start_process_http_server(MAILSERVICE_WEB_METRICS_PORT, ports)
+    if server is None:
+        logging.error("No free port to serve metrics on from port %d to %d" % (
+            MAILSERVICE_WEB_METRICS_PORT, MAILSERVICE_WEB_METRICS_PORT + ports - 1))
+        return
+    logging.info("Serving metrics on port %d" % server.server_port)
+
+
+# Return the number of processes serving the webservice, which is the number of uwsgi
+# workers when run by uwsgi
+def get_process_count():
+    try:
+        import uwsgi
+    except ImportError:
+        return 1
+    return uwsgi.numproc
+
 
 @app.route('/')
 def index():
@@ -23,7 +82,12 @@ Add en email to be sent by the system. This endpoints emits the task definition
 so a Celery worker can deliver the email. A HTTP/200 indicates the task was
 successfully queued in Celery, NOT the delivery of the email.
 Returns the emailid that can be used to query for the status of the email
-on the /email/<emailId> endpoint
+on the /email/<emailId> endpoint. An idempotency key can be given with the
+idempotency_key field or the Idempotency-Key header, in which case adding the
+same email again returns the same emailId and the email is only delivered once.
+The optional priority field is transactional (the default) or bulk. Bulk emails
+are queued separately so they do not delay the transactional emails.
+The traceId is returned for emails traced through the system
 '''
 @app.route('/email', methods=['POST'])
 def add_email():
@@ -33,43 +97,205 @@ def add_email():
     else:
         fields = request.form
 
+    trace_id = tracer.start_trace()
     try:
-        email = Email(fields['to'], MAILSERVICE_SENDER_EMAIL,
-                      fields['subject'], markdown.markdown(fields['content']),
-                      content_type="text/html", sender_name=MAILSERVICE_SENDER_NAME,
-                      to_name=fields.get('to_name', None))
+        with tracer.span("webservice.build_email", trace_id):
+            email = build_email(fields)
+            priority = get_priority(fields)
     except InvalidEmailArgument as e:
+        added_count.inc(("failed",))
         return Response(json.dumps({"status": "failed", "error": e.message}), status=400)
 
-    email_id = send_email.apply_async([email]).id
+    added_count.inc(("queued",))
+    email_id = enqueue_email(email, fields.get('idempotency_key', request.headers.get('Idempotency-Key')), trace_id,
+                             priority=priority)
     logging.debug("Enqueing email to %s with emailId=%s" % (email.to[0][0], email_id))
-    return Response(json.dumps({"status": "queued", "emailId": email_id}), mimetype='application/json')
+    response = {"status": "queued", "emailId": email_id}
+    if trace_id is not None:
+        response["traceId"] = trace_id
+    return Response(json.dumps(response), mimetype='application/json')
+
+
+'''
+Add a list of emails to be sent by the system. The body is either a JSON array
+of emails or a NDJSON stream (Content-Type: application/x-ndjson) with an email
+per line. Each email has the same fields as for the /email endpoint. All the
+valid emails are queued in Celery over a single broker connection.
+Returns a list with the emailId or validation error for each email in the
+same order as they were given
+'''
+@app.route('/email/batch', methods=['POST'])
+def add_email_batch():
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            items = [json.loads(line) for line in request.get_data().splitlines() if line.strip()]
+        else:
+            items = json.loads(request.get_data())
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        return Response(json.dumps({"status": "failed", "error": "Body has to be a JSON array or NDJSON stream of emails"}), status=400)
+    if len(items) > MAX_BATCH_EMAILS:
+        return Response(json.dumps({"status": "failed", "error": "At most %d emails can be sent in a batch" % MAX_BATCH_EMAILS}), status=400)
+
+    results = []
+    with celeryApp.producer_or_acquire() as producer:
+        for fields in items:
+            try:
+                if not isinstance(fields, dict):
+                    raise InvalidEmailArgument("Email has to be a JSON object")
+                email = build_email(fields)
+                priority = get_priority(fields)
+            except InvalidEmailArgument as e:
+                results.append({"status": "failed", "error": e.message})
+                continue
+            except KeyError as e:
+                results.append({"status": "failed", "error": "Missing field '%s'" % e.args[0]})
+                continue
+            email_id = enqueue_email(email, fields.get('idempotency_key'), tracer.start_trace(), producer, priority)
+            results.append({"status": "queued", "emailId": email_id})
+
+    queued = len([x for x in results if "emailId" in x])
+    added_count.inc(("queued",), queued)
+    added_count.inc(("failed",), len(items) - queued)
+    logging.debug("Enqueued %d emails from batch of %d" % (queued, len(items)))
+    return Response(json.dumps({"emails": results}), mimetype='application/json')
 
 
 '''
-Retrieve the status of an email. Returns an json object describing the status.
-Until the task have been executed successfully or the maximum number of retries
-have been reached, this will return "not found"
+Register a named template that emails can be sent from by giving its
+template_id and variables to /email instead of the subject and content.
+Fields: subject, content and optionally content_type (text/markdown, which
+is the default, text/html or text/plain). Placeholders are written as {{name}}.
+Templates can not be changed once registered.
+'''
+@app.route('/template/<templateId>', methods=['PUT'])
+def add_template(templateId):
+    fields = request.get_json(force=True, silent=True)
+    if not isinstance(fields, dict):
+        return Response(json.dumps({"status": "failed", "error": "Body has to be a JSON object"}), status=400)
+    try:
+        created = get_template_registry().register(templateId, fields.get('subject'), fields.get('content'),
+                                                   fields.get('content_type', "text/markdown"))
+    except InvalidEmailArgument as e:
+        return Response(json.dumps({"status": "failed", "error": e.message}), status=400)
+    except TemplateConflict as e:
+        return Response(json.dumps({"status": "failed", "error": e.message}), status=409)
+
+    variables = sorted(get_template_registry().get(templateId).variables)
+    return Response(json.dumps({"status": "created" if created else "exists", "templateId": templateId, "variables": variables}),
+                    status=201 if created else 200, mimetype='application/json')
+
+
+# Queue the email for delivery in the queue of its priority lane and return its email id.
+# The trace id is passed on to the worker in the task headers and the time the email was
+# enqueued in the task arguments, from which the workers measure the time emails wait in
+# each lane. Emails that are not traced by the webservice are not traced by the workers either
+def enqueue_email(email, key, trace_id, producer=None, priority=DEFAULT_PRIORITY):
+    with tracer.span("webservice.enqueue", trace_id):
+        return email_task.apply_async([encode_email(email)], {'enqueued_at': time.time()}, task_id=get_email_id(key),
+                                      producer=producer, headers={'trace_id': trace_id},
+                                      queue=PRIORITY_QUEUES[priority]).id
+
+
+# Return the priority lane of the email from the posted fields. Raises InvalidEmailArgument
+# if the priority is unknown
+def get_priority(fields):
+    priority = fields.get('priority', DEFAULT_PRIORITY)
+    if not isinstance(priority, basestring) or priority not in PRIORITY_QUEUES:
+        raise InvalidEmailArgument("Priority has to be %s" % " or ".join(sorted(PRIORITY_QUEUES, reverse=True)))
+    return priority
+
+
+# Return the email id for an idempotency key, or None to let Celery create a new id.
+# The workers only deliver an email once per email id
+def get_email_id(key):
+    if key is None:
+        return None
+    return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, unicode(key).encode('utf-8')))
+
+
+# Create the email to send from the posted fields. Raises InvalidEmailArgument
+# if the email is invalid and KeyError if a required field is missing.
+# The markdown content is rendered here unless it is rendered by the workers.
+# Template emails are only validated here and rendered by the workers
+def build_email(fields):
+    if 'template_id' in fields:
+        return Email(fields['to'], MAILSERVICE_SENDER_EMAIL, None, None,
+                     sender_name=MAILSERVICE_SENDER_NAME, to_name=fields.get('to_name', None),
+                     template=get_template_registry().get(fields['template_id']), template_vars=fields.get('variables', {}))
+
+    content = fields['content']
+    content_type = "text/markdown"
+    if not MAILSERVICE_RENDER_IN_WORKER:
+        if isinstance(content, basestring):
+            content = markdown_cache.render(content)
+        content_type = "text/html"
+    return Email(fields['to'], MAILSERVICE_SENDER_EMAIL,
+                 fields['subject'], content,
+                 content_type=content_type, sender_name=MAILSERVICE_SENDER_NAME,
+                 to_name=fields.get('to_name', None))
+
+
+'''
+Retrieve the status of an email. Returns an json object describing the status:
+queued (or unknown emailId), retrying, success or failed together with the
+number of delivery attempts made. Delivered emails have a result with the
+mail service, the message id given by the service, the time of delivery and
+the indexes of any rejected recipients. The stored status is read once and returned
+right away. With the optional wait=<seconds> argument, a request for an email
+that is not delivered yet waits until its status changes or the time runs out
+(requires the redis result backend)
 '''
 @app.route('/email/<emailId>', methods=['GET'])
 def get_email_status(emailId):
-    return_object = {'status': 'unknown', 'emailId': emailId}
+    wait = min(request.args.get('wait', 0, type=float), MAX_STATUS_WAIT)
+    subscription = subscribe_email_status(emailId) if wait > 0 else None
     try:
-        task_result = AsyncResult(id=emailId)
-        task_result.get(timeout=2, interval=0.1)
+        meta = celeryApp.backend.get_task_meta(emailId)
+        if subscription is not None and meta['status'] in states.UNREADY_STATES:
+            wait_until = time.time() + wait
+            while time.time() < wait_until:
+                if subscription.get_message(timeout=wait_until - time.time()) is not None:
+                    meta = celeryApp.backend.get_task_meta(emailId)
+                    break
+    finally:
+        if subscription is not None:
+            subscription.close()
+
+    return Response(json.dumps(build_email_status(emailId, meta)), mimetype='application/json')
+
 
-        # If the task raised an exception, the exception is re-raised here
-        return_object['status'] = 'success'
-        if task_result.info is not None:
-            return_object['result'] = task_result.info
+def build_email_status(emailId, meta):
+    return_object = {'status': EMAIL_STATUSES.get(meta['status'], 'unknown'), 'emailId': emailId, 'attempts': 0}
+    result = meta['result']
+    if meta['status'] == states.SUCCESS:
+        return_object['attempts'], return_object['result'] = build_delivery_result(result)
+    elif meta['status'] in (states.RETRY, states.FAILURE):
+        return_object['attempts'] = result.get('attempts', 1) if isinstance(result, dict) else 1
+        exception = celeryApp.backend.exception_to_python(result)
+        try:
+            return_object['exception'] = json.loads(exception.message)
+        except (ValueError, TypeError, AttributeError):
+            return_object['exception'] = str(exception)
+    return return_object
 
-    except TimeoutError:
-        return_object['status'] = 'notfound'
-    except Exception as exception:
-        return_object['status'] = 'failed'
-        return_object['exception'] = json.loads(exception.message)
 
-    return Response(json.dumps(return_object), mimetype='application/json')
+# Return the number of attempts and the delivery result reported for a stored
+# result. Results stored before delivery records were introduced are converted
+# to records, so all the results are reported the same way
+def build_delivery_result(result):
+    if isinstance(result, dict):
+        result = encode_legacy_result(result)
+    record = decode_delivery_record(result)
+    return record['attempts'], {
+        'delivery': record['status'],
+        'service': record['service'],
+        'providerId': record['provider_id'],
+        'deliveredAt': record['timestamp'],
+        'rejected': record['rejected'],
+        'message': record['message']
+    }
 
 
 if __name__ == '__main__':